@@ -1,28 +1,208 @@
-from flask import Flask, Response, render_template, request, jsonify, make_response
+from flask import Flask, Response, render_template, request, jsonify, make_response, g, has_request_context, stream_with_context
 from dotenv import load_dotenv
-from pymongo import MongoClient, ReturnDocument
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure
 from bson.json_util import dumps
+from bson.decimal128 import Decimal128
 from bson.objectid import ObjectId
 from flask_pymongo import PyMongo
-from flask.json import JSONEncoder
+from flask.json.provider import DefaultJSONProvider
+from flask.wrappers import Request
 from flask_cors import CORS
 from flask import send_from_directory
+from flask.cli import AppGroup
+from flask.logging import default_handler
+from collections import OrderedDict
+from contextlib import closing
 from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlencode
+import atexit
+import base64
+import click
+import hashlib
+import hmac
+import logging
+import math
 import os
 import datetime
+import json
+import queue
+import random
+import secrets
+import sqlite3
+import threading
+import time
 import traceback
+import zlib
 
+try:
+    import orjson
+except ImportError:  # optional: JSON falls back to the stdlib encoder without it
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: devices fall back to JSON without it
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # optional: devices fall back to JSON without it
+    cbor2 = None
+
+try:
+    import brotli
+except ImportError:  # optional: responses are only gzip-compressed without it
+    brotli = None
+
+
+# ==========================================
+# JSON ENCODING
+# ==========================================
+# jsonify() and app.json.dumps() encode with orjson when it is installed and
+# with the stdlib encoder otherwise; both encode values the same way. ObjectId and
+# Decimal128 become strings and datetimes become ISO 8601 in UTC with a "Z"
+# suffix (Mongo hands back naive UTC datetimes).
+
+ORJSON_OPTIONS = (orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS) if orjson is not None else 0
+
+
+def iso_datetime(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def json_default(obj):
+    """Encode the BSON and datetime values a user or teacher document can hold."""
+    if isinstance(obj, (ObjectId, Decimal128)):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return iso_datetime(obj)
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, falling back to the stdlib encoder."""
+
+    default = staticmethod(json_default)
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        option = ORJSON_OPTIONS
+        if self._app.debug:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(self._prepare_response_obj(args, kwargs), default=json_default, option=option)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+# ==========================================
+# BINARY ENCODINGS
+# ==========================================
+# ESP32 clients can send and receive msgpack or CBOR instead of JSON. A body
+# with Content-Type application/msgpack or application/cbor is decoded by
+# request.get_json()/request.json, and jsonify() answers in whichever of the
+# formats the Accept header prefers. Values are mapped as for JSON: ObjectId
+# becomes a string and datetimes become ISO 8601 strings, so a field has the
+# same type whichever format the client picked.
+
+MSGPACK_MIMETYPE = "application/msgpack"
+CBOR_MIMETYPE = "application/cbor"
+
+
+def _cbor_default(encoder, obj):
+    try:
+        encoder.encode(json_default(obj))
+    except TypeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not CBOR serializable") from None
+
+
+def _cbor_values(obj):
+    """Swap datetimes for json_default()'s strings; cbor2 would tag them natively before calling a default."""
+    if isinstance(obj, dict):
+        return {key: _cbor_values(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_cbor_values(value) for value in obj]
+    if isinstance(obj, datetime.date):
+        return json_default(obj)
+    return obj
+
+
+# mimetype -> (encode, decode) for the formats whose library is installed
+BINARY_FORMATS = {}
+if msgpack is not None:
+    BINARY_FORMATS[MSGPACK_MIMETYPE] = (
+        lambda obj: msgpack.packb(obj, default=json_default, datetime=False),
+        lambda data: msgpack.unpackb(data, raw=False)
+    )
+if cbor2 is not None:
+    BINARY_FORMATS[CBOR_MIMETYPE] = (
+        lambda obj: cbor2.dumps(_cbor_values(obj), default=_cbor_default),
+        cbor2.loads
+    )
+
+
+def negotiated_mimetype():
+    """Response mimetype for this request: JSON unless Accept prefers a binary format."""
+    if not BINARY_FORMATS or not has_request_context():
+        return "application/json"
+    return request.accept_mimetypes.best_match(["application/json", *BINARY_FORMATS], "application/json")
+
+
+class NegotiatingJSONProvider(FastJSONProvider):
+    """jsonify() that answers in msgpack or CBOR when the client asks for it."""
+
+    def response(self, *args, **kwargs):
+        mimetype = negotiated_mimetype()
+        if mimetype in BINARY_FORMATS:
+            encode = BINARY_FORMATS[mimetype][0]
+            response = self._app.response_class(encode(self._prepare_response_obj(args, kwargs)), mimetype=mimetype)
+        else:
+            response = super().response(*args, **kwargs)
+        if BINARY_FORMATS:
+            response.vary.add("Accept")
+        return response
+
+
+class DeviceRequest(Request):
+    """Request whose get_json() also decodes msgpack and CBOR bodies."""
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype not in BINARY_FORMATS:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if cache and "_binary_body" in self.__dict__:
+            return self._binary_body
+        try:
+            body = BINARY_FORMATS[self.mimetype][1](self.get_data(cache=cache))
+        except Exception as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._binary_body = body
+        return body
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        return super().default(obj)
 
 load_dotenv()
 
 app = Flask(__name__)
-app.json_encoder = CustomJSONEncoder
+app.json = NegotiatingJSONProvider(app)
+app.request_class = DeviceRequest
 
 # Updated CORS to allow both your website and ESP32
 CORS(app, 
@@ -34,55 +214,1802 @@ CORS(app,
          'https://gameapi-2e9bb6e38339.herokuapp.com'
      ],
      supports_credentials=True,
-     allow_headers=['Content-Type', 'Authorization', 'X-API-Key', 'X-Teacher-Token'],
+     allow_headers=['Content-Type', 'Authorization', 'X-API-Key', 'X-Teacher-Token', 'Idempotency-Key', 'If-None-Match'],
+     expose_headers=['ETag', 'X-Next-Cursor', 'Link'],
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS']
 )
 
 
 app.config["MONGO_URI"] = os.getenv('MONGO_URI')
+app.config["KEYED_INVENTORY"] = os.getenv('KEYED_INVENTORY', '0') == '1'
+app.config["IDEMPOTENCY_TTL_SECONDS"] = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+app.config["IDEMPOTENCY_CACHE_SIZE"] = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 1024))
+app.config["ASYNC_INGEST"] = os.getenv('ASYNC_INGEST', '0') == '1'
+app.config["INGEST_JOURNAL_PATH"] = os.getenv('INGEST_JOURNAL_PATH', 'ingest_journal.sqlite3')
+app.config["INGEST_BATCH_SIZE"] = int(os.getenv('INGEST_BATCH_SIZE', 200))
+app.config["INGEST_POLL_SECONDS"] = float(os.getenv('INGEST_POLL_SECONDS', 1))
+app.config["ROSTER_CACHE"] = os.getenv('ROSTER_CACHE', '1') == '1'
+app.config["ROSTER_POLL_SECONDS"] = float(os.getenv('ROSTER_POLL_SECONDS', 5))
+app.config["VERSION_FLUSH_SECONDS"] = float(os.getenv('VERSION_FLUSH_SECONDS', 0.05))
+app.config["COMPRESS_MIN_SIZE"] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+app.config["COMPRESS_GZIP_LEVEL"] = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+app.config["COMPRESS_BROTLI_QUALITY"] = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+app.config["SYNC_INDEXES"] = os.getenv('SYNC_INDEXES', '0') == '1'
+app.config["SSE_HEARTBEAT_SECONDS"] = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+app.config["SSE_MAX_SECONDS"] = float(os.getenv('SSE_MAX_SECONDS', 300))
+app.config["REFRESH_POLL_SECONDS"] = float(os.getenv('REFRESH_POLL_SECONDS', 2))
+app.config["TEACHER_TOKEN_KEYS"] = os.getenv('TEACHER_TOKEN_KEYS', '')
+app.config["TEACHER_TOKEN_TTL_SECONDS"] = int(os.getenv('TEACHER_TOKEN_TTL_SECONDS', 12 * 60 * 60))
+app.config["TEACHER_LEGACY_TOKENS"] = os.getenv('TEACHER_LEGACY_TOKENS', '0') == '1'
+app.config["RATE_LIMIT"] = os.getenv('RATE_LIMIT', '1') == '1'
+app.config["RATE_LIMIT_PATH"] = os.getenv('RATE_LIMIT_PATH', 'rate_limits.sqlite3')
+# Per-process Mongo pool. Size it for the worker's threads plus its few background threads.
+app.config["MONGO_MAX_POOL_SIZE"] = int(os.getenv('MONGO_MAX_POOL_SIZE', 32))
+app.config["MONGO_MIN_POOL_SIZE"] = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000))
+app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+
+mongo = PyMongo()
+
+
+def init_mongo():
+    """Create this process's MongoClient, replacing any inherited one.
+
+    Runs at import with connect=False, so nothing is opened before gunicorn
+    forks; gunicorn.conf.py calls it again in each worker after the fork so
+    no worker shares a client (or its monitor threads) with the master.
+    """
+    if getattr(mongo, "cx", None) is not None:
+        mongo.cx.close()
+    mongo.init_app(app, **mongo_client_options(), connect=False)
+
+
+def mongo_client_options():
+    """Pool settings shared by this client and the async one in asgi.py."""
+    return {
+        "maxPoolSize": app.config["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": app.config["MONGO_MIN_POOL_SIZE"],
+        "waitQueueTimeoutMS": app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+        "serverSelectionTimeoutMS": app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+    }
+
+
+init_mongo()
+
+
+# ==========================================
+# DECLARED INDEXES
+# ==========================================
+# Every index the app relies on is declared here with the endpoints that
+# rely on it. With SYNC_INDEXES=1 each worker creates missing ones in the
+# background on its first request; `flask indexes sync|diff|drop-unused`
+# manage them by hand and `flask indexes routes` prints the route report.
+# Index names are pymongo's defaults, so indexes created before this spec
+# existed are recognised by their keys.
+
+# Endpoints that look a user up by rfidUID, directly or through update_user()
+_RFID_ROUTES = (
+    "add_5_coin", "create_user_from_rfid", "get_users", "get_user_summary", "add_creature",
+    "add_artifact", "add_challenge_code", "update_creature_loot_and_coin", "set_main_creature",
+    "update_creature_stats", "complete_loot_upload", "add_crafted_artifact", "add_creature_stacked",
+    "add_loot_stacked", "complete_loot_upload_stacked", "set_main_creature_stacked",
+    "add_loot_stacked_v2", "complete_loot_upload_stacked_v2", "teacher_award_coins", "purchase_item",
+    "purchase_cart", "use_travel_item", "set_location", "use_seize_power", "set_class", "refresh_now",
+)
+
+INDEX_SPEC = (
+    {"collection": "Users", "keys": [("rfidUID", 1)],
+     "options": {"unique": True, "partialFilterExpression": {"rfidUID": {"$exists": True}}},
+     "routes": _RFID_ROUTES},
+    # Login matches name and password; the name narrows it to a handful of
+    # documents, and plaintext passwords are kept out of the index
+    {"collection": "Users", "keys": [("name", 1)], "options": {},
+     "routes": ("login_user",)},
+    # Also serves playerClass-only lookups once the school backfill has run
+    {"collection": "Users", "keys": [("school", 1), ("playerClass", 1)], "options": {},
+     "routes": ("get_users", "get_class_students")},
+    {"collection": "Users", "keys": [("lordOf", 1)],
+     "options": {"partialFilterExpression": {"lordOf": {"$type": "string"}}},
+     "routes": ("use_seize_power",)},
+    {"collection": "Teachers", "keys": [("email", 1)], "options": {"unique": True},
+     "routes": ("register_teacher", "login_teacher")},
+    {"collection": "ClassRefresh", "keys": [("classId", 1)], "options": {"unique": True},
+     "routes": ("refresh_now", "get_refresh_now")},
+    {"collection": "Classes", "keys": [("school", 1), ("_id", 1)], "options": {},
+     "routes": ("get_teacher_classes",)},
+    {"collection": "Leaderboard", "keys": [("playerClass", 1), ("coins", -1)], "options": {},
+     "routes": ("get_leaderboard", "get_leaderboard_rank")},
+    {"collection": "Leaderboard", "keys": [("school", 1), ("coins", -1)], "options": {},
+     "routes": ("get_leaderboard", "get_leaderboard_rank")},
+    {"collection": "Leaderboard", "keys": [("coins", -1)], "options": {},
+     "routes": ("get_leaderboard", "get_leaderboard_rank")},
+    {"collection": "RevokedTokens", "keys": [("expiresAt", 1)], "options": {"expireAfterSeconds": 0},
+     "routes": ("logout_teacher",)},
+    {"collection": "IdempotencyKeys", "keys": [("createdAt", 1)],
+     "options": {"expireAfterSeconds": app.config["IDEMPOTENCY_TTL_SECONDS"]},
+     "routes": (), "note": "strict-key writes sent with an Idempotency-Key"},
+)
+
+# Options that make two indexes on the same keys different indexes
+_INDEX_OPTION_KEYS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def _index_options(info):
+    return {key: info[key] for key in _INDEX_OPTION_KEYS if key in info}
+
+
+def _index_keys(keys):
+    return [(field, int(direction)) for field, direction in keys]
+
+
+def declared_indexes(collection=None):
+    return [spec for spec in INDEX_SPEC if collection is None or spec["collection"] == collection]
+
+
+def declared_index(collection, *fields):
+    """The spec of `collection` indexing exactly `fields`, in order."""
+    return next(spec for spec in declared_indexes(collection) if [field for field, _ in spec["keys"]] == list(fields))
+
+
+def create_declared_index(spec):
+    return mongo.db[spec["collection"]].create_index(spec["keys"], **spec["options"])
+
+
+def index_diff():
+    """Compare the spec with the database.
+
+    Returns (missing, conflicting, undeclared): declared specs with no index
+    on their keys, (spec, existing name) pairs whose options differ, and
+    (collection, name) for indexes nothing declares.
+    """
+    missing, conflicting, undeclared = [], [], []
+    for collection in sorted({spec["collection"] for spec in INDEX_SPEC}):
+        existing = mongo.db[collection].index_information()
+        claimed = {"_id_"}
+        for spec in declared_indexes(collection):
+            name = next((name for name, info in existing.items()
+                         if _index_keys(info["key"]) == _index_keys(spec["keys"])), None)
+            if name is None:
+                missing.append(spec)
+                continue
+            claimed.add(name)
+            if _index_options(existing[name]) != spec["options"]:
+                conflicting.append((spec, name))
+        undeclared.extend((collection, name) for name in existing if name not in claimed)
+    return missing, conflicting, undeclared
+
+
+def sync_indexes(collection=None):
+    """Create the declared indexes that do not exist yet. Returns the names created.
+
+    Existing indexes are left alone; an index whose options changed has to
+    be dropped first, which `flask indexes diff` points out.
+    """
+    return [create_declared_index(spec) for spec in declared_indexes(collection)]
+
+
+def index_sync_task():
+    """Background thread body for SYNC_INDEXES."""
+    for spec in INDEX_SPEC:
+        try:
+            create_declared_index(spec)
+        except Exception as e:
+            # e.g. duplicate rfidUIDs blocking the unique index; the rest still get built
+            app.logger.error(f"Index sync failed for {spec['collection']} {spec['keys']}: {str(e)}")
+
+
+def _describe_index(spec):
+    keys = ", ".join(f"{field}:{direction}" for field, direction in spec["keys"])
+    options = " ".join(f"{key}={value}" for key, value in spec["options"].items())
+    return f"{spec['collection']}({keys}){' ' + options if options else ''}"
+
+
+# ==========================================
+# TEACHER ENDPOINTS (NEW)
+# ==========================================
+
+def api_key_error(api_key, strict):
+    """The 401 message for this X-API-Key value, or None if it is accepted.
+
+    Strict endpoints need the key; the others take requests without one
+    (website requests) but still refuse a wrong one. Shared with asgi.py.
+    """
+    expected_key = os.getenv('API_KEY')
+    if strict and (not api_key or api_key != expected_key):
+        return "API key required"
+    if not strict and api_key and api_key != expected_key:
+        return "Invalid API key"
+    return None
+
+
+def require_api_key_optional(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # ✅ Allow OPTIONS requests (CORS preflight)
+        if request.method == 'OPTIONS':
+            return make_response('', 204)
+            
+        error = api_key_error(request.headers.get('X-API-Key'), strict=False)
+        if error:
+            return make_response(jsonify({"error": error}), 401)
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Strict API key requirement (for sensitive operations)
+def require_api_key_strict(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # ✅ Allow OPTIONS requests (CORS preflight)
+        if request.method == 'OPTIONS':
+            return make_response('', 204)
+            
+        error = api_key_error(request.headers.get('X-API-Key'), strict=True)
+        if error:
+            return make_response(jsonify({"error": error}), 401)
+        
+        # Devices retrying after a timeout send the same Idempotency-Key
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            return idempotent_response(idempotency_key, f, *args, **kwargs)
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# ==========================================
+# IDEMPOTENCY KEYS
+# ==========================================
+# Responses to requests carrying an Idempotency-Key are stored in the
+# IdempotencyKeys collection (expired by a TTL index on createdAt) and in a
+# small per-process LRU, so a retried write is answered from the stored
+# response instead of being applied twice.
+
+_idempotency_cache = OrderedDict()
+_idempotency_lock = threading.Lock()
+_idempotency_index_ready = False
+
+# A pending record older than this is assumed to belong to a crashed worker
+IDEMPOTENCY_PENDING_TIMEOUT = datetime.timedelta(seconds=60)
+
+
+def _idempotency_cache_get(record_id):
+    with _idempotency_lock:
+        entry = _idempotency_cache.get(record_id)
+        if entry is None:
+            return None
+        if entry["expiresAt"] < datetime.datetime.utcnow():
+            del _idempotency_cache[record_id]
+            return None
+        _idempotency_cache.move_to_end(record_id)
+        return entry
+
+
+def _idempotency_cache_put(record_id, record):
+    with _idempotency_lock:
+        _idempotency_cache[record_id] = {
+            **record,
+            "expiresAt": record["createdAt"] + datetime.timedelta(seconds=app.config["IDEMPOTENCY_TTL_SECONDS"])
+        }
+        _idempotency_cache.move_to_end(record_id)
+        while len(_idempotency_cache) > app.config["IDEMPOTENCY_CACHE_SIZE"]:
+            _idempotency_cache.popitem(last=False)
+
+
+def _ensure_idempotency_index():
+    global _idempotency_index_ready
+    if not _idempotency_index_ready:
+        sync_indexes("IdempotencyKeys")
+        _idempotency_index_ready = True
+
+
+def _replay(record):
+    response = make_response(bytes(record["body"]), record["status"])
+    response.mimetype = record["mimetype"]
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent_response(idempotency_key, f, *args, **kwargs):
+    """Run `f` at most once per Idempotency-Key and route, replaying the stored response on retries."""
+    record_id = f"{request.method} {request.path} {idempotency_key}"
+    fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+    record = _idempotency_cache_get(record_id)
+    if record is None:
+        _ensure_idempotency_index()
+        now = datetime.datetime.utcnow()
+        # One round trip either claims the key or returns whoever holds it
+        record = mongo.db.IdempotencyKeys.find_one_and_update(
+            {"_id": record_id},
+            {"$setOnInsert": {"state": "pending", "fingerprint": fingerprint, "createdAt": now}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if record and record["state"] == "pending":
+            stale = mongo.db.IdempotencyKeys.update_one(
+                {"_id": record_id, "state": "pending", "createdAt": {"$lt": now - IDEMPOTENCY_PENDING_TIMEOUT}},
+                {"$set": {"fingerprint": fingerprint, "createdAt": now}}
+            )
+            if stale.modified_count == 0:
+                return make_response(jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409)
+            record = None
+        elif record:
+            _idempotency_cache_put(record_id, record)
+
+    if record:
+        if record["fingerprint"] != fingerprint:
+            return make_response(jsonify({"error": "Idempotency-Key was already used with a different request body"}), 422)
+        return _replay(record)
+
+    try:
+        response = app.make_response(f(*args, **kwargs))
+    except Exception:
+        mongo.db.IdempotencyKeys.delete_one({"_id": record_id, "state": "pending"})
+        raise
+
+    if response.status_code >= 500:
+        # Let the device retry a server error for real
+        mongo.db.IdempotencyKeys.delete_one({"_id": record_id, "state": "pending"})
+        return response
+
+    record = {
+        "state": "done",
+        "fingerprint": fingerprint,
+        "status": response.status_code,
+        "mimetype": response.mimetype,
+        "body": response.get_data(),
+        "createdAt": datetime.datetime.utcnow()
+    }
+    mongo.db.IdempotencyKeys.update_one({"_id": record_id}, {"$set": record})
+    _idempotency_cache_put(record_id, record)
+    return response
+
+
+# ==========================================
+# LOGGING
+# ==========================================
+# app.logger hands records to a queue so request threads never block on the
+# log stream; formatting (including %-style args) happens on the listener
+# thread. Each request ends with one key=value summary line that handlers
+# enrich through log_fields(). INFO-and-below records can be sampled per
+# route, and the level and sample rates are stored in Settings so every
+# worker picks up a change made through /api/v1/admin/logging.
+
+LOG_SETTINGS_REFRESH_SECONDS = 30
+
+
+def _parse_sample_rates(value):
+    """Parse "route=rate,route=rate" into a dict."""
+    rates = {}
+    for part in (value or "").split(","):
+        route, _, rate = part.partition("=")
+        if route.strip() and rate.strip():
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+_log_settings = {
+    "level": os.getenv("LOG_LEVEL", "INFO").upper(),
+    "sampleRates": _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES"))
+}
+
+
+class StructuredFormatter(logging.Formatter):
+    """Append a record's `fields` dict as key=value pairs."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class RouteSampler(logging.Filter):
+    """Keep only a share of INFO-and-below records per route; warnings and errors always pass."""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        # Records logged outside a Flask request (asgi.py) name their route themselves
+        endpoint = getattr(record, "endpoint", None)
+        if endpoint is None:
+            if not has_request_context():
+                return True
+            endpoint = request.endpoint
+        rate = _log_settings["sampleRates"].get(endpoint, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+_log_queue = queue.SimpleQueue()
+_log_listener = None
+_log_listener_pid = None
+
+
+def start_log_listener():
+    """(Re)start the thread that writes queued records, e.g. after a fork."""
+    global _log_listener, _log_listener_pid
+    if _log_listener_pid == os.getpid():
+        return
+    stream = logging.StreamHandler()
+    stream.setFormatter(StructuredFormatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+    _log_listener = QueueListener(_log_queue, stream)
+    _log_listener.start()
+    _log_listener_pid = os.getpid()
+    atexit.register(_log_listener.stop)
+
+
+def apply_log_settings(settings):
+    if not isinstance(settings, dict):
+        raise ValueError("Logging settings must be an object")
+    level = str(settings.get("level", _log_settings["level"])).upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f"Unknown log level: {level}")
+    rates = settings.get("sampleRates") or {}
+    if not isinstance(rates, dict):
+        raise ValueError("sampleRates must be an object of route: rate")
+    rates = {route: float(rate) for route, rate in rates.items()}
+    if any(not 0 <= rate <= 1 for rate in rates.values()):
+        raise ValueError("Sample rates must be between 0 and 1")
+    _log_settings["level"] = level
+    _log_settings["sampleRates"] = rates
+    app.logger.setLevel(level)
+
+
+def log_settings_refresher():
+    """Background thread body: follow log settings changed by other workers."""
+    while True:
+        time.sleep(LOG_SETTINGS_REFRESH_SECONDS)
+        try:
+            settings = mongo.db.Settings.find_one({"_id": "logging"})
+            if settings:
+                apply_log_settings(settings)
+        except Exception as e:
+            app.logger.warning("Could not refresh log settings: %s", e)
+
+
+def log_fields(**fields):
+    """Add key=value pairs to this request's summary line."""
+    g.setdefault("log_fields", {}).update(fields)
+
+
+_log_handler = LazyQueueHandler(_log_queue)
+_log_handler.addFilter(RouteSampler())
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(_log_handler)
+apply_log_settings(_log_settings)
+start_log_listener()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def log_request_summary(response):
+    started = g.get("request_started")
+    if started is not None and app.logger.isEnabledFor(logging.INFO):
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            **g.get("log_fields", {})
+        }
+        app.logger.info("request", extra={"fields": fields})
+    return response
+
+
+@app.route("/api/v1/admin/logging", methods=["GET", "POST"])
+@require_api_key_strict
+def logging_settings():
+    """Read or change the log level and per-route sample rates for all workers.
+
+    POST body: { "level": "DEBUG", "sampleRates": {"complete_loot_upload_stacked_v2": 0.1} }
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            try:
+                apply_log_settings(data)
+            except (TypeError, ValueError) as e:
+                return make_response(jsonify({"error": str(e)}), 400)
+            mongo.db.Settings.update_one({"_id": "logging"}, {"$set": _log_settings}, upsert=True)
+
+        return jsonify(_log_settings), 200
+
+    except Exception as e:
+        app.logger.error("Error in logging_settings: %s", e)
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
+# ==========================================
+# RATE LIMITING
+# ==========================================
+# Token buckets per route and caller identity: the API key, the device
+# (X-Device-Id), the rfidUID (path, query or body) and the teacher id in the
+# path. A request takes one token from every bucket that applies, or none
+# when any is empty, in which case it is answered 429 with Retry-After
+# before the view (and so Mongo) is reached. Buckets live in a SQLite file
+# so all gunicorn workers on a host draw from the same ones; if it cannot
+# be used the request is let through.
+#
+# The limiter runs before the auth decorators, so it checks the API key and
+# signed teacher token itself: a claimed device, rfidUID or teacher id is
+# only charged once the caller has proven it may act for them. Everyone
+# else draws on a bucket for their address, and so can neither spend a
+# student's or teacher's tokens nor add rows by inventing identities.
+
+# identity kind -> (burst, refill per second). Every ESP32 shares one API
+# key, so that budget covers the whole fleet.
+RATE_LIMIT_DEFAULTS = {
+    "apiKey": (600, 100.0),
+    "device": (30, 5.0),
+    "rfidUID": (30, 5.0),
+    "teacher": (60, 10.0),
+    "address": (120, 20.0),
+}
+
+# endpoint -> the kinds whose default budget it replaces
+RATE_LIMIT_ROUTES = {
+    "add_5_coin": {"device": (10, 1.0), "rfidUID": (10, 1.0)},
+    "create_user_from_rfid": {"rfidUID": (5, 0.2)},
+    "purchase_item": {"rfidUID": (10, 1.0)},
+    "purchase_cart": {"rfidUID": (10, 1.0)},
+    "use_travel_item": {"rfidUID": (10, 1.0)},
+    "use_seize_power": {"rfidUID": (5, 0.5)},
+    "refresh_now": {"rfidUID": (5, 0.5)},
+    "get_class_students": {"teacher": (10, 1.0)},
+    "get_teacher_classes": {"teacher": (10, 1.0)},
+    "teacher_award_coins": {"teacher": (30, 2.0)},
+    "stream_refresh_events": {"apiKey": (60, 1.0)},
+    "stream_live_roster": {"apiKey": (60, 1.0)},
+}
+
+# Idle buckets refill to full long before this; dropping them loses nothing
+RATE_LIMIT_IDLE_SECONDS = 60 * 60
+
+_rate_limit_local = threading.local()
+
+
+def _rate_limit_db():
+    """This thread's connection to the bucket store."""
+    conn = getattr(_rate_limit_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(app.config["RATE_LIMIT_PATH"], timeout=1, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Buckets are disposable; a crash forgetting the last few spends is fine
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        _rate_limit_local.conn = conn
+    return conn
+
+
+def caller_identities(address, api_key=None, device=None, rfid_uid=None, teacher_id=None, teacher_verified=False):
+    """(kind, value) pairs to charge for a caller.
+
+    The device and rfidUID count only with a valid API key, the teacher id
+    only when `teacher_verified`; a caller with neither is charged by address.
+    """
+    key_valid = api_key_error(api_key, strict=True) is None
+    if not key_valid and not teacher_verified:
+        return [("address", address or "unknown")]
+    identities = []
+    if key_valid:
+        # Never store the key itself
+        identities.append(("apiKey", hashlib.sha256(api_key.encode()).hexdigest()[:16]))
+        if device:
+            identities.append(("device", device))
+    if rfid_uid:
+        identities.append(("rfidUID", rfid_uid))
+    if teacher_verified:
+        identities.append(("teacher", teacher_id))
+    return identities
+
+
+def rate_limit_identities():
+    """(kind, value) pairs identifying the caller of this request."""
+    view_args = request.view_args or {}
+    rfid_uid = view_args.get("rfidUID") or request.args.get("rfidUID")
+    if not rfid_uid and request.method == "POST":
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and isinstance(body.get("rfidUID"), str):
+            rfid_uid = body["rfidUID"]
+    # Legacy teacher tokens need a Mongo lookup to check, so they are charged by address
+    teacher_id = view_args.get("teacher_id")
+    token = request_teacher_token()
+    payload = verify_teacher_token(token) if teacher_id and token else None
+    return caller_identities(
+        request.remote_addr, request.headers.get("X-API-Key"), request.headers.get("X-Device-Id"), rfid_uid,
+        teacher_id, teacher_verified=bool(payload) and payload.get("sub") == teacher_id
+    )
+
+
+def rate_limit_buckets(endpoint, identities):
+    """(key, burst, rate) for each bucket a request to `endpoint` draws on."""
+    budgets = {**RATE_LIMIT_DEFAULTS, **RATE_LIMIT_ROUTES.get(endpoint, {})}
+    return [(f"{endpoint}:{kind}:{value}", *budgets[kind]) for kind, value in identities]
+
+
+def take_tokens(buckets, now=None):
+    """Spend one token from each (key, burst, rate) bucket, all or nothing.
+
+    Returns 0 when admitted, otherwise the seconds until every bucket has a token.
+    """
+    now = time.time() if now is None else now
+    conn = _rate_limit_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        placeholders = ",".join("?" * len(buckets))
+        stored = dict((key, (tokens, updated_at)) for key, tokens, updated_at in conn.execute(
+            f"SELECT key, tokens, updated_at FROM buckets WHERE key IN ({placeholders})",
+            [key for key, _, _ in buckets]
+        ))
+        levels = []
+        wait = 0.0
+        for key, burst, rate in buckets:
+            tokens, updated_at = stored.get(key, (burst, now))
+            tokens = min(burst, tokens + max(now - updated_at, 0) * rate)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+            levels.append((key, tokens - 1))
+        if wait:
+            conn.execute("ROLLBACK")
+            return wait
+        conn.executemany(
+            "INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+            [(key, tokens, now) for key, tokens in levels]
+        )
+        if random.random() < 0.001:
+            conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - RATE_LIMIT_IDLE_SECONDS,))
+        conn.execute("COMMIT")
+        return 0
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+@app.before_request
+def admit_request():
+    if not app.config["RATE_LIMIT"] or request.method == "OPTIONS" or request.endpoint in (None, "static"):
+        return None
+    buckets = rate_limit_buckets(request.endpoint, rate_limit_identities())
+    if not buckets:
+        return None
+    try:
+        wait = take_tokens(buckets)
+    except Exception as e:
+        app.logger.warning("Rate limiter unavailable, admitting request: %s", e)
+        return None
+    if not wait:
+        return None
+    retry_after = max(1, math.ceil(wait))
+    log_fields(throttled=1)
+    response = make_response(jsonify({"error": "Too many requests", "retryAfter": retry_after}), 429)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+# ==========================================
+# POST-IMAGE RESPONSES
+# ==========================================
+# Write endpoints use find_one_and_update and echo the updated slice of the
+# user under "user", so a device can redraw without a follow-up GET. Each
+# endpoint has a default slice (coins, mainCreature and the stacks it
+# touched); ?fields=a,b picks other fields from USER_FIELDS instead.
+
+# Fields a write response may echo back; password and _id never leave the server
+USER_FIELDS = (
+    "name", "rfidUID", "playerClass", "coins", "mainCreature", "creatures", "artifacts", "loot",
+    "challengeCodes", "purchasedItems", "currentLocation", "character", "gender", "lordOf"
+)
+
+
+def stack_names(items):
+    return [item["name"] for item in items or [] if isinstance(item, dict) and item.get("name")]
+
+
+def unknown_fields_error(fields, allowed=USER_FIELDS):
+    """The 400 message for ?fields= names outside `allowed`, or None. Shared with asgi.py."""
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        return f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}"
+    return None
+
+
+def requested_fields(requested):
+    return [field.strip() for field in requested.split(",") if field.strip()]
+
+
+def validate_write_fields(f):
+    """Reject a write whose ?fields= names an unknown field, as reads do, before it runs."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        requested = request.args.get("fields")
+        error = unknown_fields_error(requested_fields(requested)) if requested is not None else None
+        if error:
+            return make_response(jsonify({"error": error}), 400)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def post_image_projection(default, creatures=(), loot=(), pushed=(), requested=None):
+    """Projection for a write's post-image plus the stack names to trim it to.
+
+    Unless ?fields= overrides the defaults, creature and loot stacks are
+    limited to the names the write touched: by key in the keyed layout, with
+    $elemMatch for a single array stack, or by trimming in user_slice().
+    Arrays listed in `pushed` only return the entry the write appended.
+    Outside a Flask request pass the ?fields= value as `requested`. Unknown
+    field names raise ValueError; validate_write_fields() turns that into a 400
+    before the view runs.
+    """
+    if requested is None and has_request_context():
+        requested = request.args.get("fields")
+    if requested is None:
+        fields = default
+        changed = {"creatures": list(dict.fromkeys(creatures)), "loot": list(dict.fromkeys(loot))}
+    else:
+        fields = list(dict.fromkeys(requested_fields(requested)))
+        error = unknown_fields_error(fields)
+        if error:
+            raise ValueError(error)
+        changed = {}
+
+    projection = {"_id": 0, "rfidUID": 1}
+    for field in fields:
+        names = changed.get(field)
+        if field in pushed and requested is None:
+            projection[field] = {"$slice": -1}
+        elif names == []:
+            # Default slice and this write left these stacks alone
+            continue
+        elif names and keyed_inventory():
+            for name in names:
+                projection[inventory_path(field, name)] = 1
+        elif names and len(names) == 1:
+            projection[field] = {"$elemMatch": {"name": names[0]}}
+        else:
+            projection[field] = 1
+    return inventory_projection(projection), changed
+
+
+def user_slice(user, changed=None):
+    """Shape a post-image for a write response."""
+    user = inventory_to_arrays(user)
+    for kind, names in (changed or {}).items():
+        if names and isinstance(user.get(kind), list):
+            user[kind] = [stack for stack in user[kind] if stack.get("name") in names]
+    return user
+
+
+def update_user(rfid_uid, update, projection, query=None, **kwargs):
+    """Apply `update` to the user with this rfidUID in one round trip.
+
+    Returns the post-image limited to `projection`, or None when no user
+    matched. The user's version counter is incremented by the same write and
+    the class's is queued for the version flusher; the leaderboard entry is
+    refreshed when the update touches coins.
+    """
+    update = with_user_version(update)
+    if touches_coins(update):
+        update = with_leaderboard_version(update)
+    internal = write_tracked_fields(update, projection)
+    updated_user = mongo.db.Users.find_one_and_update(
+        {"rfidUID": rfid_uid, **(query or {})},
+        update,
+        projection={**projection, **dict.fromkeys(internal, 1)},
+        return_document=ReturnDocument.AFTER,
+        **kwargs
+    )
+    if updated_user:
+        user = {**updated_user, "rfidUID": rfid_uid}
+        for field in internal:
+            updated_user.pop(field, None)
+        queue_version_bumps(user.get("playerClass"))
+        if touches_coins(update):
+            update_leaderboard(user)
+    return updated_user
+
+
+def write_tracked_fields(update, projection):
+    """Fields update_user() adds to a projection so versions and the leaderboard need no extra read."""
+    tracked = ("playerClass", "name", "coins", LEADERBOARD_VERSION_FIELD) if touches_coins(update) else ("playerClass",)
+    return [field for field in tracked if field not in projection]
+
+
+def touches_coins(update):
+    """Whether an update document or pipeline writes the coins field."""
+    stages = update if isinstance(update, list) else [update]
+    return any("coins" in fields for stage in stages for fields in stage.values() if isinstance(fields, dict))
+
+
+# ==========================================
+# SPARSE FIELDSETS
+# ==========================================
+# User reads accept ?fields=a,b (checked against the endpoint's allow-list)
+# or ?profile=<name> for one of FIELD_PROFILES. Without either, each
+# endpoint keeps its existing response.
+
+FIELD_PROFILES = {
+    "esp32-min": ("rfidUID", "name", "coins", "mainCreature"),
+    "dashboard": (
+        "rfidUID", "name", "playerClass", "coins", "mainCreature", "creatures", "artifacts", "loot",
+        "currentLocation", "lordOf"
+    ),
+    "full": USER_FIELDS,
+}
+
+
+def selected_fields(allowed=USER_FIELDS):
+    """Fields picked by ?fields= or ?profile=, or None when the client asked for neither.
+
+    Raises ValueError with a client-facing message for unknown fields or profiles.
+    """
+    requested = request.args.get("fields")
+    profile = request.args.get("profile")
+    if requested is not None:
+        fields = requested_fields(requested)
+        error = unknown_fields_error(fields, allowed)
+        if error:
+            raise ValueError(error)
+        return list(dict.fromkeys(fields))
+    if profile is not None:
+        if profile not in FIELD_PROFILES:
+            raise ValueError(f"Unknown profile: {profile}. Allowed: {', '.join(FIELD_PROFILES)}")
+        # Profiles are trimmed to what the endpoint can return rather than rejected
+        return [field for field in FIELD_PROFILES[profile] if field in allowed]
+    return None
+
+
+# get_class_students summary key -> the user field it is derived from
+STUDENT_SUMMARY_SOURCES = {
+    "name": "name", "coins": "coins", "mainPet": "mainCreature", "schoolClass": "playerClass",
+    "totalCreatures": "creatures", "totalArtifacts": "artifacts", "rfidUID": "rfidUID"
+}
+
+
+def fields_projection(fields):
+    return inventory_projection({"_id": 0, **dict.fromkeys(fields, 1)})
+
+
+# ==========================================
+# VERSIONS AND CONDITIONAL GETS
+# ==========================================
+# A user's version is a counter on the user document (USER_VERSION_FIELD)
+# that update_user() increments in the same write, so a profile ETag changes
+# together with the data at no extra round trip. Classes and the list of
+# classes keep counters in the Versions collection. Class bumps from device
+# writes are queued and written by a per-process flusher thread in one
+# bulk_write every VERSION_FLUSH_SECONDS, keeping them off the request path;
+# for that long after a write a class roster may still answer 304. Roster
+# and profile reads derive a strong ETag from these counters, so
+# If-None-Match is answered with a 304 after one small read.
+
+USER_VERSION_FIELD = "etagVersion"
+
+
+def with_user_version(update):
+    """Add the user version increment to an update document or pipeline."""
+    return with_summary(update, {USER_VERSION_FIELD: 1})
+
+
+def user_version(rfid_uid):
+    """The user's version counter, 0 for users not written since it was added."""
+    user = mongo.db.Users.find_one({"rfidUID": rfid_uid}, {"_id": 0, USER_VERSION_FIELD: 1})
+    return (user or {}).get(USER_VERSION_FIELD, 0)
+
+
+def class_version_id(player_class):
+    return f"class:{player_class}"
+
+
+CLASS_LIST_VERSION_ID = "classes"
+
+
+def invalidated_version_ids(*player_classes, class_list=False):
+    """Ids of the Versions counters a write to these classes invalidates."""
+    ids = [class_version_id(player_class) for player_class in dict.fromkeys(player_classes) if player_class]
+    if class_list:
+        ids.append(CLASS_LIST_VERSION_ID)
+    return ids
+
+
+def version_bumps(ids):
+    return [UpdateOne({"_id": version_id}, {"$inc": {"v": 1}}, upsert=True) for version_id in ids]
+
+
+def bump_versions(*player_classes, class_list=False):
+    """Increment the class (and class list) counters now."""
+    ids = invalidated_version_ids(*player_classes, class_list=class_list)
+    if not ids:
+        return
+    try:
+        mongo.db.Versions.bulk_write(version_bumps(ids), ordered=False)
+    except Exception as e:
+        # The write itself succeeded; failing the request would only invite a retry
+        app.logger.error(f"Failed to bump versions {ids}: {str(e)}")
+
+
+_pending_versions = set()
+_pending_versions_lock = threading.Lock()
+_version_wakeup = threading.Event()
+_version_flusher_pid = None
+
+
+def queue_version_bumps(*player_classes):
+    """Leave the class counter bumps to the version flusher.
+
+    Bumps them inline where this process has no flusher (CLI commands,
+    requests before start_background_tasks).
+    """
+    if _version_flusher_pid != os.getpid():
+        bump_versions(*player_classes)
+        return
+    with _pending_versions_lock:
+        _pending_versions.update(invalidated_version_ids(*player_classes))
+    _version_wakeup.set()
+
+
+def flush_versions():
+    """Write the queued bumps; on failure they stay queued for the next flush."""
+    with _pending_versions_lock:
+        ids = list(_pending_versions)
+        _pending_versions.clear()
+    if not ids:
+        return True
+    try:
+        mongo.db.Versions.bulk_write(version_bumps(ids), ordered=False)
+        return True
+    except Exception as e:
+        app.logger.error(f"Failed to bump versions {ids}: {str(e)}")
+        with _pending_versions_lock:
+            _pending_versions.update(ids)
+        return False
+
+
+def version_flusher():
+    """Background thread body: one bulk_write per VERSION_FLUSH_SECONDS for the writes queued in it."""
+    while True:
+        _version_wakeup.wait()
+        # Let the rest of a burst queue up behind the first write
+        time.sleep(app.config["VERSION_FLUSH_SECONDS"])
+        _version_wakeup.clear()
+        if not flush_versions():
+            time.sleep(1)
+            _version_wakeup.set()
+
+
+def start_version_flusher():
+    global _version_flusher_pid
+    threading.Thread(target=version_flusher, name="version-flusher", daemon=True).start()
+    _version_flusher_pid = os.getpid()
+    atexit.register(flush_versions)
+
+
+def read_versions(*version_ids):
+    """Current value of each counter, 0 for ones never bumped."""
+    found = {doc["_id"]: doc.get("v", 0) for doc in mongo.db.Versions.find({"_id": {"$in": list(version_ids)}})}
+    return [found.get(version_id, 0) for version_id in version_ids]
+
+
+def version_etag(*versions):
+    """Strong ETag for this request's representation at the given counter values."""
+    tag = json.dumps([request.full_path, negotiated_mimetype(), versions], default=str)
+    return hashlib.sha1(tag.encode()).hexdigest()
+
+
+def not_modified(etag):
+    """A 304 response if the client already holds `etag` in any encoding, else None."""
+    for tag in [etag] + [f"{etag}-{encoding}" for encoding in compressed_etag_suffixes()]:
+        if request.if_none_match.contains(tag):
+            response = make_response("", 304)
+            response.set_etag(tag)
+            return response
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+# ==========================================
+# LEADERBOARDS
+# ==========================================
+# The Leaderboard collection holds one small entry per user (name, class,
+# school, coins), refreshed by update_user() whenever a write touches coins.
+# Top-N lists and ranks are answered from its (scope, coins) indexes: top-N
+# is a bounded index walk and a rank counts index keys above the user's
+# coins, so neither reads Users.
+#
+# Writes that refresh an entry also $inc the user's LEADERBOARD_VERSION_FIELD
+# and the entry stores the value as "v". An upsert only replaces an entry
+# with a lower v, so when two coin writes race, the older post-image can
+# never overwrite the newer one; its upsert then fails on the unique _id
+# and is dropped.
+
+LEADERBOARD_SCOPES = ("class", "school", "global")
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_VERSION_FIELD = "leaderboardVersion"
+
+_leaderboard_index_ready = False
+
+
+def class_school(player_class):
+    """School part of a "School / Class" playerClass."""
+    return (player_class or "").split(" / ")[0] or None
+
+
+def _ensure_leaderboard_indexes():
+    global _leaderboard_index_ready
+    if not _leaderboard_index_ready:
+        sync_indexes("Leaderboard")
+        _leaderboard_index_ready = True
+
+
+def leaderboard_entry(user):
+    return {
+        "name": user.get("name"),
+        "playerClass": user.get("playerClass"),
+        "school": class_school(user.get("playerClass")),
+        "coins": user.get("coins", 0),
+    }
+
+
+def with_leaderboard_version(update):
+    """Add the leaderboard version increment to an update document or pipeline."""
+    return with_summary(update, {LEADERBOARD_VERSION_FIELD: 1})
+
+
+def leaderboard_write(user, replace_equal=False):
+    """(filter, update) for upserting a user's entry unless a newer write already has.
+
+    `user` needs rfidUID, name, playerClass, coins and LEADERBOARD_VERSION_FIELD
+    as they were after its write. Entries written before versions existed have no v.
+    """
+    version = user.get(LEADERBOARD_VERSION_FIELD, 0)
+    return (
+        {"_id": user["rfidUID"], "$or": [{"v": {"$lte" if replace_equal else "$lt": version}}, {"v": {"$exists": False}}]},
+        {"$set": {**leaderboard_entry(user), "v": version}}
+    )
+
+
+def update_leaderboard(user):
+    """Upsert the leaderboard entry for a post-image; see leaderboard_write()."""
+    try:
+        _ensure_leaderboard_indexes()
+        mongo.db.Leaderboard.update_one(*leaderboard_write(user), upsert=True)
+    except DuplicateKeyError:
+        # A write with a newer version got there first
+        pass
+    except Exception as e:
+        # The coin write itself succeeded; the next one or a rebuild repairs the entry
+        app.logger.error(f"Failed to update leaderboard for {user.get('rfidUID')}: {str(e)}")
+
+
+def rebuild_leaderboard(batch_size=500):
+    """Rewrite every leaderboard entry from Users. Returns how many were written.
+
+    Entries are replaced at the same version too, but never rolled back past
+    a coin write that lands while the rebuild runs.
+    """
+    _ensure_leaderboard_indexes()
+    written = 0
+    batch = []
+    projection = {"rfidUID": 1, "name": 1, "playerClass": 1, "coins": 1, LEADERBOARD_VERSION_FIELD: 1}
+    for user in mongo.db.Users.find({"rfidUID": {"$exists": True}}, projection):
+        batch.append(UpdateOne(*leaderboard_write(user, replace_equal=True), upsert=True))
+        if len(batch) >= batch_size:
+            written += _write_leaderboard_batch(batch)
+            batch = []
+    if batch:
+        written += _write_leaderboard_batch(batch)
+    return written
+
+
+def _write_leaderboard_batch(batch):
+    try:
+        mongo.db.Leaderboard.bulk_write(batch, ordered=False)
+        return len(batch)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        # Duplicate keys are entries a newer coin write refreshed meanwhile
+        return len(batch) - len(errors)
+
+
+def leaderboard_backfill():
+    """Background thread body: build the leaderboard once if it has never been built."""
+    try:
+        if mongo.db.Leaderboard.estimated_document_count() == 0:
+            app.logger.info(f"Leaderboard backfill finished: {rebuild_leaderboard()} entries")
+    except Exception as e:
+        app.logger.error(f"Leaderboard backfill failed: {str(e)}")
+
+
+def leaderboard_scope_filter(scope, player_class=None, school=None):
+    """Leaderboard query for a scope, or None when the scope's key is missing."""
+    if scope == "class":
+        return {"playerClass": player_class} if player_class else None
+    if scope == "school":
+        return {"school": school} if school else None
+    return {}
+
+
+leaderboard_cli = AppGroup("leaderboard", help="Leaderboard maintenance.")
+
+
+@leaderboard_cli.command("rebuild")
+def leaderboard_rebuild_command():
+    """Rewrite every leaderboard entry from Users."""
+    click.echo(f"Wrote {rebuild_leaderboard()} leaderboard entries")
+
+
+app.cli.add_command(leaderboard_cli)
+
+
+# ==========================================
+# CLASS REGISTRY
+# ==========================================
+# The Classes collection holds one entry per playerClass with its school and
+# member count. create_user_from_rfid and set_class keep the counts current,
+# so class pickers read a handful of small documents instead of grouping
+# every user. Classes whose count drops to zero are kept but not listed.
+#
+# Users and Classes also carry a `school` derived from playerClass by
+# class_school(), indexed with the class name, so teacher lookups are exact
+# equality matches rather than prefix regexes over playerClass.
+
+_school_indexes_ready = False
+
+
+def _ensure_school_indexes():
+    global _school_indexes_ready
+    if not _school_indexes_ready:
+        create_declared_index(declared_index("Users", "school", "playerClass"))
+        sync_indexes("Classes")
+        _school_indexes_ready = True
+
+
+def register_class_members(player_class, delta):
+    """Add delta to a class's member count, creating the entry if needed."""
+    if not player_class:
+        return
+    try:
+        mongo.db.Classes.update_one(
+            {"_id": player_class},
+            {"$inc": {"members": delta}, "$set": {"school": class_school(player_class)}},
+            upsert=True,
+        )
+    except Exception as e:
+        # The user write itself succeeded; a rebuild repairs the count
+        app.logger.error(f"Failed to update class registry for {player_class}: {str(e)}")
+
+
+def listed_classes(query=None):
+    """Names of registered classes with members, sorted."""
+    cursor = mongo.db.Classes.find({**(query or {}), "members": {"$gt": 0}}, {"_id": 1}).sort("_id", 1)
+    return [entry["_id"] for entry in cursor]
+
+
+def rebuild_classes():
+    """Recount every class from Users. Returns how many classes have members.
+
+    Like rebuild_leaderboard, a class change racing the rebuild may be
+    counted with the value read here until the next rebuild.
+    """
+    counts = list(mongo.db.Users.aggregate([
+        {"$match": {"playerClass": {"$nin": [None, ""]}}},
+        {"$group": {"_id": "$playerClass", "members": {"$sum": 1}}},
+    ]))
+    if counts:
+        mongo.db.Classes.bulk_write([
+            UpdateOne({"_id": entry["_id"]},
+                      {"$set": {"members": entry["members"], "school": class_school(entry["_id"])}},
+                      upsert=True)
+            for entry in counts
+        ], ordered=False)
+    mongo.db.Classes.update_many({"_id": {"$nin": [entry["_id"] for entry in counts]}}, {"$set": {"members": 0}})
+    # Class-list ETags derive from this counter alone, so lists cached before the rebuild must go stale
+    bump_versions(class_list=True)
+    return len(counts)
+
+
+def backfill_user_schools(batch_size=500):
+    """Set `school` on users that predate it. Returns how many were updated.
+
+    Each write is conditional on the playerClass read here, so a class change
+    racing the backfill (which sets its own school) is never overwritten.
+    """
+    updated = 0
+    batch = []
+    for user in mongo.db.Users.find({"school": {"$exists": False}}, {"playerClass": 1}):
+        batch.append(UpdateOne(
+            {"_id": user["_id"], "playerClass": user.get("playerClass"), "school": {"$exists": False}},
+            {"$set": {"school": class_school(user.get("playerClass"))}}
+        ))
+        if len(batch) >= batch_size:
+            updated += mongo.db.Users.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += mongo.db.Users.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def classes_backfill():
+    """Background thread body: create the school indexes, then fill in what older data lacks."""
+    try:
+        _ensure_school_indexes()
+        if mongo.db.Classes.estimated_document_count() == 0:
+            app.logger.info(f"Class registry backfill finished: {rebuild_classes()} classes")
+        updated = backfill_user_schools()
+        if updated:
+            app.logger.info(f"School backfill finished: {updated} users")
+    except Exception as e:
+        app.logger.error(f"Class registry backfill failed: {str(e)}")
+
+
+classes_cli = AppGroup("classes", help="Class registry maintenance.")
+
+
+@classes_cli.command("rebuild")
+def classes_rebuild_command():
+    """Recount every class in the registry from Users."""
+    click.echo(f"Registered {rebuild_classes()} classes with members")
+
+
+@classes_cli.command("backfill-schools")
+def classes_backfill_schools_command():
+    """Create the school indexes and set `school` on users that lack it."""
+    _ensure_school_indexes()
+    click.echo(f"Set school on {backfill_user_schools()} users")
+
+
+app.cli.add_command(classes_cli)
+
+
+@app.route("/api/v1/leaderboard", methods=["GET"])
+@require_api_key_optional
+def get_leaderboard():
+    """Top-N users by coins for a class (?playerClass=), a school (?school=) or everyone."""
+    try:
+        player_class = request.args.get("playerClass")
+        school = request.args.get("school")
+        scope = "class" if player_class else "school" if school else "global"
+        try:
+            limit = min(max(int(request.args.get("limit", 10)), 1), LEADERBOARD_MAX_LIMIT)
+        except ValueError:
+            return make_response(jsonify({"error": "limit must be an integer"}), 400)
+
+        _ensure_leaderboard_indexes()
+        entries = mongo.db.Leaderboard.find(
+            leaderboard_scope_filter(scope, player_class, school),
+            {"name": 1, "playerClass": 1, "coins": 1}
+        ).sort([("coins", -1), ("_id", 1)]).limit(limit)
+
+        leaders = []
+        previous_coins, rank = None, 0
+        for position, entry in enumerate(entries, start=1):
+            # Ties share a rank, matching /leaderboard/rank
+            if entry.get("coins") != previous_coins:
+                previous_coins, rank = entry.get("coins"), position
+            leaders.append({
+                "rank": rank,
+                "rfidUID": entry["_id"],
+                "name": entry.get("name"),
+                "playerClass": entry.get("playerClass"),
+                "coins": entry.get("coins", 0)
+            })
+
+        return jsonify({"scope": scope, "leaders": leaders}), 200
+
+    except Exception as e:
+        app.logger.error(f"Error getting leaderboard: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
+@app.route("/api/v1/leaderboard/rank/<rfidUID>", methods=["GET"])
+@require_api_key_optional
+def get_leaderboard_rank(rfidUID):
+    """Rank of one user by coins within their class, school (?scope=school) or everyone (?scope=global)."""
+    try:
+        scope = request.args.get("scope", "class")
+        if scope not in LEADERBOARD_SCOPES:
+            return make_response(jsonify({"error": f"scope must be one of {', '.join(LEADERBOARD_SCOPES)}"}), 400)
+
+        _ensure_leaderboard_indexes()
+        entry = mongo.db.Leaderboard.find_one({"_id": rfidUID})
+        if not entry:
+            return make_response(jsonify({"error": "No leaderboard entry for given rfidUID"}), 404)
+
+        query = leaderboard_scope_filter(scope, entry.get("playerClass"), entry.get("school"))
+        if query is None:
+            return make_response(jsonify({"error": f"User has no {scope}"}), 404)
+
+        coins = entry.get("coins", 0)
+        # Both counts are answered from the (scope, coins) index
+        ahead = mongo.db.Leaderboard.count_documents({**query, "coins": {"$gt": coins}})
+        total = mongo.db.Leaderboard.count_documents(query)
+
+        return jsonify({
+            "rfidUID": rfidUID,
+            "scope": scope,
+            "playerClass": entry.get("playerClass"),
+            "school": entry.get("school"),
+            "coins": coins,
+            "rank": ahead + 1,
+            "total": total
+        }), 200
+
+    except Exception as e:
+        app.logger.error(f"Error getting leaderboard rank: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
+# ==========================================
+# SUMMARY COUNTERS
+# ==========================================
+# Each user carries a `summary` subdocument with totals a device would
+# otherwise compute from the full arrays: creatures and loot by stack count,
+# artifacts, challenge codes and purchased items by name. Write paths add
+# their deltas to the same update via with_summary(). A summary is only
+# trusted once `built` is set by a full recount; writes that cannot tell
+# their delta mark it unbuilt, and /summary recounts it on the next read.
+
+def stack_total(entries):
+    """Sum of stack counts; entries without a usable count count as 1."""
+    total = 0
+    for entry in entries or []:
+        count = entry.get("count", 1) if isinstance(entry, dict) else 1
+        total += count if isinstance(count, int) else 1
+    return total
+
+
+def purchased_item_name(entry):
+    return entry.get("itemName") if isinstance(entry, dict) else entry
+
+
+def compute_summary(user):
+    """Full recount of the summary for a user document in either inventory layout."""
+    user = inventory_to_arrays(dict(user))
+    items = {}
+    for entry in user.get("purchasedItems") or []:
+        name = purchased_item_name(entry)
+        if name:
+            items[inventory_key(name)] = items.get(inventory_key(name), 0) + 1
+    return {
+        "built": True,
+        "creatures": stack_total(user.get("creatures")),
+        "loot": stack_total(user.get("loot")),
+        "artifacts": len(user.get("artifacts") or []),
+        "challengeCodes": len(user.get("challengeCodes") or []),
+        "items": items,
+    }
+
+
+def summary_inc(creatures=0, loot=0, artifacts=0, challenge_codes=0, items=None):
+    """Counter deltas as a $inc document; `items` maps item names to deltas."""
+    deltas = {
+        "summary.creatures": creatures,
+        "summary.loot": loot,
+        "summary.artifacts": artifacts,
+        "summary.challengeCodes": challenge_codes,
+    }
+    for name, delta in (items or {}).items():
+        deltas[f"summary.items.{inventory_key(name)}"] = delta
+    return {path: delta for path, delta in deltas.items() if delta}
+
+
+def with_summary(update, inc):
+    """Add summary counter deltas to an update document or pipeline."""
+    if not inc:
+        return update
+    if isinstance(update, list):
+        # Pipelines cannot $inc; add the delta to the current value in a final stage
+        return update + [{"$set": {
+            path: {"$add": [{"$ifNull": [f"${path}", 0]}, delta]} for path, delta in inc.items()
+        }}]
+    return {**update, "$inc": {**update.get("$inc", {}), **inc}}
+
+
+STALE_SUMMARY = {"summary.built": False}
+
+
+def rebuild_summary(rfid_uid):
+    """Recount and store one user's summary. Returns it, or None when there is no such user.
+
+    The write is conditional on the counted fields being unchanged since they
+    were read; after a lost race the fresh count is still returned and the
+    next read tries again.
+    """
+    fields = ("creatures", "loot", "inventory", "artifacts", "challengeCodes", "purchasedItems")
+    user = mongo.db.Users.find_one({"rfidUID": rfid_uid}, dict.fromkeys(fields, 1))
+    if not user:
+        return None
+    summary = compute_summary(user)
+    mongo.db.Users.update_one(
+        {"_id": user["_id"], **{field: user.get(field) for field in fields}},
+        {"$set": {"summary": summary}}
+    )
+    return summary
+
+
+@app.route("/api/v1/users/<rfidUID>/summary", methods=["GET"])
+@require_api_key_optional
+def get_user_summary(rfidUID):
+    """Fixed-size profile for devices: identity, coins and precomputed totals."""
+    try:
+        etag = version_etag(USER_VERSION_FIELD, user_version(rfidUID))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        user = mongo.db.Users.find_one(
+            {"rfidUID": rfidUID},
+            {"_id": 0, "name": 1, "coins": 1, "mainCreature": 1, "currentLocation": 1, "summary": 1}
+        )
+        if not user:
+            return make_response(jsonify({"error": "No user found for the given rfidUID"}), 404)
+
+        summary = user.get("summary") or {}
+        if not summary.get("built"):
+            summary = rebuild_summary(rfidUID) or compute_summary({})
+
+        return with_etag(jsonify({
+            "rfidUID": rfidUID,
+            "name": user.get("name"),
+            "coins": user.get("coins", 0),
+            "mainCreature": user.get("mainCreature"),
+            "currentLocation": user.get("currentLocation"),
+            "totalCreatures": summary.get("creatures", 0),
+            "totalLoot": summary.get("loot", 0),
+            "totalArtifacts": summary.get("artifacts", 0),
+            "totalChallengeCodes": summary.get("challengeCodes", 0),
+            "items": {inventory_unkey(key): count for key, count in (summary.get("items") or {}).items() if count > 0}
+        }), etag), 200
+
+    except Exception as e:
+        app.logger.error(f"Error getting user summary: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
+# ==========================================
+# CLASS ROSTER CACHE
+# ==========================================
+# Dashboards poll whole classes every few seconds. Rosters are cached per
+# playerClass and dropped by a change stream on Users whenever a member
+# changes. Standalone servers have no change streams, so there (and while
+# the stream is reconnecting) an entry is only served for ROSTER_POLL_SECONDS.
+
+# Union of the fields the class roster endpoints return
+ROSTER_FIELDS = (
+    "name", "playerClass", "coins", "mainCreature", "creatures", "artifacts", "loot", "rfidUID",
+    "purchasedItems", "currentLocation", "character", "gender", "lordOf"
+)
+
+# Non-replica-set servers reject $changeStream with this code
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+_roster_cache = {}    # playerClass -> (loaded_at, class version, users)
+_roster_members = {}  # user _id -> playerClass it was last cached under
+_roster_generation = {}
+_roster_lock = threading.Lock()
+_roster_stream_live = threading.Event()
+
+
+def class_roster(player_class, version=None):
+    """All users in `player_class` with ROSTER_FIELDS, served from the cache when fresh.
+
+    `version` is the class version the caller read before asking; an entry
+    loaded at another version is reloaded, so a roster is never tagged with
+    a newer version than its data. The returned list is shared with the
+    cache; callers must not modify it.
+    """
+    if app.config["ROSTER_CACHE"]:
+        with _roster_lock:
+            entry = _roster_cache.get(player_class)
+            generation = _roster_generation.get(player_class, 0)
+        if entry and (version is None or entry[1] == version) and (
+                _roster_stream_live.is_set()
+                or time.monotonic() - entry[0] < app.config["ROSTER_POLL_SECONDS"]):
+            return entry[2]
+
+    loaded_at = time.monotonic()
+    projection = inventory_projection({field: 1 for field in ROSTER_FIELDS})
+    users, member_ids = [], []
+    # Users the school backfill has not reached yet have no school
+    query = {"school": {"$in": [class_school(player_class), None]}, "playerClass": player_class}
+    for user in mongo.db.Users.find(query, projection):
+        member_ids.append(user.pop("_id"))
+        users.append(inventory_to_arrays(user))
+
+    if app.config["ROSTER_CACHE"]:
+        with _roster_lock:
+            # A change that arrived while we were reading makes this result stale
+            if _roster_generation.get(player_class, 0) == generation:
+                _roster_cache[player_class] = (loaded_at, version, users)
+                _roster_members.update(dict.fromkeys(member_ids, player_class))
+    return users
+
+
+def invalidate_roster(*player_classes):
+    """Drop cached rosters; with no arguments, drop them all."""
+    with _roster_lock:
+        if not player_classes:
+            player_classes = list(_roster_cache)
+            _roster_members.clear()
+        for player_class in player_classes:
+            _roster_cache.pop(player_class, None)
+            _roster_generation[player_class] = _roster_generation.get(player_class, 0) + 1
+
+
+def invalidate_roster_change(change):
+    """Drop the rosters a Users change-stream event can affect."""
+    if change.get("operationType") not in ("insert", "update", "replace", "delete"):
+        # drop, rename or invalidate: nothing cached can be trusted
+        invalidate_roster()
+        return
+    classes = set()
+    player_class = (change.get("fullDocument") or {}).get("playerClass")
+    if player_class:
+        classes.add(player_class)
+    # The class the user was cached under covers class changes and deletes
+    with _roster_lock:
+        previous_class = _roster_members.get((change.get("documentKey") or {}).get("_id"))
+    if previous_class:
+        classes.add(previous_class)
+    if classes:
+        invalidate_roster(*classes)
+
+
+_roster_watcher_lock = threading.Lock()
+_roster_watcher_started = False
+
+
+def ensure_roster_watcher():
+    """Start roster_watcher once per process; both the cache and live rosters follow it."""
+    global _roster_watcher_started
+    if _roster_watcher_started:
+        return
+    with _roster_watcher_lock:
+        if not _roster_watcher_started:
+            _roster_watcher_started = True
+            threading.Thread(target=roster_watcher, name="roster-watcher", daemon=True).start()
+
+
+def roster_watcher():
+    """Invalidate cached rosters from a change stream on Users.
+
+    Gives up and leaves the cache on its ROSTER_POLL_SECONDS expiry when the
+    server does not support change streams.
+    """
+    while True:
+        try:
+            with mongo.db.Users.watch(full_document="updateLookup") as stream:
+                # Anything that changed before the stream opened was missed
+                invalidate_roster()
+                _roster_stream_live.set()
+                app.logger.info("Roster cache following Users change stream")
+                for change in stream:
+                    invalidate_roster_change(change)
+                    publish_roster_change(change)
+        except OperationFailure as e:
+            _roster_stream_live.clear()
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                app.logger.info(f"Change streams unavailable, roster cache polling every {app.config['ROSTER_POLL_SECONDS']}s")
+                return
+            app.logger.warning(f"Roster change stream failed: {e}")
+        except Exception as e:
+            _roster_stream_live.clear()
+            app.logger.warning(f"Roster change stream failed: {e}")
+        time.sleep(app.config["ROSTER_POLL_SECONDS"])
+
+
+# ==========================================
+# PAGINATION AND STREAMING
+# ==========================================
+# Whole-collection endpoints walk Users in _id order. With ?limit=N they
+# return one page and put the cursor for the next one in X-Next-Cursor (and
+# a Link rel="next" header); pass it back as ?after=. Without a limit the
+# response is streamed as the Mongo cursor yields documents instead of being
+# built in memory. ?format=ndjson (or Accept: application/x-ndjson) writes one
+# document per line instead of a JSON array.
+
+MAX_PAGE_SIZE = 1000
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def page_params():
+    """(limit, after) from the query string; limit is None for an unpaged read.
+
+    Raises ValueError with a client-facing message for bad values.
+    """
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit must be an integer")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    after = request.args.get("after")
+    if after is not None and not ObjectId.is_valid(after):
+        raise ValueError("after must be a cursor returned in X-Next-Cursor")
+    return limit, after
+
+
+def wants_ndjson():
+    if request.args.get("format") == "ndjson":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def _next_page_link(cursor):
+    args = request.args.to_dict()
+    args["after"] = cursor
+    return f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+
+
+def collection_response(query, projection, transform, envelope=None):
+    """Page or stream Users matching `query` through `transform`.
+
+    `envelope` is (items_key, count_key) to wrap a JSON body as
+    {items_key: [...], count_key: n}; NDJSON bodies are never wrapped.
+    """
+    try:
+        limit, after = page_params()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+
+    if after:
+        query = {**query, "_id": {"$gt": ObjectId(after)}}
+    cursor = mongo.db.Users.find(query, {**projection, "_id": 1}).sort("_id", 1)
+    ndjson = wants_ndjson()
+    last_id = None
+
+    def items(docs):
+        nonlocal last_id
+        for doc in docs:
+            last_id = doc.pop("_id")
+            item = transform(doc)
+            if item is not None:
+                yield item
+
+    if limit:
+        docs = list(cursor.limit(limit))
+        page = list(items(docs))
+        if ndjson:
+            response = Response("".join(app.json.dumps(item) + "\n" for item in page), mimetype=NDJSON_MIMETYPE)
+        else:
+            response = jsonify({envelope[0]: page, envelope[1]: len(page)} if envelope else page)
+        # A short page is the last one
+        if len(docs) == limit:
+            response.headers["X-Next-Cursor"] = str(last_id)
+            response.headers["Link"] = _next_page_link(str(last_id))
+        return response
+
+    def generate():
+        count = 0
+        try:
+            if not ndjson:
+                yield f'{{"{envelope[0]}": [' if envelope else "["
+            for item in items(cursor):
+                if ndjson:
+                    yield app.json.dumps(item) + "\n"
+                else:
+                    yield ("," if count else "") + app.json.dumps(item)
+                count += 1
+            if not ndjson:
+                yield f'], "{envelope[1]}": {count}}}' if envelope else "]"
+        finally:
+            cursor.close()
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE if ndjson else "application/json")
+
+
+# ==========================================
+# RESPONSE COMPRESSION
+# ==========================================
+# Responses are compressed with brotli or gzip, whichever Accept-Encoding
+# prefers. Buffered bodies below COMPRESS_MIN_SIZE (device acknowledgements)
+# are sent as-is. Streamed bodies are always compressed, flushing after
+# every chunk so clients see documents as soon as the cursor yields them.
+# Views can pick their own levels with @compression(...).
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json", NDJSON_MIMETYPE, MSGPACK_MIMETYPE, CBOR_MIMETYPE, "text/html", "text/plain", "text/event-stream"
+}
+
+
+def compression(gzip=None, br=None):
+    """Per-view compression levels: gzip 1-9, brotli quality 0-11. Apply below the auth decorator."""
+    def decorator(f):
+        f.compression_levels = {"gzip": gzip, "br": br}
+        return f
+    return decorator
+
+
+def _compression_level(encoding):
+    view = app.view_functions.get(request.endpoint)
+    level = (getattr(view, "compression_levels", None) or {}).get(encoding)
+    if level is not None:
+        return level
+    return app.config["COMPRESS_GZIP_LEVEL"] if encoding == "gzip" else app.config["COMPRESS_BROTLI_QUALITY"]
 
-mongo = PyMongo(app)
 
+def _compressor(encoding, level):
+    """(compress chunk, flush, finish) callables for one response body."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
 
-# ==========================================
-# TEACHER ENDPOINTS (NEW)
-# ==========================================
 
-def require_api_key_optional(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        # ✅ Allow OPTIONS requests (CORS preflight)
-        if request.method == 'OPTIONS':
-            return make_response('', 204)
-            
-        api_key = request.headers.get('X-API-Key')
-        expected_key = os.getenv('API_KEY')
-        
-        # If API key is provided, validate it
-        if api_key:
-            if api_key != expected_key:
-                return make_response(jsonify({"error": "Invalid API key"}), 401)
-        
-        # If no API key provided, continue (for website requests)
-        return f(*args, **kwargs)
-    return decorated_function
+def _compressed_chunks(chunks, encoding, level):
+    compress, flush, finish = _compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compressed_etag_suffixes():
+    return ["gzip", "br"] if brotli is not None else ["gzip"]
+
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.status_code in (204, 304) or response.status_code < 200
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+    if encoding is None:
+        return response
+
+    level = _compression_level(encoding)
+    if response.is_streamed:
+        response.response = _compressed_chunks(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        compress, _, finish = _compressor(encoding, level)
+        response.set_data(compress(body) + finish())
+
+    response.headers["Content-Encoding"] = encoding
+    # A strong ETag names one exact byte sequence, so each encoding gets its own
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+    return response
 
-# Strict API key requirement (for sensitive operations)
-def require_api_key_strict(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        # ✅ Allow OPTIONS requests (CORS preflight)
-        if request.method == 'OPTIONS':
-            return make_response('', 204)
-            
-        api_key = request.headers.get('X-API-Key')
-        expected_key = os.getenv('API_KEY')
-        
-        if not api_key or api_key != expected_key:
-            return make_response(jsonify({"error": "API key required"}), 401)
-        
-        return f(*args, **kwargs)
-    return decorated_function
 
 @app.route("/")
 def index():
@@ -91,27 +2018,25 @@ def index():
 # ESP32 endpoints - require API key
 @app.route("/api/v1/add_5_coin", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_5_coin():
     try:
         # Expecting a JSON body with "rfidUID"
         data = request.json
-        if not data:
-            return make_response(jsonify({"error": "No data provided"}), 400)
+        error = validate_rfid_body(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
 
         rfid_uid = data.get("rfidUID")
-        if not rfid_uid:
-            return make_response(jsonify({"error": "rfidUID is required"}), 400)
 
         # Attempt to update the user's coins by +5 using rfidUID
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfid_uid},
-            {"$inc": {"coins": 5}}
-        )
+        projection, _ = post_image_projection(["coins"])
+        updated_user = update_user(rfid_uid, {"$inc": {"coins": 5}}, projection)
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "5 coins added successfully"}), 200
+        return jsonify({"message": "5 coins added successfully", "user": user_slice(updated_user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error adding 5 coins: {str(e)}")
@@ -156,6 +2081,7 @@ def create_user_from_rfid():
             "password": password,
             "rfidUID": rfidUID,
             "playerClass": playerClass,
+            "school": class_school(playerClass),
             "gender": gender,        # NEW field
             "character": character,  # NEW field
             "mainCreature": mainCreature,
@@ -167,8 +2093,15 @@ def create_user_from_rfid():
             "purchasedItems": [],
             "currentLocation": "H"
         }
+        if keyed_inventory():
+            user["inventory"] = inventory_from_arrays(user.pop("creatures"), user.pop("loot"))
+        user["summary"] = compute_summary(user)
 
         result = mongo.db.Users.insert_one(user)
+        # Registry first: a class-list read between the two would cache the old list under the new tag
+        register_class_members(playerClass, 1)
+        bump_versions(playerClass, class_list=True)
+        update_leaderboard(user)
 
         return jsonify({
             "warning": False,
@@ -194,14 +2127,19 @@ def login_user():
         if not username or not password:
             return make_response(jsonify({"warning": True, "message": "Username and password required"}), 400)
 
-        user = mongo.db.Users.find_one({"name": username, "password": password})
+        try:
+            fields = selected_fields()
+        except ValueError as e:
+            return make_response(jsonify({"warning": True, "message": str(e)}), 400)
+
+        user = mongo.db.Users.find_one(
+            {"name": username, "password": password},
+            fields_projection(fields) if fields else {"_id": 0, "password": 0, "summary": 0, INGEST_APPLIED_FIELD: 0, LEADERBOARD_VERSION_FIELD: 0, USER_VERSION_FIELD: 0}
+        )
         if not user:
             return make_response(jsonify({"warning": True, "message": "Invalid username or password"}), 401)
 
-        user.pop("_id", None)
-        user.pop("password", None)
-
-        return jsonify({"warning": False, "user": user}), 200
+        return jsonify({"warning": False, "user": inventory_to_arrays(user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error logging in: {str(e)}")
@@ -209,15 +2147,11 @@ def login_user():
 
 # Public endpoints - no API key required
 @app.route("/api/v1/get_custom_names", methods=["GET"])
+@compression(gzip=4, br=3)
 def get_custom_names():
     try:
         # Retrieve only the 'customName' field from all documents
-        users = mongo.db.Users.find({}, {"_id": 0, "name": 1})  # Changed from customName to name
-        
-        # Build a list of custom names
-        custom_names = [user["name"] for user in users if "name" in user]
-        
-        return jsonify(custom_names), 200
+        return collection_response({}, {"name": 1}, lambda user: user.get("name"))  # Changed from customName to name
     except Exception as e:
         app.logger.error(f"Error fetching custom names: {str(e)}")
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
@@ -225,36 +2159,54 @@ def get_custom_names():
 # FIXED: Single users endpoint that handles both ESP32 and website requests
 @app.route('/api/v1/users', methods=['GET'])
 @require_api_key_optional
+@compression(gzip=6, br=5)
 def get_users():
     try:
-        # Check if this is a request for a specific user by RFID
         rfid_uid = request.args.get("rfidUID")
+        player_class = request.args.get("playerClass")
+        try:
+            fields = selected_fields(ROSTER_FIELDS if player_class and not rfid_uid else USER_FIELDS)
+        except ValueError as e:
+            return make_response(jsonify({"error": str(e)}), 400)
+
+        # Check if this is a request for a specific user by RFID
         if rfid_uid:
+            etag = version_etag(USER_VERSION_FIELD, user_version(rfid_uid))
+            cached = not_modified(etag)
+            if cached:
+                return cached
+
             # Get specific user with ALL data including challengeCodes
             user = mongo.db.Users.find_one(
                 {"rfidUID": rfid_uid},
-                {"_id": 0, "password": 0}  # Exclude only sensitive fields
+                fields_projection(fields) if fields else {"_id": 0, "password": 0, "summary": 0, INGEST_APPLIED_FIELD: 0, LEADERBOARD_VERSION_FIELD: 0, USER_VERSION_FIELD: 0}  # Exclude only sensitive fields
             )
             if not user:
                 return make_response(jsonify({"error": "No user found for the given rfidUID"}), 404)
-            return jsonify(user), 200
+            return with_etag(jsonify(inventory_to_arrays(user)), etag), 200
         
         # Check if filtering by playerClass
-        player_class = request.args.get("playerClass")
         if player_class:
+            version, = read_versions(class_version_id(player_class))
+            etag = version_etag(version)
+            cached = not_modified(etag)
+            if cached:
+                return cached
+
             # Get users for specific class with full data including purchasedItems
-            users = mongo.db.Users.find(
-                {"playerClass": player_class},
-                {"_id": 0, "name": 1, "playerClass": 1, "coins": 1, "creatures": 1, "artifacts": 1, "loot": 1, "rfidUID": 1, "purchasedItems": 1, "currentLocation": 1, "character": 1, "gender": 1, "lordOf": 1}
-            )
-            users_list = list(users)
+            if fields is None:
+                fields = [field for field in ROSTER_FIELDS if field != "mainCreature"]
+            users_list = [
+                {field: user[field] for field in fields if field in user}
+                for user in class_roster(player_class, version)
+            ]
             app.logger.info(f"Fetched {len(users_list)} users for class: {player_class}")
-            return jsonify(users_list), 200
+            return with_etag(jsonify(users_list), etag), 200
         
         # No filters - get all users (without sensitive data)
-        users = mongo.db.Users.find({}, {"_id": 0, "name": 1, "playerClass": 1, "coins": 1, "creatures": 1, "artifacts": 1, "loot": 1, "rfidUID": 1})
-        users_list = list(users)
-        return jsonify(users_list), 200
+        if fields is None:
+            fields = ["name", "playerClass", "coins", "creatures", "artifacts", "loot", "rfidUID"]
+        return collection_response({}, inventory_projection(dict.fromkeys(fields, 1)), inventory_to_arrays)
     except Exception as e:
         app.logger.error(f"Error fetching users: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -263,13 +2215,9 @@ def get_users():
 @app.route('/api/v1/classes', methods=['GET'])
 @require_api_key_optional
 def get_classes():
-    """Return distinct playerClass values."""
+    """Return registered playerClass values."""
     try:
-        classes = mongo.db.Users.distinct("playerClass")
-        # Remove empty/null values and sort for consistency
-        classes = [c for c in classes if c]
-        classes.sort()
-        return jsonify(classes), 200
+        return jsonify(listed_classes()), 200
     except Exception as e:
         app.logger.error(f"Error fetching classes: {str(e)}")
         return jsonify({"error": "Internal Server Error"}), 500
@@ -277,6 +2225,7 @@ def get_classes():
 # ESP32 specific endpoints
 @app.route("/api/v1/users/<rfidUID>/add_creature", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_creature(rfidUID):
     try:
         data = request.json
@@ -294,16 +2243,24 @@ def add_creature(rfidUID):
         if creature_name is None or creature_value is None:
             return make_response(jsonify({"error": "Missing creatureName or creatureValue"}), 400)
 
-        # Push the creature to the "creatures" list in the user's document
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$push": {"creatures": {"name": creature_name, "value": creature_value}}}
-        )
+        if keyed_inventory():
+            # The keyed layout has no unstacked entries, so this is a stack of one
+            projection, changed = post_image_projection(["coins", "mainCreature", "creatures"], creatures=[creature_name])
+            update = keyed_stack_update([{"name": creature_name, "value": creature_value, "count": 1}])
+            updated_user = update_keyed_user(rfidUID, with_summary(update, summary_inc(creatures=1)), projection)
+        else:
+            # Push the creature to the "creatures" list in the user's document
+            projection, changed = post_image_projection(["coins", "mainCreature", "creatures"], pushed=["creatures"])
+            updated_user = update_user(
+                rfidUID,
+                with_summary({"$push": {"creatures": {"name": creature_name, "value": creature_value}}}, summary_inc(creatures=1)),
+                projection
+            )
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "Creature added successfully"}), 200
+        return jsonify({"message": "Creature added successfully", "user": user_slice(updated_user, changed)}), 200
 
     except Exception as e:
         app.logger.error(f"Error adding creature: {str(e)}")
@@ -311,6 +2268,7 @@ def add_creature(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/add_artifact", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_artifact(rfidUID):
     try:
         data = request.json
@@ -329,15 +2287,17 @@ def add_artifact(rfidUID):
             return make_response(jsonify({"error": "Missing artifactName or artifactPower"}), 400)
 
         # Push the artifact to the "artifacts" list in the user's document
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$push": {"artifacts": {"name": artifact_name, "power": artifact_power}}}
+        projection, _ = post_image_projection(["coins", "mainCreature", "artifacts"], pushed=["artifacts"])
+        updated_user = update_user(
+            rfidUID,
+            with_summary({"$push": {"artifacts": {"name": artifact_name, "power": artifact_power}}}, summary_inc(artifacts=1)),
+            projection
         )
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "Artifact added successfully"}), 200
+        return jsonify({"message": "Artifact added successfully", "user": user_slice(updated_user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error adding artifact: {str(e)}")
@@ -346,6 +2306,7 @@ def add_artifact(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/add_challenge_code", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_challenge_code(rfidUID):
     try:
         data = request.json
@@ -365,15 +2326,17 @@ def add_challenge_code(rfidUID):
 
         # Push the new item into the 'challengeCodes' array
         # Each entry could look like: {"code": 123, "digit": 7}
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$push": {"challengeCodes": {"code": challenge_code, "digit": digit}}}
+        projection, _ = post_image_projection(["challengeCodes"], pushed=["challengeCodes"])
+        updated_user = update_user(
+            rfidUID,
+            with_summary({"$push": {"challengeCodes": {"code": challenge_code, "digit": digit}}}, summary_inc(challenge_codes=1)),
+            projection
         )
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "Challenge code added successfully"}), 200
+        return jsonify({"message": "Challenge code added successfully", "user": user_slice(updated_user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error adding challenge code: {str(e)}")
@@ -382,6 +2345,7 @@ def add_challenge_code(rfidUID):
 
 @app.route("/api/v1/update_creature_loot_and_coin", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def update_creature_loot_and_coin():
     try:
         data = request.json
@@ -396,21 +2360,31 @@ def update_creature_loot_and_coin():
         if not rfid_uid:
             return make_response(jsonify({"error": "rfidUID is required"}), 400)
 
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfid_uid},
-            {
-                "$inc": {"coins": add_coins},
-                "$push": {
-                    "creatures": {"$each": creatures},
-                    "loot": {"$each": loot}
-                }
-            }
+        projection, changed = post_image_projection(
+            ["coins", "creatures", "loot"], creatures=stack_names(creatures), loot=stack_names(loot)
         )
+        if keyed_inventory():
+            updated_user = update_keyed_user(rfid_uid, keyed_push_update(add_coins, creatures, loot), projection)
+        else:
+            updated_user = update_user(
+                rfid_uid,
+                with_summary({
+                    "$inc": {"coins": add_coins},
+                    "$push": {
+                        "creatures": {"$each": creatures},
+                        "loot": {"$each": loot}
+                    }
+                }, summary_inc(creatures=stack_total(creatures), loot=stack_total(loot))),
+                projection
+            )
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for this rfidUID"}), 404)
 
-        return jsonify({"message": "Creature, loot, and coins updated successfully"}), 200
+        return jsonify({
+            "message": "Creature, loot, and coins updated successfully",
+            "user": user_slice(updated_user, changed)
+        }), 200
 
     except Exception as e:
         app.logger.error(f"Error updating creature, loot, and coins: {str(e)}")
@@ -418,6 +2392,7 @@ def update_creature_loot_and_coin():
 
 @app.route("/api/v1/users/<rfidUID>/set_main_creature", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def set_main_creature(rfidUID):
     try:
         data = request.json
@@ -428,41 +2403,38 @@ def set_main_creature(rfidUID):
         if not creature_name:
             return make_response(jsonify({"error": "creatureName is required"}), 400)
 
-        # First, check if user exists
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
-            return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
-
-        # Update just the main creature (don't require creature to exist in collection)
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$set": {"mainCreature": creature_name}}
-        )
-
-        # If the creature exists in the user's collection, update its stats
-        creature_exists = mongo.db.Users.find_one(
-            {"rfidUID": rfidUID, "creatures.name": creature_name}
-        )
-        
-        if creature_exists:
-            # Update existing creature stats
-            mongo.db.Users.update_one(
-                {"rfidUID": rfidUID, "creatures.name": creature_name},
-                {
-                    "$set": {
-                        "creatures.$.stats": {
-                            "power": data.get("power", 3),
-                            "defence": data.get("defence", 3),
-                            "speed": data.get("speed", 3)
-                        }
-                    }
-                }
+        stats = {
+            "power": data.get("power", 3),
+            "defence": data.get("defence", 3),
+            "speed": data.get("speed", 3)
+        }
+        projection, changed = post_image_projection(["coins", "mainCreature", "creatures"], creatures=[creature_name])
+
+        # Update the main creature (don't require creature to exist in collection)
+        if keyed_inventory():
+            updated_user = update_keyed_user(rfidUID, {"$set": {"mainCreature": creature_name}}, projection)
+            # If the creature exists in the user's collection, update its stats
+            if updated_user and user_slice(dict(updated_user), changed).get("creatures"):
+                updated_user = update_user(
+                    rfidUID, {"$set": {stack_field("creatures", creature_name, "stats"): stats}}, projection
+                )
+        else:
+            # arrayFilters makes the stats update a no-op when the creature isn't owned,
+            # but the server rejects it outright when there is no creatures array
+            updated_user = update_user(
+                rfidUID,
+                {"$set": {"mainCreature": creature_name, "creatures.$[stack].stats": stats}},
+                projection,
+                {"creatures": {"$type": "array"}},
+                array_filters=[{"stack.name": creature_name}]
             )
+            if not updated_user:
+                updated_user = update_user(rfidUID, {"$set": {"mainCreature": creature_name}}, projection)
 
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "Failed to update main creature"}), 500)
+        if not updated_user:
+            return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "Main creature updated successfully"}), 200
+        return jsonify({"message": "Main creature updated successfully", "user": user_slice(updated_user, changed)}), 200
 
     except Exception as e:
         app.logger.error(f"Error setting main creature: {str(e)}")
@@ -470,6 +2442,7 @@ def set_main_creature(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/update_creature_stats", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def update_creature_stats(rfidUID):
     try:
         data = request.json
@@ -483,15 +2456,17 @@ def update_creature_stats(rfidUID):
             return make_response(jsonify({"error": "creatureName is required"}), 400)
 
         # Update the creature's stats
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID, "creatures.name": creature_name},
-            {"$set": {"creatures.$.stats": stats}}
-        )
-
-        if result.modified_count == 0:
+        projection, changed = post_image_projection(["creatures"], creatures=[creature_name])
+        query = stack_filter(rfidUID, "creatures", creature_name)
+        update = {"$set": {stack_field("creatures", creature_name, "stats"): stats}}
+        updated_user = update_user(rfidUID, update, projection, query)
+        if not updated_user and keyed_inventory() and migrate_user_inventory({"rfidUID": rfidUID}):
+            updated_user = update_user(rfidUID, update, projection, query)
+
+        if not updated_user:
             return make_response(jsonify({"error": "Creature not found or user not found"}), 404)
 
-        return jsonify({"message": "Creature stats updated successfully"}), 200
+        return jsonify({"message": "Creature stats updated successfully", "user": user_slice(updated_user, changed)}), 200
 
     except Exception as e:
         app.logger.error(f"Error updating creature stats: {str(e)}")
@@ -499,6 +2474,7 @@ def update_creature_stats(rfidUID):
 
 @app.route("/api/v1/complete_loot_upload", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def complete_loot_upload():
     try:
         data = request.json
@@ -507,33 +2483,35 @@ def complete_loot_upload():
         creatures = data.get('creatures', [])
         loot = data.get('loot', [])
         
-        user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
-        if not user:
-            return make_response(jsonify({"error": "User not found"}), 404)
-        
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfid_uid},
-            {
-                "$inc": {"coins": add_coins},
-                "$push": {
-                    "creatures": {"$each": creatures},
-                    "loot": {"$each": loot}
-                }
-            }
+        projection, changed = post_image_projection(
+            ["name", "coins", "creatures", "loot"], creatures=stack_names(creatures), loot=stack_names(loot)
         )
+        if keyed_inventory():
+            updated_user = update_keyed_user(rfid_uid, keyed_push_update(add_coins, creatures, loot), projection)
+        else:
+            updated_user = update_user(
+                rfid_uid,
+                with_summary({
+                    "$inc": {"coins": add_coins},
+                    "$push": {
+                        "creatures": {"$each": creatures},
+                        "loot": {"$each": loot}
+                    }
+                }, summary_inc(creatures=stack_total(creatures), loot=stack_total(loot))),
+                projection
+            )
         
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "No user found for this rfidUID"}), 404)
-        
-        updated_user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
+        if not updated_user:
+            return make_response(jsonify({"error": "User not found"}), 404)
         
-        app.logger.info(f"Complete loot upload for user {user['name']}: +{add_coins} coins, {len(creatures)} creatures, {len(loot)} loot")
+        app.logger.info(f"Complete loot upload for user {updated_user.get('name')}: +{add_coins} coins, {len(creatures)} creatures, {len(loot)} loot")
         return make_response(jsonify({
             "message": "Upload successful",
             "coinsAdded": add_coins,
             "creaturesAdded": len(creatures),
             "lootAdded": len(loot),
-            "totalCoins": updated_user.get("coins", 0)
+            "totalCoins": updated_user.get("coins", 0),
+            "user": user_slice(updated_user, changed)
         }), 200)
         
     except Exception as e:
@@ -542,14 +2520,11 @@ def complete_loot_upload():
 
 @app.route("/api/v1/debug/users", methods=["GET"])
 @require_api_key_strict
+@compression(gzip=4, br=3)
 def debug_users():
     try:
         # Get all users to see what's in the database
-        users = list(mongo.db.Users.find({}, {"_id": 0, "name": 1, "rfidUID": 1}))
-        return jsonify({
-            "total_users": len(users),
-            "users": users
-        })
+        return collection_response({}, {"name": 1, "rfidUID": 1}, lambda user: user, envelope=("users", "total_users"))
     except Exception as e:
         app.logger.error(f"Error in debug_users: {str(e)}")
         return make_response(jsonify({"error": str(e)}), 500)
@@ -586,6 +2561,7 @@ def handle_exception(e):
 
 @app.route("/api/v1/users/<rfidUID>/add_crafted_artifact", methods=["POST"])
 @require_api_key_optional  # <-- Add this line
+@validate_write_fields
 def add_crafted_artifact(rfidUID):
     try:
         data = request.json
@@ -609,70 +2585,917 @@ def add_crafted_artifact(rfidUID):
         }
 
         # Push the artifact to the "artifacts" list in the user's document
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$push": {"artifacts": crafted_artifact}}
+        projection, _ = post_image_projection(["coins", "mainCreature", "artifacts"], pushed=["artifacts"])
+        updated_user = update_user(
+            rfidUID, with_summary({"$push": {"artifacts": crafted_artifact}}, summary_inc(artifacts=1)), projection
         )
 
-        if result.modified_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        return jsonify({"message": "Crafted artifact added successfully"}), 200
+        return jsonify({"message": "Crafted artifact added successfully", "user": user_slice(updated_user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error adding crafted artifact: {str(e)}")
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
+
+# ==========================================
+# KEYED INVENTORY
+# ==========================================
+# With KEYED_INVENTORY=1 creature and loot stacks live in
+#   inventory.creatures.<key> = {"name": ..., "value": ..., "count": ...}
+#   inventory.loot.<key>      = {"name": ..., "count": ..., "type": "loot"}
+# instead of the `creatures` / `loot` arrays, so adding to a stack is a blind
+# $inc. Reads go through inventory_to_arrays() so clients still get arrays.
+# Once documents have been migrated, leave the flag on.
+
+def keyed_inventory():
+    return app.config["KEYED_INVENTORY"]
+
+
+def inventory_key(name):
+    """Escape a stack name so it is safe to use as a document key."""
+    return str(name).replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def inventory_unkey(key):
+    """Reverse inventory_key()."""
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+def inventory_path(kind, name):
+    return f"inventory.{kind}.{inventory_key(name)}"
+
+
+def inventory_from_arrays(creatures, loot):
+    """Build the keyed inventory from the legacy arrays, merging duplicate names."""
+    inventory = {"creatures": {}, "loot": {}}
+    for kind, entries in (("creatures", creatures), ("loot", loot)):
+        for entry in entries or []:
+            if not isinstance(entry, dict) or not entry.get("name"):
+                continue
+            key = inventory_key(entry["name"])
+            count = entry.get("count", 1)
+            if key in inventory[kind]:
+                inventory[kind][key]["count"] += count
+            else:
+                inventory[kind][key] = {**entry, "count": count}
+    return inventory
+
+
+def inventory_to_arrays(user):
+    """Compatibility layer: give a keyed user document the array shape back."""
+    if user and isinstance(user.get("inventory"), dict):
+        inventory = user.pop("inventory")
+        for kind in ("creatures", "loot"):
+            if kind in inventory:
+                user[kind] = list((inventory[kind] or {}).values())
+    return user
+
+
+def inventory_projection(projection):
+    """Add the keyed inventory to an inclusion projection that asks for creatures or loot."""
+    if projection.get("creatures") or projection.get("loot"):
+        projection = {**projection, "inventory": 1}
+    return projection
+
+
+def keyed_stack_update(creature_stacks=(), loot_stacks=()):
+    """Update document that adds stacks to a keyed inventory without reading it.
+
+    Counts are $inc'd and identity fields $set. A creature's value is applied
+    with $max so the default of 1 sent by older devices never overwrites the
+    value recorded when the stack was created.
+    """
+    update = {}
+    for kind, stacks in (("creatures", creature_stacks), ("loot", loot_stacks)):
+        for stack in stacks:
+            path = inventory_path(kind, stack["name"])
+            for field, value in stack.items():
+                operator = {"count": "$inc", "value": "$max"}.get(field, "$set")
+                update.setdefault(operator, {})[f"{path}.{field}"] = value
+    return update
+
+
+def stack_filter(rfid_uid, kind, name):
+    """Query matching a user who owns a `kind` stack called `name`, in either layout."""
+    if keyed_inventory():
+        return {"rfidUID": rfid_uid, inventory_path(kind, name): {"$exists": True}}
+    return {"rfidUID": rfid_uid, f"{kind}.name": name}
+
+
+def stack_field(kind, name, field):
+    """Update path for `field` of the stack matched by stack_filter()."""
+    if keyed_inventory():
+        return f"{inventory_path(kind, name)}.{field}"
+    return f"{kind}.$.{field}"
+
+
+def keyed_push_update(add_coins, creatures, loot):
+    """Keyed-layout equivalent of $push-ing raw creature/loot entries plus a coin $inc."""
+    creature_stacks, _ = merge_stacks(creatures, "creatures")
+    loot_stacks, _ = merge_stacks(loot, "loot")
+    update = keyed_stack_update(creature_stacks, loot_stacks)
+    update.setdefault("$inc", {})["coins"] = add_coins
+    return with_summary(update, summary_inc(creatures=stack_total(creature_stacks), loot=stack_total(loot_stacks)))
+
+
+def migrate_user_inventory(query):
+    """Move one array-layout user matching `query` to the keyed layout.
+
+    The write is conditional on the arrays being unchanged since they were
+    read, so a concurrent legacy write makes it a no-op instead of losing data.
+    Returns True when a document was converted.
+    """
+    user = mongo.db.Users.find_one(
+        {**query, "inventory": {"$exists": False}},
+        {"rfidUID": 1, "playerClass": 1, "creatures": 1, "loot": 1}
+    )
+    if not user:
+        return False
+
+    creatures = user.get("creatures")
+    loot = user.get("loot")
+    result = mongo.db.Users.update_one(
+        {"_id": user["_id"], "inventory": {"$exists": False}, "creatures": creatures, "loot": loot},
+        {
+            "$set": {"inventory": inventory_from_arrays(creatures, loot)},
+            "$unset": {"creatures": "", "loot": ""},
+            # Duplicate stacks merge, so the user reads back differently
+            "$inc": {USER_VERSION_FIELD: 1}
+        }
+    )
+    if result.modified_count != 1:
+        return False
+    queue_version_bumps(user.get("playerClass"))
+    return True
+
+
+def update_keyed_user(rfid_uid, update, projection, query=None):
+    """find_one_and_update against a keyed user, migrating the document first if needed."""
+    for _ in range(3):
+        updated_user = update_user(rfid_uid, update, projection, {**(query or {}), "inventory": {"$exists": True}})
+        if updated_user or not mongo.db.Users.find_one({"rfidUID": rfid_uid}, {"_id": 1}):
+            return updated_user
+        migrate_user_inventory({"rfidUID": rfid_uid})
+    return None
+
+
+def migrate_inventories(batch_size=100):
+    """Convert every remaining array-layout user. Returns how many were converted."""
+    converted = 0
+    while True:
+        pending = list(mongo.db.Users.find({"inventory": {"$exists": False}}, {"_id": 1}).limit(batch_size))
+        if not pending:
+            return converted
+        for user in pending:
+            # A lost race just leaves the document for the next batch
+            if migrate_user_inventory({"_id": user["_id"]}):
+                converted += 1
+
+
+def inventory_migrator():
+    """Background thread body: migrate users to the keyed layout, then exit."""
+    try:
+        converted = migrate_inventories()
+        app.logger.info(f"Keyed inventory migration finished: {converted} users converted")
+    except Exception as e:
+        app.logger.error(f"Keyed inventory migration failed: {str(e)}")
+
+
+_background_started = False
+_background_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_tasks():
+    """Start per-process background threads on the first request.
+
+    Deferred to the first request so they run in each gunicorn worker rather
+    than in a process that is about to fork, and never under `flask` CLI commands.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+        if keyed_inventory():
+            threading.Thread(target=inventory_migrator, name="inventory-migrator", daemon=True).start()
+        start_log_listener()
+        start_version_flusher()
+        threading.Thread(target=log_settings_refresher, name="log-settings", daemon=True).start()
+        threading.Thread(target=revocation_refresher, name="token-revocations", daemon=True).start()
+        if app.config["ASYNC_INGEST"]:
+            threading.Thread(target=ingest_worker, name="ingest-worker", daemon=True).start()
+        if app.config["ROSTER_CACHE"]:
+            ensure_roster_watcher()
+        if app.config["SYNC_INDEXES"]:
+            threading.Thread(target=index_sync_task, name="index-sync", daemon=True).start()
+        threading.Thread(target=leaderboard_backfill, name="leaderboard-backfill", daemon=True).start()
+        threading.Thread(target=classes_backfill, name="classes-backfill", daemon=True).start()
+
+
+indexes_cli = AppGroup("indexes", help="Declared index maintenance.")
+
+
+@indexes_cli.command("sync")
+def indexes_sync_command():
+    """Create declared indexes that are missing."""
+    for spec in INDEX_SPEC:
+        try:
+            click.echo(f"ok       {spec['collection']}.{create_declared_index(spec)}")
+        except OperationFailure as e:
+            click.echo(f"failed   {_describe_index(spec)}: {e}")
+
+
+@indexes_cli.command("diff")
+def indexes_diff_command():
+    """Show declared indexes that are missing or differ, and undeclared ones."""
+    missing, conflicting, undeclared = index_diff()
+    for spec in missing:
+        click.echo(f"missing     {_describe_index(spec)}")
+    for spec, name in conflicting:
+        click.echo(f"differs     {_describe_index(spec)} (existing {name})")
+    for collection, name in undeclared:
+        click.echo(f"undeclared  {collection}.{name}")
+    if not (missing or conflicting or undeclared):
+        click.echo("Indexes match the spec")
+
+
+@indexes_cli.command("drop-unused")
+@click.option("--yes", is_flag=True, help="Drop without asking.")
+def indexes_drop_unused_command(yes):
+    """Drop indexes the spec does not declare."""
+    _, _, undeclared = index_diff()
+    if not undeclared:
+        click.echo("No undeclared indexes")
+        return
+    for collection, name in undeclared:
+        # Access counts since the last restart, as a hint that the index is dead weight
+        stats = next(mongo.db[collection].aggregate([{"$indexStats": {}}, {"$match": {"name": name}}]), None)
+        ops = stats["accesses"]["ops"] if stats else "?"
+        click.echo(f"{collection}.{name} (ops since restart: {ops})")
+    if yes or click.confirm("Drop these indexes?"):
+        for collection, name in undeclared:
+            mongo.db[collection].drop_index(name)
+            click.echo(f"dropped  {collection}.{name}")
+
+
+@indexes_cli.command("routes")
+def indexes_routes_command():
+    """Print the declared indexes each route relies on."""
+    rules = {}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint != "static":
+            rules.setdefault(rule.endpoint, rule.rule)
+    for endpoint in sorted(rules, key=rules.get):
+        specs = [spec for spec in INDEX_SPEC if endpoint in spec["routes"]]
+        click.echo(rules[endpoint])
+        for spec in specs:
+            click.echo(f"    {_describe_index(spec)}")
+        if not specs:
+            click.echo("    (no declared index)")
+    for spec in INDEX_SPEC:
+        if spec.get("note"):
+            click.echo(f"{spec['note']}\n    {_describe_index(spec)}")
+    unknown = sorted({endpoint for spec in INDEX_SPEC for endpoint in spec["routes"]} - set(rules))
+    if unknown:
+        click.echo(f"Spec names unknown endpoints: {', '.join(unknown)}")
+
+
+app.cli.add_command(indexes_cli)
+
+
+inventory_cli = AppGroup("inventory", help="Keyed inventory maintenance.")
+
+
+@inventory_cli.command("migrate")
+def inventory_migrate_command():
+    """Convert all array-layout users to the keyed inventory layout."""
+    click.echo(f"Converted {migrate_inventories()} users")
+
+
+app.cli.add_command(inventory_cli)
+
+
+# ==========================================
+# STACKED UPLOAD ENGINE
+# ==========================================
+
+def merge_stacks(items, kind):
+    """Collapse upload entries into one new-stack document per name.
+
+    `kind` is "creatures" or "loot" and decides the shape of a new stack
+    (creatures carry a value, loot carries type "loot"). Returns the stacks
+    in first-seen order plus how many entries had a name, which is what the
+    endpoints report back as processed.
+    """
+    stacks = {}
+    processed = 0
+    for item in items or []:
+        name = item.get("name") if isinstance(item, dict) else None
+        if not name:
+            app.logger.warning("Skipping %s entry with no name: %s", kind, item)
+            continue
+
+        count = item.get("count", 1)
+        if name in stacks:
+            stacks[name]["count"] += count
+        elif kind == "creatures":
+            stacks[name] = {"name": name, "value": item.get("value", 1), "count": count}
+        else:
+            stacks[name] = {"name": name, "count": count, "type": "loot"}
+        processed += 1
+
+    return list(stacks.values()), processed
+
+
+def build_challenge_entry(challenge_code, timestamp=None):
+    """Split a challenge code like "1115" into code, base code and lives remaining."""
+    lives_remaining = int(challenge_code[-1]) if challenge_code[-1].isdigit() else 0
+    base_code = challenge_code[:-1] if len(challenge_code) > 1 else challenge_code
+
+    return {
+        "code": challenge_code,             # Full code (e.g., "1115")
+        "baseCode": base_code,              # Just the code part (e.g., "111")
+        "livesRemaining": lives_remaining,  # Last digit (e.g., 5)
+        "timestamp": timestamp or datetime.datetime.utcnow()
+    }
+
+
+def _stack_merge_expr(field, stacks):
+    """Aggregation expression that adds `stacks` onto the array in `field`.
+
+    Existing stacks with a matching name get their count incremented (a missing
+    count is treated as 0, same as `$inc` did); names not present yet are
+    appended as new stacks. Payload values are wrapped in $literal so names or
+    counts starting with "$" are never read as field paths.
+    """
+    current = {"$ifNull": [f"${field}", []]}
+    existing_names = {"$ifNull": [f"${field}.name", []]}
+
+    branches = [
+        {
+            "case": {"$eq": ["$$stack.name", {"$literal": stack["name"]}]},
+            "then": {"$mergeObjects": [
+                "$$stack",
+                {"count": {"$add": [{"$ifNull": ["$$stack.count", 0]}, {"$literal": stack["count"]}]}}
+            ]}
+        }
+        for stack in stacks
+    ]
+    incremented = {"$map": {
+        "input": current,
+        "as": "stack",
+        "in": {"$switch": {"branches": branches, "default": "$$stack"}}
+    }}
+    appended = [
+        {"$cond": [{"$in": [{"$literal": stack["name"]}, existing_names]}, [], [{"$literal": stack}]]}
+        for stack in stacks
+    ]
+    return {"$concatArrays": [incremented] + appended}
+
+
+def _stack_take_one_expr(field, name):
+    """Aggregation expression that takes one `name` off the first matching stack in `field`.
+
+    A stack without a count counts as 1, and a stack that reaches 0 is removed.
+    """
+    name = {"$literal": name}
+    stacks = {"$ifNull": [f"${field}", []]}
+    taken = {"$cond": [
+        {"$gt": [{"$ifNull": ["$$stack.count", 1]}, 1]},
+        {"$mergeObjects": ["$$stack", {"count": {"$subtract": [{"$ifNull": ["$$stack.count", 1]}, 1]}}]},
+        None
+    ]}
+    return {"$let": {
+        "vars": {"stacks": stacks, "at": {"$indexOfArray": [{"$ifNull": [f"${field}.name", []]}, name]}},
+        "in": {"$filter": {
+            "input": {"$map": {
+                "input": {"$range": [0, {"$size": "$$stacks"}]},
+                "as": "i",
+                "in": {"$let": {
+                    "vars": {"stack": {"$arrayElemAt": ["$$stacks", "$$i"]}},
+                    "in": {"$cond": [{"$eq": ["$$i", "$$at"]}, taken, "$$stack"]}
+                }}
+            }},
+            "as": "stack",
+            "cond": {"$ne": ["$$stack", None]}
+        }}
+    }}
+
+
+def apply_stacked_upload(rfid_uid, add_coins=0, creatures=None, loot=None, challenge_entries=(),
+                         projection=None, journal_keys=()):
+    """Apply a whole stacked upload to one user in a single atomic write.
+
+    Creature and loot stacks, coins and the challenge code entries are merged
+    into one write - a pipeline update for the array layout, plain $inc/$set
+    for the keyed layout - and the post-image comes back from the same round
+    trip via find_one_and_update.
+
+    With journal_keys the write records them on the user and only matches
+    if none is recorded yet, so a journal batch is applied at most once.
+
+    Returns (updated_user, creatures_processed, loot_processed). updated_user
+    is None when no user matches rfid_uid (or, with journal_keys, when one of
+    them was already applied).
+    """
+    if projection is None:
+        projection = {"_id": 0, "name": 1, "coins": 1}
+
+    creature_stacks, creatures_processed = merge_stacks(creatures, "creatures")
+    loot_stacks, loot_processed = merge_stacks(loot, "loot")
+    counters = summary_inc(
+        creatures=stack_total(creature_stacks), loot=stack_total(loot_stacks), challenge_codes=len(challenge_entries)
+    )
+
+    query = {INGEST_APPLIED_FIELD: {"$nin": list(journal_keys)}} if journal_keys else None
+
+    if keyed_inventory():
+        update = keyed_stack_update(creature_stacks, loot_stacks)
+        if add_coins > 0:
+            update.setdefault("$inc", {})["coins"] = add_coins
+        if challenge_entries:
+            update["$push"] = {"challengeCodes": {"$each": list(challenge_entries)}}
+
+        update = with_journal_keys(with_summary(update, counters), journal_keys)
+        if update:
+            updated_user = update_keyed_user(rfid_uid, update, projection, query)
+        else:
+            updated_user = mongo.db.Users.find_one({"rfidUID": rfid_uid}, projection)
+        return updated_user, creatures_processed, loot_processed
+
+    update = stacked_upload_pipeline(creature_stacks, loot_stacks, add_coins, challenge_entries) or []
+    update = with_journal_keys(with_summary(update, counters), journal_keys)
+    if update:
+        updated_user = update_user(rfid_uid, update, projection, query)
+    else:
+        updated_user = mongo.db.Users.find_one({"rfidUID": rfid_uid}, projection)
+
+    return updated_user, creatures_processed, loot_processed
+
+
+def stacked_upload_pipeline(creature_stacks, loot_stacks, add_coins=0, challenge_entries=()):
+    """Array-layout pipeline update for a stacked upload, or None when it changes nothing."""
+    changes = {}
+    if creature_stacks:
+        changes["creatures"] = _stack_merge_expr("creatures", creature_stacks)
+    if loot_stacks:
+        changes["loot"] = _stack_merge_expr("loot", loot_stacks)
+    if add_coins > 0:
+        changes["coins"] = {"$add": [{"$ifNull": ["$coins", 0]}, {"$literal": add_coins}]}
+    if challenge_entries:
+        changes["challengeCodes"] = {"$concatArrays": [
+            {"$ifNull": ["$challengeCodes", []]},
+            [{"$literal": entry} for entry in challenge_entries]
+        ]}
+    return [{"$set": changes}] if changes else None
+
+
+# ==========================================
+# WRITE-BEHIND INGESTION
+# ==========================================
+# With ASYNC_INGEST=1 the stacked upload endpoints validate the body, append
+# it to a local SQLite journal and answer 202 straight away. A worker thread
+# in every process drains the journal, folds all pending uploads for the same
+# rfidUID into one apply_stacked_upload() call and deletes the rows only after
+# that write succeeded. Rows claimed by a worker that died are picked up again
+# after INGEST_CLAIM_TIMEOUT.
+#
+# The same write appends "<journal id>:<row id>" for every row it applied to
+# the user's INGEST_APPLIED_FIELD and only matches while none of them is
+# there, so a row whose delete failed (or whose worker died after the write)
+# is dropped rather than applied twice when it comes round again. The list
+# keeps the last INGEST_APPLIED_KEEP keys; that has to outlast the uploads
+# one student can have applied in an INGEST_CLAIM_TIMEOUT.
+#
+# A student's rows that fail together are retried one at a time, and every
+# failure counts against the row. A row that fails INGEST_MAX_ATTEMPTS times,
+# or whose rfidUID matches no user, moves to the dead_uploads table so it
+# cannot hold back the rows queued after it; /api/v1/ingest/status counts
+# them. Only Mongo being unreachable hands the whole batch back untouched.
+
+INGEST_CLAIM_TIMEOUT = 300
+INGEST_APPLIED_FIELD = "ingestApplied"
+INGEST_APPLIED_KEEP = 500
+INGEST_FINISH_ATTEMPTS = 5
+INGEST_MAX_ATTEMPTS = 5
+INGEST_UNKNOWN_RFID = "unknown rfidUID"
+
+_ingest_wakeup = threading.Event()
+_ingest_stats = {"applied": 0, "coalesced": 0, "lastDrainAt": None, "lastLagSeconds": None}
+
+
+def validate_stacked_upload(data):
+    """Return an error message for a malformed stacked upload body, or None."""
+    if not isinstance(data, dict) or not data:
+        return "No data provided"
+    if not data.get("rfidUID"):
+        return "rfidUID is required"
+    add_coins = data.get("addCoins", 0)
+    if isinstance(add_coins, bool) or not isinstance(add_coins, (int, float)):
+        return "addCoins must be a number"
+    for field in ("creatures", "loot"):
+        if not isinstance(data.get(field, []), list):
+            return f"{field} must be a list"
+        for index, item in enumerate(data.get(field, [])):
+            error = _validate_upload_stack(item)
+            if error:
+                return f"{field}[{index}]: {error}"
+    if not isinstance(data.get("challengeCode", ""), str):
+        return "challengeCode must be a string"
+    return None
+
+
+def _validate_upload_stack(item):
+    # Entries without a name are skipped by merge_stacks, so only their shape is checked
+    if not isinstance(item, dict):
+        return "must be an object"
+    if item.get("name") is not None and not isinstance(item["name"], str):
+        return "name must be a string"
+    count = item.get("count", 1)
+    if isinstance(count, bool) or not isinstance(count, int):
+        return "count must be an integer"
+    return None
+
+
+# Body checks shared by the Flask views and their async twins in asgi.py;
+# each returns a client-facing error message or None.
+
+def validate_rfid_body(data):
+    if not data:
+        return "No data provided"
+    if not data.get("rfidUID"):
+        return "rfidUID is required"
+    return None
+
+
+def validate_stack_item(data, name_field):
+    """Body of add_creature_stacked ("creatureName") or add_loot_stacked ("lootName")."""
+    if not data:
+        return "No data provided"
+    if not data.get(name_field):
+        return f"Missing {name_field}"
+    return None
+
+
+def validate_purchase(data):
+    data = data or {}
+    if not data.get("rfidUID"):
+        return "rfidUID required"
+    return _validate_purchase_item(data)
+
+
+def _validate_purchase_item(item):
+    if not item.get("itemName"):
+        return "itemName required"
+    item_cost = item.get("itemCost")
+    if isinstance(item_cost, bool) or not isinstance(item_cost, (int, float)) or item_cost <= 0:
+        return "itemCost must be > 0"
+    return None
+
+
+def validate_cart(data):
+    """Body of purchase_cart: rfidUID and a list of {itemName, itemCost}."""
+    data = data or {}
+    if not data.get("rfidUID"):
+        return "rfidUID required"
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return "items must be a non-empty list"
+    if len(items) > PURCHASE_CART_MAX_ITEMS:
+        return f"items may hold at most {PURCHASE_CART_MAX_ITEMS} entries"
+    for index, item in enumerate(items):
+        error = _validate_purchase_item(item) if isinstance(item, dict) else "must be an object"
+        if error:
+            return f"items[{index}]: {error}"
+    return None
+
+
+def _journal():
+    conn = sqlite3.connect(app.config["INGEST_JOURNAL_PATH"], timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " rfid_uid TEXT NOT NULL,"
+        " payload TEXT NOT NULL,"
+        " received_at REAL NOT NULL,"
+        " claimed_by TEXT,"
+        " claimed_at REAL,"
+        " attempts INTEGER NOT NULL DEFAULT 0)"
+    )
+    if "attempts" not in {column[1] for column in conn.execute("PRAGMA table_info(uploads)")}:
+        try:
+            conn.execute("ALTER TABLE uploads ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass  # another process upgraded the journal first
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS dead_uploads ("
+        " id INTEGER PRIMARY KEY,"
+        " rfid_uid TEXT NOT NULL,"
+        " payload TEXT NOT NULL,"
+        " received_at REAL NOT NULL,"
+        " attempts INTEGER NOT NULL,"
+        " error TEXT NOT NULL,"
+        " failed_at REAL NOT NULL)"
+    )
+    # Row ids are only unique within one journal file; its id tells files (and hosts) apart
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('journal_id', ?)", (secrets.token_hex(8),))
+    return conn
+
+
+def journal_keys(rows):
+    """Applied-marker keys for journal rows, as recorded on the user."""
+    with closing(_journal()) as conn:
+        journal_id = conn.execute("SELECT value FROM meta WHERE key = 'journal_id'").fetchone()[0]
+    return [f"{journal_id}:{row[0]}" for row in rows]
+
+
+def with_journal_keys(update, keys):
+    """Add the journal keys an upload applies to an update document or pipeline."""
+    if not keys:
+        return update
+    if isinstance(update, list):
+        return update + [{"$set": {INGEST_APPLIED_FIELD: {"$slice": [
+            {"$concatArrays": [{"$ifNull": [f"${INGEST_APPLIED_FIELD}", []]}, {"$literal": list(keys)}]},
+            -INGEST_APPLIED_KEEP
+        ]}}}]
+    return {**update, "$push": {
+        **update.get("$push", {}), INGEST_APPLIED_FIELD: {"$each": list(keys), "$slice": -INGEST_APPLIED_KEEP}
+    }}
+
+
+def journal_append(data):
+    """Durably queue one stacked upload. Returns once the row is committed."""
+    payload = {
+        "addCoins": data.get("addCoins", 0),
+        "creatures": data.get("creatures", []),
+        "loot": data.get("loot", []),
+        "challengeCode": data.get("challengeCode", "")
+    }
+    with closing(_journal()) as conn:
+        conn.execute(
+            "INSERT INTO uploads (rfid_uid, payload, received_at) VALUES (?, ?, ?)",
+            (data["rfidUID"], json.dumps(payload), time.time())
+        )
+    _ingest_wakeup.set()
+
+
+def _journal_claim(worker_id, limit):
+    now = time.time()
+    with closing(_journal()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE uploads SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+            " SELECT id FROM uploads WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY id LIMIT ?)",
+            (worker_id, now, now - INGEST_CLAIM_TIMEOUT, limit)
+        )
+        rows = conn.execute(
+            "SELECT id, rfid_uid, payload, received_at FROM uploads WHERE claimed_by = ? AND claimed_at = ? ORDER BY id",
+            (worker_id, now)
+        ).fetchall()
+        conn.execute("COMMIT")
+    return rows
+
+
+def _journal_finish(ids, release=False):
+    """Delete applied rows, or hand them back to the queue when release is True.
+
+    Retried in place when the journal is locked by another worker; rows left
+    behind after the last attempt come round again after INGEST_CLAIM_TIMEOUT.
+    """
+    placeholders = ",".join("?" * len(ids))
+    for attempt in range(INGEST_FINISH_ATTEMPTS):
+        try:
+            with closing(_journal()) as conn:
+                if release:
+                    conn.execute(f"UPDATE uploads SET claimed_by = NULL, claimed_at = NULL WHERE id IN ({placeholders})", ids)
+                else:
+                    conn.execute(f"DELETE FROM uploads WHERE id IN ({placeholders})", ids)
+            return True
+        except sqlite3.OperationalError as e:
+            app.logger.warning(f"[ingest] Journal update for {len(ids)} rows failed (attempt {attempt + 1}): {str(e)}")
+            time.sleep(0.1 * 2 ** attempt)
+    return False
+
+
+def _journal_fail(ids, error, dead_letter=False):
+    """Count a failed attempt against rows and hand them back to the queue.
+
+    Rows that have now failed INGEST_MAX_ATTEMPTS times, or all of them when
+    dead_letter is True, move to dead_uploads instead.
+    """
+    placeholders = ",".join("?" * len(ids))
+    limit = 0 if dead_letter else INGEST_MAX_ATTEMPTS
+    with closing(_journal()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            f"UPDATE uploads SET attempts = attempts + 1, claimed_by = NULL, claimed_at = NULL WHERE id IN ({placeholders})",
+            ids
+        )
+        moved = conn.execute(
+            "INSERT INTO dead_uploads (id, rfid_uid, payload, received_at, attempts, error, failed_at)"
+            f" SELECT id, rfid_uid, payload, received_at, attempts, ?, ? FROM uploads WHERE id IN ({placeholders}) AND attempts >= ?",
+            (error, time.time(), *ids, limit)
+        ).rowcount
+        conn.execute(f"DELETE FROM uploads WHERE id IN ({placeholders}) AND attempts >= ?", (*ids, limit))
+        conn.execute("COMMIT")
+    if moved:
+        app.logger.error(f"[ingest] Moved {moved} queued uploads to dead_uploads: {error}")
+
+
+def coalesce_uploads(rows):
+    """Fold journal rows for one rfidUID into a single upload."""
+    add_coins = 0
+    creatures = []
+    loot = []
+    challenge_entries = []
+    for _, _, payload, received_at in rows:
+        upload = json.loads(payload)
+        if upload["addCoins"] > 0:
+            add_coins += upload["addCoins"]
+        creatures.extend(upload["creatures"])
+        loot.extend(upload["loot"])
+        if upload["challengeCode"]:
+            challenge_entries.append(
+                build_challenge_entry(upload["challengeCode"], datetime.datetime.utcfromtimestamp(received_at))
+            )
+    return add_coins, creatures, loot, challenge_entries
+
+
+def drain_journal(worker_id):
+    """Apply one batch of queued uploads. Returns how many journal rows were handled."""
+    rows = _journal_claim(worker_id, app.config["INGEST_BATCH_SIZE"])
+    by_student = OrderedDict()
+    for row in rows:
+        by_student.setdefault(row[1], []).append(row)
+
+    done = set()
+    batches = list(by_student.values())
+    while batches:
+        batch = batches.pop(0)
+        rfid_uid, ids = batch[0][1], [row[0] for row in batch]
+        try:
+            found = apply_journal_rows(rfid_uid, batch)
+        except (ConnectionFailure, sqlite3.OperationalError) as e:
+            app.logger.error(f"[ingest] Failed to apply {len(ids)} queued uploads for {rfid_uid}: {str(e)}")
+            # Mongo or the journal is unavailable, not the rows: hand back everything not yet applied
+            _journal_finish([row[0] for row in rows if row[0] not in done], release=True)
+            raise
+        except Exception as e:
+            if len(batch) > 1:
+                app.logger.warning(f"[ingest] Failed to apply {len(ids)} queued uploads for {rfid_uid}, retrying one at a time: {str(e)}")
+                batches[:0] = [[row] for row in batch]
+            else:
+                app.logger.error(f"[ingest] Failed to apply queued upload {ids[0]} for {rfid_uid}: {str(e)}")
+                _journal_fail(ids, str(e))
+                done.update(ids)
+            continue
+
+        if not found:
+            _journal_fail(ids, INGEST_UNKNOWN_RFID, dead_letter=True)
+        elif not _journal_finish(ids):
+            app.logger.error(f"[ingest] Could not delete {len(ids)} applied rows for {rfid_uid}; they will be skipped when reclaimed")
+        done.update(ids)
+
+        if found:
+            _ingest_stats["applied"] += 1
+            _ingest_stats["coalesced"] += len(ids)
+            _ingest_stats["lastLagSeconds"] = round(time.time() - min(row[3] for row in batch), 3)
+
+    _ingest_stats["lastDrainAt"] = datetime.datetime.utcnow()
+    return len(rows)
+
+
+def apply_journal_rows(rfid_uid, rows):
+    """Apply one student's journal rows, skipping any an earlier attempt already applied.
+
+    Returns False when no user has this rfidUID.
+    """
+    pending = rows
+    while pending:
+        keys = journal_keys(pending)
+        add_coins, creatures, loot, challenge_entries = coalesce_uploads(pending)
+        updated_user, _, _ = apply_stacked_upload(
+            rfid_uid, add_coins, creatures, loot, challenge_entries, projection={"_id": 1}, journal_keys=keys
+        )
+        if updated_user:
+            return True
+
+        user = mongo.db.Users.find_one({"rfidUID": rfid_uid}, {INGEST_APPLIED_FIELD: 1})
+        if not user:
+            app.logger.error(f"[ingest] {len(rows)} queued uploads for unknown RFID: {rfid_uid}")
+            return False
+        applied = set(user.get(INGEST_APPLIED_FIELD) or [])
+        remaining = [row for row, key in zip(pending, keys) if key not in applied]
+        if len(remaining) == len(pending):
+            raise RuntimeError("conditional ingest write matched no document")
+        app.logger.warning(f"[ingest] Skipping {len(pending) - len(remaining)} already applied uploads for {rfid_uid}")
+        pending = remaining
+    return True
+
+
+def ingest_worker():
+    """Background thread body: drain the journal forever."""
+    worker_id = f"{os.getpid()}-{threading.get_ident()}"
+    while True:
+        try:
+            if drain_journal(worker_id):
+                continue
+        except Exception:
+            # Mongo is unhappy; back off instead of spinning on the same rows
+            time.sleep(5)
+        _ingest_wakeup.wait(app.config["INGEST_POLL_SECONDS"])
+        _ingest_wakeup.clear()
+
+
+def queued_upload_response(data):
+    """202 acknowledgement for an upload that went to the journal."""
+    # Merged first so a body merge_stacks chokes on is never journaled
+    _, creatures_processed = merge_stacks(data.get("creatures", []), "creatures")
+    _, loot_processed = merge_stacks(data.get("loot", []), "loot")
+    journal_append(data)
+    return make_response(jsonify({
+        "message": "Stacked upload queued",
+        "queued": True,
+        "coinsAdded": data.get("addCoins", 0),
+        "creaturesProcessed": creatures_processed,
+        "lootProcessed": loot_processed,
+        "challengeCodeAdded": data.get("challengeCode") or None
+    }), 202)
+
+
+@app.route("/api/v1/ingest/status", methods=["GET"])
+@require_api_key_strict
+def ingest_status():
+    """Queue depth and lag of the write-behind journal."""
+    try:
+        if not app.config["ASYNC_INGEST"]:
+            return jsonify({"enabled": False}), 200
+
+        with closing(_journal()) as conn:
+            depth, claimed, oldest = conn.execute(
+                "SELECT COUNT(*), COUNT(claimed_by), MIN(received_at) FROM uploads"
+            ).fetchone()
+            dead, unknown = conn.execute(
+                "SELECT COUNT(*), COUNT(CASE WHEN error = ? THEN 1 END) FROM dead_uploads", (INGEST_UNKNOWN_RFID,)
+            ).fetchone()
+
+        last_drain = _ingest_stats["lastDrainAt"]
+        return jsonify({
+            "enabled": True,
+            "depth": depth,
+            "claimed": claimed,
+            "oldestAgeSeconds": round(time.time() - oldest, 3) if oldest else 0,
+            "deadLettered": dead,
+            "deadLetteredUnknownRfid": unknown,
+            "lastLagSeconds": _ingest_stats["lastLagSeconds"],
+            "lastDrainAt": last_drain.isoformat() + "Z" if last_drain else None,
+            "studentsApplied": _ingest_stats["applied"],
+            "uploadsCoalesced": _ingest_stats["coalesced"]
+        }), 200
+
+    except Exception as e:
+        app.logger.error(f"Error in ingest_status: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
 # Add this new endpoint for adding creatures with stacking
 @app.route("/api/v1/users/<rfidUID>/add_creature_stacked", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_creature_stacked(rfidUID):
     try:
         data = request.json
-        if not data:
-            return make_response(jsonify({"error": "No data provided"}), 400)
+        error = validate_stack_item(data, "creatureName")
+        if error:
+            return make_response(jsonify({"error": error}), 400)
         
         creature_name = data.get("creatureName")
         creature_value = data.get("creatureValue", 1)
         count_to_add = data.get("count", 1)
 
-        if not creature_name:
-            return make_response(jsonify({"error": "Missing creatureName"}), 400)
-
-        # Check if creature already exists in user's collection
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
+        # Existing stacks are incremented and new ones appended in a single write
+        projection, changed = post_image_projection(["coins", "mainCreature", "creatures"], creatures=[creature_name])
+        updated_user, _, _ = apply_stacked_upload(
+            rfidUID,
+            creatures=[{"name": creature_name, "value": creature_value, "count": count_to_add}],
+            projection=projection
+        )
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        # Find existing creature
-        existing_creature = None
-        for i, creature in enumerate(user.get("creatures", [])):
-            if creature.get("name") == creature_name:
-                existing_creature = {"creature": creature, "index": i}
-                break
-
-        if existing_creature:
-            # Increment existing creature count
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID, "creatures.name": creature_name},
-                {"$inc": {"creatures.$.count": count_to_add}}
-            )
-        else:
-            # Add new creature with count
-            new_creature = {
-                "name": creature_name,
-                "value": creature_value,
-                "count": count_to_add
-            }
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID},
-                {"$push": {"creatures": new_creature}}
-            )
-
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "Failed to update creature"}), 500)
-
-        return jsonify({"message": f"Added {count_to_add} {creature_name}(s) successfully"}), 200
+        return jsonify({
+            "message": f"Added {count_to_add} {creature_name}(s) successfully",
+            "user": user_slice(updated_user, changed)
+        }), 200
 
     except Exception as e:
         app.logger.error(f"Error adding stacked creature: {str(e)}")
@@ -681,52 +3504,31 @@ def add_creature_stacked(rfidUID):
 # Add this new endpoint for adding loot/resources with stacking
 @app.route("/api/v1/users/<rfidUID>/add_loot_stacked", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_loot_stacked(rfidUID):
     try:
         data = request.json
-        if not data:
-            return make_response(jsonify({"error": "No data provided"}), 400)
+        error = validate_stack_item(data, "lootName")
+        if error:
+            return make_response(jsonify({"error": error}), 400)
         
         loot_name = data.get("lootName")
         count_to_add = data.get("count", 1)
 
-        if not loot_name:
-            return make_response(jsonify({"error": "Missing lootName"}), 400)
-
-        # Check if loot already exists in user's collection
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
+        # Existing stacks are incremented and new ones appended in a single write
+        projection, changed = post_image_projection(["coins", "loot"], loot=[loot_name])
+        updated_user, _, _ = apply_stacked_upload(
+            rfidUID,
+            loot=[{"name": loot_name, "count": count_to_add}],
+            projection=projection
+        )
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        # Find existing loot
-        existing_loot = None
-        for i, loot in enumerate(user.get("loot", [])):
-            if loot.get("name") == loot_name:
-                existing_loot = {"loot": loot, "index": i}
-                break
-
-        if existing_loot:
-            # Increment existing loot count
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID, "loot.name": loot_name},
-                {"$inc": {"loot.$.count": count_to_add}}
-            )
-        else:
-            # Add new loot with count
-            new_loot = {
-                "name": loot_name,
-                "count": count_to_add,
-                "type": "loot"
-            }
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID},
-                {"$push": {"loot": new_loot}}
-            )
-
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "Failed to update loot"}), 500)
-
-        return jsonify({"message": f"Added {count_to_add} {loot_name}(s) successfully"}), 200
+        return jsonify({
+            "message": f"Added {count_to_add} {loot_name}(s) successfully",
+            "user": user_slice(updated_user, changed)
+        }), 200
 
     except Exception as e:
         app.logger.error(f"Error adding stacked loot: {str(e)}")
@@ -735,136 +3537,52 @@ def add_loot_stacked(rfidUID):
 # Update the complete loot upload endpoint to handle stacking
 @app.route("/api/v1/complete_loot_upload_stacked", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def complete_loot_upload_stacked():
     try:
-        data = request.json
-        app.logger.info(f"[complete_loot_upload_stacked] Received data: {data}")
-        
-        rfid_uid = data.get('rfidUID')
-        add_coins = data.get('addCoins', 0)
-        creatures = data.get('creatures', [])
-        loot = data.get('loot', [])
-        
-        app.logger.info(f"[complete_loot_upload_stacked] Processing - RFID: {rfid_uid}, Coins: {add_coins}")
-        app.logger.info(f"[complete_loot_upload_stacked] Creatures: {creatures}")
-        app.logger.info(f"[complete_loot_upload_stacked] Loot: {loot}")
-        
-        user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
-        if not user:
-            app.logger.error(f"[complete_loot_upload_stacked] User not found for RFID: {rfid_uid}")
-            return make_response(jsonify({"error": "User not found"}), 404)
-        
-        app.logger.info(f"[complete_loot_upload_stacked] Found user: {user['name']}")
-        
-        creatures_processed = 0
-        loot_processed = 0
-        
-        # Process creatures with stacking
-        for creature_data in creatures:
-            creature_name = creature_data.get("name")
-            creature_value = creature_data.get("value", 1)
-            count = creature_data.get("count", 1)
-            
-            app.logger.info(f"[complete_loot_upload_stacked] Processing creature: {creature_name}, value: {creature_value}, count: {count}")
-            
-            if not creature_name:
-                app.logger.warning(f"[complete_loot_upload_stacked] Skipping creature with no name: {creature_data}")
-                continue
-                
-            # Check if creature already exists
-            existing_creature = mongo.db.Users.find_one(
-                {"rfidUID": rfid_uid, "creatures.name": creature_name}
-            )
-            
-            if existing_creature:
-                app.logger.info(f"[complete_loot_upload_stacked] Incrementing existing creature {creature_name} by {count}")
-                # Increment count
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid, "creatures.name": creature_name},
-                    {"$inc": {"creatures.$.count": count}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked] Creature increment result: {result.modified_count}")
-            else:
-                app.logger.info(f"[complete_loot_upload_stacked] Adding new creature {creature_name} with count {count}")
-                # Add new creature
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid},
-                    {"$push": {"creatures": {
-                        "name": creature_name,
-                        "value": creature_value,
-                        "count": count
-                    }}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked] New creature result: {result.modified_count}")
-            
-            creatures_processed += 1
+        data = request.json
+        app.logger.debug("[complete_loot_upload_stacked] Received data: %s", data)
         
-        # Process loot with stacking
-        for loot_data in loot:
-            loot_name = loot_data.get("name")
-            count = loot_data.get("count", 1)
-            
-            app.logger.info(f"[complete_loot_upload_stacked] Processing loot: {loot_name}, count: {count}")
-            
-            if not loot_name:
-                app.logger.warning(f"[complete_loot_upload_stacked] Skipping loot with no name: {loot_data}")
-                continue
-            
-            # Check if loot already exists
-            existing_loot = mongo.db.Users.find_one(
-                {"rfidUID": rfid_uid, "loot.name": loot_name}
-            )
-            
-            if existing_loot:
-                app.logger.info(f"[complete_loot_upload_stacked] Incrementing existing loot {loot_name} by {count}")
-                # Increment count
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid, "loot.name": loot_name},
-                    {"$inc": {"loot.$.count": count}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked] Loot increment result: {result.modified_count}")
-            else:
-                app.logger.info(f"[complete_loot_upload_stacked] Adding new loot {loot_name} with count {count}")
-                # Add new loot
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid},
-                    {"$push": {"loot": {
-                        "name": loot_name,
-                        "count": count,
-                        "type": "loot"
-                    }}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked] New loot result: {result.modified_count}")
-            
-            loot_processed += 1
+        error = validate_stacked_upload(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
+        if app.config["ASYNC_INGEST"]:
+            return queued_upload_response(data)
         
-        # Add coins
-        if add_coins > 0:
-            app.logger.info(f"[complete_loot_upload_stacked] Adding {add_coins} coins")
-            coin_result = mongo.db.Users.update_one(
-                {"rfidUID": rfid_uid},
-                {"$inc": {"coins": add_coins}}
-            )
-            app.logger.info(f"[complete_loot_upload_stacked] Coin update result: {coin_result.modified_count}")
+        rfid_uid = data.get('rfidUID')
+        add_coins = data.get('addCoins', 0)
+        creatures = data.get('creatures', [])
+        loot = data.get('loot', [])
+        log_fields(rfid=rfid_uid, coins=add_coins, creatures=len(creatures), loot=len(loot))
         
-        updated_user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
+        projection, changed = post_image_projection(
+            ["name", "coins", "creatures", "loot"], creatures=stack_names(creatures), loot=stack_names(loot)
+        )
+        updated_user, creatures_processed, loot_processed = apply_stacked_upload(
+            rfid_uid, add_coins, creatures, loot, projection=projection
+        )
+        if not updated_user:
+            app.logger.warning("[complete_loot_upload_stacked] User not found for RFID: %s", rfid_uid)
+            return make_response(jsonify({"error": "User not found"}), 404)
         
-        app.logger.info(f"[complete_loot_upload_stacked] FINAL RESULT - User: {user['name']}, Creatures processed: {creatures_processed}, Loot processed: {loot_processed}, Total coins: {updated_user.get('coins', 0)}")
+        log_fields(user=updated_user.get("name"), totalCoins=updated_user.get("coins", 0))
         
         return make_response(jsonify({
             "message": "Stacked upload successful",
             "coinsAdded": add_coins,
             "creaturesProcessed": creatures_processed,
             "lootProcessed": loot_processed,
-            "totalCoins": updated_user.get("coins", 0)
+            "totalCoins": updated_user.get("coins", 0),
+            "user": user_slice(updated_user, changed)
         }), 200)
         
     except Exception as e:
-        app.logger.error(f"[complete_loot_upload_stacked] ERROR: {str(e)}")
+        app.logger.error("[complete_loot_upload_stacked] ERROR: %s", e)
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
 @app.route("/api/v1/users/<rfidUID>/set_main_creature_stacked", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def set_main_creature_stacked(rfidUID):
     try:
         data = request.json
@@ -875,43 +3593,47 @@ def set_main_creature_stacked(rfidUID):
         if not creature_name:
             return make_response(jsonify({"error": "creatureName is required"}), 400)
 
-        # First, check if user exists
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
-            return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
+        projection, changed = post_image_projection(["coins", "mainCreature", "creatures"], creatures=[creature_name])
 
-        # Set the main creature
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$set": {"mainCreature": creature_name}}
-        )
+        if keyed_inventory():
+            user = mongo.db.Users.find_one({"rfidUID": rfidUID})
+            if not user:
+                return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
+            if "inventory" not in user and migrate_user_inventory({"rfidUID": rfidUID}):
+                user = mongo.db.Users.find_one({"rfidUID": rfidUID})
+
+            # Set the main creature and take one off its stack, dropping the stack at zero
+            update = {"$set": {"mainCreature": creature_name}}
+            stack = ((user.get("inventory") or {}).get("creatures") or {}).get(inventory_key(creature_name))
+            if stack:
+                path = inventory_path("creatures", creature_name)
+                if stack.get("count", 1) > 1:
+                    update["$inc"] = {f"{path}.count": -1}
+                else:
+                    update["$unset"] = {path: ""}
+                update = with_summary(update, summary_inc(creatures=-1))
+            updated_user = update_user(rfidUID, update, projection)
+        else:
+            # Set the main creature and take one off its stack, dropping the stack at zero
+            # Ownership is checked against the creatures the stage starts from
+            owned = {"$in": [{"$literal": creature_name}, {"$ifNull": ["$creatures.name", []]}]}
+            updated_user = update_user(
+                rfidUID,
+                [{"$set": {
+                    "mainCreature": {"$literal": creature_name},
+                    "creatures": _stack_take_one_expr("creatures", creature_name),
+                    "summary.creatures": {"$add": [{"$ifNull": ["$summary.creatures", 0]}, {"$cond": [owned, -1, 0]}]}
+                }}],
+                projection
+            )
 
-        # Find the creature and decrement its count
-        creature_exists = mongo.db.Users.find_one(
-            {"rfidUID": rfidUID, "creatures.name": creature_name}
-        )
-        
-        if creature_exists:
-            # Find the specific creature in the array
-            for creature in creature_exists.get("creatures", []):
-                if creature.get("name") == creature_name:
-                    current_count = creature.get("count", 1)
-                    
-                    if current_count > 1:
-                        # Decrement count
-                        mongo.db.Users.update_one(
-                            {"rfidUID": rfidUID, "creatures.name": creature_name},
-                            {"$inc": {"creatures.$.count": -1}}
-                        )
-                    else:
-                        # Remove creature entirely if count would be 0
-                        mongo.db.Users.update_one(
-                            {"rfidUID": rfidUID},
-                            {"$pull": {"creatures": {"name": creature_name}}}
-                        )
-                    break
-
-        return jsonify({"message": "Main creature set and count decremented"}), 200
+        if not updated_user:
+            return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
+
+        return jsonify({
+            "message": "Main creature set and count decremented",
+            "user": user_slice(updated_user, changed)
+        }), 200
 
     except Exception as e:
         app.logger.error(f"Error setting main creature with stacking: {str(e)}")
@@ -1003,9 +3725,8 @@ def login_teacher():
         if teacher.get("password") != password:
             return make_response(jsonify({"error": "Invalid email or password"}), 401)
 
-        # Generate simple token (in production, use JWT)
         teacher_id = str(teacher["_id"])
-        token = f"teacher_{teacher_id}_{teacher['email']}"  # Simple token for now
+        token, expires_at = issue_teacher_token(teacher_id)
 
         app.logger.info(f"Teacher logged in: {teacher['name']} ({email})")
 
@@ -1013,6 +3734,7 @@ def login_teacher():
             "message": "Login successful",
             "teacherId": teacher_id,
             "token": token,
+            "expiresAt": expires_at.isoformat() + "Z",
             "name": teacher["name"],
             "school": teacher["school"]
         }), 200
@@ -1032,20 +3754,18 @@ def get_teacher_classes(teacher_id):
         if not teacher:
             return make_response(jsonify({"error": "Teacher not found"}), 404)
 
-        # Get unique classes from their school
-        # This finds all unique playerClass values from students in the same school
-        pipeline = [
-            {"$match": {"playerClass": {"$regex": f"^{teacher['school']}"}}},
-            {"$group": {"_id": "$playerClass"}},
-            {"$sort": {"_id": 1}}
-        ]
-        
-        classes = list(mongo.db.Users.aggregate(pipeline))
-        
+        # The school is part of the tag as the class list is filtered by it
+        etag = version_etag(*read_versions(CLASS_LIST_VERSION_ID), teacher.get("school"))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        # Classes from their school, by the school part of the teacher's school name
+        classes = listed_classes({"school": class_school(teacher["school"])})
+
         # Format classes for dropdown
         formatted_classes = []
-        for cls in classes:
-            class_name = cls["_id"]
+        for class_name in classes:
             # Create ID by replacing spaces/slashes with hyphens
             class_id = class_name.replace(" / ", "-").replace(" ", "-")
             formatted_classes.append({
@@ -1061,7 +3781,7 @@ def get_teacher_classes(teacher_id):
                 {"id": f"{school_name} / Kauri", "name": f"{school_name} / Kauri"}
             ]
 
-        return jsonify(formatted_classes), 200
+        return with_etag(jsonify(formatted_classes), etag), 200
 
     except Exception as e:
         app.logger.error(f"Error getting teacher classes: {str(e)}")
@@ -1070,6 +3790,7 @@ def get_teacher_classes(teacher_id):
 
 @app.route("/api/v1/teachers/<teacher_id>/classes/<path:class_id>/students", methods=["GET"])
 @require_api_key_optional
+@compression(gzip=6, br=5)
 def get_class_students(teacher_id, class_id):
     """Get all students in a specific class"""
     try:
@@ -1082,15 +3803,22 @@ def get_class_students(teacher_id, class_id):
         from urllib.parse import unquote
         class_name = unquote(class_id)
 
-        # ✅ FIX: Include rfidUID in the response
-        students = mongo.db.Users.find(
-            {"playerClass": class_name},
-            {"_id": 0, "name": 1, "coins": 1, "mainCreature": 1, "playerClass": 1, "creatures": 1, "artifacts": 1, "rfidUID": 1}  # ✅ Added rfidUID
-        )
+        # ?fields= and ?profile= name user fields; each summary key comes from one of them
+        try:
+            fields = selected_fields(tuple(STUDENT_SUMMARY_SOURCES.values()))
+        except ValueError as e:
+            return make_response(jsonify({"error": str(e)}), 400)
+
+        version, = read_versions(class_version_id(class_name))
+        etag = version_etag(version)
+        cached = not_modified(etag)
+        if cached:
+            return cached
 
         students_list = []
-        for student in students:
-            students_list.append({
+        # Sort by coins (leaderboard style)
+        for student in sorted(class_roster(class_name, version), key=lambda x: x.get("coins", 0), reverse=True):
+            summary = {
                 "name": student.get("name", "Unknown"),
                 "coins": student.get("coins", 0),
                 "mainPet": student.get("mainCreature", "None"),
@@ -1098,14 +3826,14 @@ def get_class_students(teacher_id, class_id):
                 "totalCreatures": len(student.get("creatures", [])),
                 "totalArtifacts": len(student.get("artifacts", [])),
                 "rfidUID": student.get("rfidUID", "")  # ✅ Added this line
-            })
-
-        # Sort by coins (leaderboard style)
-        students_list.sort(key=lambda x: x["coins"], reverse=True)
+            }
+            if fields is not None:
+                summary = {key: value for key, value in summary.items() if STUDENT_SUMMARY_SOURCES[key] in fields}
+            students_list.append(summary)
 
         app.logger.info(f"Teacher {teacher['name']} viewing class {class_name}: {len(students_list)} students")
 
-        return jsonify(students_list), 200
+        return with_etag(jsonify(students_list), etag), 200
 
     except Exception as e:
         app.logger.error(f"Error getting class students: {str(e)}")
@@ -1118,17 +3846,8 @@ def get_class_students(teacher_id, class_id):
 def get_teacher_profile_classes():
     """Get all available classes from students in the database"""
     try:
-        # Get all unique playerClass values from the Users collection
-        pipeline = [
-            {"$group": {"_id": "$playerClass"}},
-            {"$match": {"_id": {"$ne": None}}},
-            {"$sort": {"_id": 1}}
-        ]
-        
-        classes = list(mongo.db.Users.aggregate(pipeline))
-        
-        # Extract just the class names as strings
-        formatted_classes = [cls["_id"] for cls in classes]
+        # Class names from the registry
+        formatted_classes = listed_classes()
         
         # If no classes found in DB, return defaults
         if not formatted_classes:
@@ -1180,52 +3899,31 @@ def get_teacher_by_id(teacher_id):
 
 @app.route("/api/v1/users/<rfidUID>/add_loot_stacked_v2", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def add_loot_stacked_v2(rfidUID):
     try:
         data = request.json
-        if not data:
-            return make_response(jsonify({"error": "No data provided"}), 400)
+        error = validate_stack_item(data, "lootName")
+        if error:
+            return make_response(jsonify({"error": error}), 400)
         
         loot_name = data.get("lootName")
         count_to_add = data.get("count", 1)
 
-        if not loot_name:
-            return make_response(jsonify({"error": "Missing lootName"}), 400)
-
-        # Check if loot already exists in user's collection
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
+        # Existing stacks are incremented and new ones appended in a single write
+        projection, changed = post_image_projection(["coins", "loot"], loot=[loot_name])
+        updated_user, _, _ = apply_stacked_upload(
+            rfidUID,
+            loot=[{"name": loot_name, "count": count_to_add}],
+            projection=projection
+        )
+        if not updated_user:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        # Find existing loot
-        existing_loot = None
-        for i, loot in enumerate(user.get("loot", [])):
-            if loot.get("name") == loot_name:
-                existing_loot = {"loot": loot, "index": i}
-                break
-
-        if existing_loot:
-            # Increment existing loot count
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID, "loot.name": loot_name},
-                {"$inc": {"loot.$.count": count_to_add}}
-            )
-        else:
-            # Add new loot with count
-            new_loot = {
-                "name": loot_name,
-                "count": count_to_add,
-                "type": "loot"
-            }
-            result = mongo.db.Users.update_one(
-                {"rfidUID": rfidUID},
-                {"$push": {"loot": new_loot}}
-            )
-
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "Failed to update loot"}), 500)
-
-        return jsonify({"message": f"Added {count_to_add} {loot_name}(s) successfully"}), 200
+        return jsonify({
+            "message": f"Added {count_to_add} {loot_name}(s) successfully",
+            "user": user_slice(updated_user, changed)
+        }), 200
 
     except Exception as e:
         app.logger.error(f"Error adding stacked loot: {str(e)}")
@@ -1234,196 +3932,227 @@ def add_loot_stacked_v2(rfidUID):
 # Update the complete loot upload endpoint to handle stacking
 @app.route("/api/v1/complete_loot_upload_stacked_v2", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def complete_loot_upload_stacked_v2():
     try:
         data = request.json
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Received data: {data}")
+        app.logger.debug("[complete_loot_upload_stacked_v2] Received data: %s", data)
+        
+        error = validate_stacked_upload(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
+        if app.config["ASYNC_INGEST"]:
+            return queued_upload_response(data)
         
         rfid_uid = data.get('rfidUID')
         add_coins = data.get('addCoins', 0)
         creatures = data.get('creatures', [])
         loot = data.get('loot', [])
-        challenge_code = data.get('challengeCode', '')  # ✅ ADD THIS LINE
+        challenge_code = data.get('challengeCode', '')
+        log_fields(rfid=rfid_uid, coins=add_coins, creatures=len(creatures), loot=len(loot), challenge=challenge_code or None)
         
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Processing - RFID: {rfid_uid}, Coins: {add_coins}")
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Challenge Code: {challenge_code}")  # ✅ ADD THIS LINE
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Creatures: {creatures}")
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Loot: {loot}")
-        
-        user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
-        if not user:
-            app.logger.error(f"[complete_loot_upload_stacked_v2] User not found for RFID: {rfid_uid}")
+        # Stacks, coins and the challenge code entry all land in one atomic write
+        challenge_entries = [build_challenge_entry(challenge_code)] if challenge_code else []
+        projection, changed = post_image_projection(
+            ["name", "coins", "creatures", "loot", "challengeCodes"],
+            creatures=stack_names(creatures), loot=stack_names(loot), pushed=["challengeCodes"]
+        )
+        updated_user, creatures_processed, loot_processed = apply_stacked_upload(
+            rfid_uid, add_coins, creatures, loot, challenge_entries, projection=projection
+        )
+        if not updated_user:
+            app.logger.warning("[complete_loot_upload_stacked_v2] User not found for RFID: %s", rfid_uid)
             return make_response(jsonify({"error": "User not found"}), 404)
         
-        app.logger.info(f"[complete_loot_upload_stacked_v2] Found user: {user['name']}")
-        
-        creatures_processed = 0
-        loot_processed = 0
-        
-        # Process creatures with stacking
-        for creature_data in creatures:
-            creature_name = creature_data.get("name")
-            creature_value = creature_data.get("value", 1)
-            count = creature_data.get("count", 1)
-            
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Processing creature: {creature_name}, value: {creature_value}, count: {count}")
-            
-            if not creature_name:
-                app.logger.warning(f"[complete_loot_upload_stacked_v2] Skipping creature with no name: {creature_data}")
-                continue
-                
-            # Check if creature already exists
-            existing_creature = mongo.db.Users.find_one(
-                {"rfidUID": rfid_uid, "creatures.name": creature_name}
-            )
-            
-            if existing_creature:
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Incrementing existing creature {creature_name} by {count}")
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid, "creatures.name": creature_name},
-                    {"$inc": {"creatures.$.count": count}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Creature increment result: {result.modified_count}")
-            else:
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Adding new creature {creature_name} with count {count}")
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid},
-                    {"$push": {"creatures": {
-                        "name": creature_name,
-                        "value": creature_value,
-                        "count": count
-                    }}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked_v2] New creature result: {result.modified_count}")
-            
-            creatures_processed += 1
-        
-        # Process loot with stacking (existing code)
-        for loot_data in loot:
-            loot_name = loot_data.get("name")
-            count = loot_data.get("count", 1)
-            
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Processing loot: {loot_name}, count: {count}")
-            
-            if not loot_name:
-                app.logger.warning(f"[complete_loot_upload_stacked_v2] Skipping loot with no name: {loot_data}")
-                continue
-            
-            # Check if loot already exists
-            existing_loot = mongo.db.Users.find_one(
-                {"rfidUID": rfid_uid, "loot.name": loot_name}
-            )
-            
-            if existing_loot:
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Incrementing existing loot {loot_name} by {count}")
-                # Increment count
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid, "loot.name": loot_name},
-                    {"$inc": {"loot.$.count": count}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Loot increment result: {result.modified_count}")
-            else:
-                app.logger.info(f"[complete_loot_upload_stacked_v2] Adding new loot {loot_name} with count {count}")
-                # Add new loot
-                result = mongo.db.Users.update_one(
-                    {"rfidUID": rfid_uid},
-                    {"$push": {"loot": {
-                        "name": loot_name,
-                        "count": count,
-                        "type": "loot"
-                    }}}
-                )
-                app.logger.info(f"[complete_loot_upload_stacked_v2] New loot result: {result.modified_count}")
-            
-            loot_processed += 1
-        
-        # Add coins
-        if add_coins > 0:
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Adding {add_coins} coins")
-            coin_result = mongo.db.Users.update_one(
-                {"rfidUID": rfid_uid},
-                {"$inc": {"coins": add_coins}}
-            )
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Coin update result: {coin_result.modified_count}")
-        
-        # ✅ ADD THIS SECTION - Store challenge code in array
-        if challenge_code and challenge_code != '':
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Adding challenge code to array: {challenge_code}")
-            
-            # Add challenge code to challengeCodes array
-            # Format: { "code": "1115", "digit": 5, "timestamp": datetime }
-            # Extract the last digit (lives remaining)
-            lives_remaining = int(challenge_code[-1]) if challenge_code[-1].isdigit() else 0
-            base_code = challenge_code[:-1] if len(challenge_code) > 1 else challenge_code
-            
-            challenge_entry = {
-                "code": challenge_code,      # Full code (e.g., "1115")
-                "baseCode": base_code,       # Just the code part (e.g., "111")
-                "livesRemaining": lives_remaining,  # Last digit (e.g., 5)
-                "timestamp": datetime.datetime.utcnow()
-            }
-            
-            challenge_result = mongo.db.Users.update_one(
-                {"rfidUID": rfid_uid},
-                {"$push": {"challengeCodes": challenge_entry}}
-            )
-            app.logger.info(f"[complete_loot_upload_stacked_v2] Challenge code added: {challenge_result.modified_count}")
-        
-        updated_user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
-        
-        app.logger.info(f"[complete_loot_upload_stacked_v2] FINAL RESULT - User: {user['name']}, Creatures processed: {creatures_processed}, Loot processed: {loot_processed}, Total coins: {updated_user.get('coins', 0)}")
+        log_fields(user=updated_user.get("name"), totalCoins=updated_user.get("coins", 0))
         
         return make_response(jsonify({
             "message": "Stacked upload successful",
             "coinsAdded": add_coins,
             "creaturesProcessed": creatures_processed,
             "lootProcessed": loot_processed,
-            "challengeCodeAdded": challenge_code if challenge_code else None,  # ✅ ADD THIS LINE
-            "totalCoins": updated_user.get("coins", 0)
+            "challengeCodeAdded": challenge_code if challenge_code else None,
+            "totalCoins": updated_user.get("coins", 0),
+            "user": user_slice(updated_user, changed)
         }), 200)
         
     except Exception as e:
-        app.logger.error(f"[complete_loot_upload_stacked_v2] ERROR: {str(e)}")
-        import traceback
-        app.logger.error(f"[complete_loot_upload_stacked_v2] TRACEBACK: {traceback.format_exc()}")
+        app.logger.error("[complete_loot_upload_stacked_v2] ERROR: %s", e)
+        app.logger.error("[complete_loot_upload_stacked_v2] TRACEBACK: %s", traceback.format_exc())
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
+# ==========================================
+# TEACHER TOKENS
+# ==========================================
+# login_teacher issues "<kid>.<claims>.<signature>" tokens: base64url JSON
+# claims (teacher id, expiry, token id) signed with HMAC-SHA256 under the
+# key named by kid. require_teacher_token checks them without touching
+# Mongo. TEACHER_TOKEN_KEYS is "kid:secret,kid:secret"; the first key signs
+# and every listed key verifies, so a key is rotated by putting its
+# replacement first and removing it once the TTL has passed. Logged-out
+# token ids go to RevokedTokens (expired by TTL) and each worker keeps the
+# unexpired ones in memory, refreshed every TEACHER_REVOCATION_REFRESH_SECONDS.
+
+TEACHER_REVOCATION_REFRESH_SECONDS = 30
+
+_revoked_token_ids = set()
+_revoked_lock = threading.Lock()
+
+
+def _teacher_token_keys():
+    """[(kid, secret bytes)], signing key first."""
+    keys = []
+    for part in app.config["TEACHER_TOKEN_KEYS"].split(","):
+        kid, _, secret = part.strip().partition(":")
+        if kid and secret:
+            keys.append((kid, secret.encode()))
+    if not keys and os.getenv('API_KEY'):
+        # Unconfigured deployments still get a secret every worker shares
+        keys.append(("api", hmac.new(os.getenv('API_KEY').encode(), b"teacher-token", hashlib.sha256).digest()))
+    return keys
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _token_signature(secret, kid, claims):
+    return _b64encode(hmac.new(secret, f"{kid}.{claims}".encode(), hashlib.sha256).digest())
+
+
+def issue_teacher_token(teacher_id):
+    """(token, expiry datetime) for a teacher."""
+    keys = _teacher_token_keys()
+    if not keys:
+        raise RuntimeError("TEACHER_TOKEN_KEYS (or API_KEY) must be set to issue teacher tokens")
+    kid, secret = keys[0]
+    expires_at = int(time.time()) + app.config["TEACHER_TOKEN_TTL_SECONDS"]
+    claims = _b64encode(json.dumps(
+        {"sub": teacher_id, "exp": expires_at, "jti": secrets.token_urlsafe(12)}, separators=(",", ":")
+    ).encode())
+    token = f"{kid}.{claims}.{_token_signature(secret, kid, claims)}"
+    return token, datetime.datetime.utcfromtimestamp(expires_at)
+
+
+def verify_teacher_token(token):
+    """The token's claims, or None if it is malformed, forged, expired or revoked."""
+    try:
+        kid, claims, signature = token.split(".")
+    except ValueError:
+        return None
+    secret = dict(_teacher_token_keys()).get(kid)
+    if secret is None or not hmac.compare_digest(signature, _token_signature(secret, kid, claims)):
+        return None
+    try:
+        payload = json.loads(_b64decode(claims))
+    except ValueError:
+        return None
+    if not isinstance(payload, dict) or payload.get("exp", 0) < time.time():
+        return None
+    with _revoked_lock:
+        if payload.get("jti") in _revoked_token_ids:
+            return None
+    return payload
+
+
+def revoke_teacher_token(payload):
+    _ensure_revoked_index()
+    mongo.db.RevokedTokens.update_one(
+        {"_id": payload["jti"]},
+        {"$set": {"expiresAt": datetime.datetime.utcfromtimestamp(payload["exp"])}},
+        upsert=True
+    )
+    with _revoked_lock:
+        _revoked_token_ids.add(payload["jti"])
+
+
+_revoked_index_ready = False
+
+
+def _ensure_revoked_index():
+    global _revoked_index_ready
+    if not _revoked_index_ready:
+        sync_indexes("RevokedTokens")
+        _revoked_index_ready = True
+
+
+def revocation_refresher():
+    """Background thread body: follow token revocations made by other workers."""
+    while True:
+        try:
+            # The TTL monitor runs once a minute, so filter out the just-expired too
+            now = datetime.datetime.utcnow()
+            revoked = {doc["_id"] for doc in mongo.db.RevokedTokens.find({"expiresAt": {"$gt": now}}, {"_id": 1})}
+            with _revoked_lock:
+                _revoked_token_ids.clear()
+                _revoked_token_ids.update(revoked)
+        except Exception as e:
+            app.logger.warning("Could not refresh revoked teacher tokens: %s", e)
+        time.sleep(TEACHER_REVOCATION_REFRESH_SECONDS)
+
+
+def _legacy_teacher_token_valid(token, teacher_id):
+    """Pre-signing 'teacher_<id>_<email>' tokens, accepted while TEACHER_LEGACY_TOKENS is on."""
+    try:
+        teacher = mongo.db.Teachers.find_one({"_id": ObjectId(teacher_id)}, {"email": 1})
+    except Exception:
+        return False
+    return bool(teacher) and token == f"teacher_{teacher_id}_{teacher.get('email')}"
+
+
+def request_teacher_token():
+    """The token from Authorization ("Bearer <token>" or bare) or X-Teacher-Token, or None."""
+    auth = request.headers.get('Authorization') or request.headers.get('X-Teacher-Token')
+    return auth.split(' ').pop() if auth else None
+
+
 def require_teacher_token(f):
-    """Validate simple teacher token returned at login: 'teacher_<id>_<email>'"""
+    """Validate the signed teacher token returned at login against the teacher id in the path"""
     @wraps(f)
     def decorated(*args, **kwargs):
         # ✅ Allow OPTIONS requests (CORS preflight)
         if request.method == 'OPTIONS':
             return make_response('', 204)
             
-        auth = request.headers.get('Authorization') or request.headers.get('X-Teacher-Token')
-        if not auth:
+        token = request_teacher_token()
+        if not token:
             return make_response(jsonify({"error": "Authorization header required"}), 401)
-        
-        # Accept "Bearer <token>" or raw token
-        token = auth.split(' ').pop()
         teacher_id = kwargs.get('teacher_id') or kwargs.get('teacherId') or None
         if not teacher_id:
             return make_response(jsonify({"error": "Teacher id required in path"}), 400)
 
-        # Find teacher and validate token matches simple format
-        try:
-            teacher = mongo.db.Teachers.find_one({"_id": ObjectId(teacher_id)})
-        except:
-            return make_response(jsonify({"error": "Invalid teacher ID"}), 400)
-            
-        if not teacher:
-            return make_response(jsonify({"error": "Teacher not found"}), 404)
-
-        expected = f"teacher_{teacher_id}_{teacher.get('email')}"
-        if token != expected:
-            return make_response(jsonify({"error": "Invalid teacher token"}), 401)
+        payload = verify_teacher_token(token)
+        if payload is None or payload.get("sub") != teacher_id:
+            if not (app.config["TEACHER_LEGACY_TOKENS"] and _legacy_teacher_token_valid(token, teacher_id)):
+                return make_response(jsonify({"error": "Invalid teacher token"}), 401)
+        g.teacher_token = payload
 
         return f(*args, **kwargs)
     return decorated
 
+
+@app.route("/api/v1/teachers/<teacher_id>/logout", methods=["POST"])
+@require_teacher_token
+def logout_teacher(teacher_id):
+    """Revoke the token this request was made with"""
+    try:
+        if not g.teacher_token:
+            # Legacy tokens carry no jti to revoke; they stay valid until TEACHER_LEGACY_TOKENS is turned off
+            return make_response(jsonify({"error": "Legacy teacher tokens cannot be revoked; log in again for a signed token"}), 409)
+        revoke_teacher_token(g.teacher_token)
+        return jsonify({"message": "Logged out"}), 200
+
+    except Exception as e:
+        app.logger.error(f"Error logging out teacher: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
 @app.route("/api/v1/teachers/<teacher_id>/award_coins", methods=["POST"])
 @require_teacher_token
+@validate_write_fields
 def teacher_award_coins(teacher_id):
     """
     Teacher can award coins to a student by providing:
@@ -1442,22 +4171,136 @@ def teacher_award_coins(teacher_id):
         if coins <= 0:
             return make_response(jsonify({"error": "coins must be > 0"}), 400)
 
-        result = mongo.db.Users.update_one({"rfidUID": rfid_uid}, {"$inc": {"coins": coins}})
-        if result.matched_count == 0:
+        projection, _ = post_image_projection(["name", "coins"])
+        updated = update_user(rfid_uid, {"$inc": {"coins": coins}}, projection)
+        if not updated:
             return make_response(jsonify({"error": "No user found for given rfidUID"}), 404)
 
-        updated = mongo.db.Users.find_one({"rfidUID": rfid_uid}, {"_id": 0, "coins": 1, "name": 1})
         return jsonify({
             "message": f"Awarded {coins} coins to {updated.get('name', rfid_uid)}",
-            "totalCoins": updated.get('coins', 0)
+            "totalCoins": updated.get('coins', 0),
+            "user": user_slice(updated)
         }), 200
 
     except Exception as e:
         app.logger.error(f"Error in teacher_award_coins: {str(e)}")
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
+# ==========================================
+# SHOP, TRAVEL AND LORDSHIP WRITES
+# ==========================================
+# Update documents for the shop, use_travel_item and use_seize_power,
+# shared with the async routes in asgi.py. A purchase is one conditional
+# write: the filter requires coins >= the total cost and the update $incs
+# the cost off and $pushes the items, so a coin award landing at the same
+# time is never overwritten and a balance can never go negative. Only a
+# refused purchase reads the user again, to tell "no such user" from
+# "not enough coins".
+
+PURCHASE_CART_MAX_ITEMS = 20
+
+# Travel items and the node they take a user to. Includes a couple legacy
+# aliases (boatTick*) to match older mock data.
+TRAVEL_DESTINATIONS = {
+    "boatTicketForest": "HF",  # Greenwood Harbour
+    "boatTicketLava": "HL",    # Lavastone Harbour
+    "boatTicketWater": "HW",   # Water Harbour
+    "boatTickForest": "HF",
+    "boatTickLava": "HL",
+    "boatTickWater": "HW",
+    "wagonRide": "FT",         # Town of Greenwood
+    "machete": "WT",           # Town of Bluehaven
+    "lavaBoots": "LT",         # Castle Emberfall
+    "donkeyRide": "MP",        # Mountain Pass
+    "forestMap": "CF",         # Forest Gate
+    "gasMask": "CL",           # Ashwood Pass
+}
+
+SEIZE_POWER_NAMES = ("seizepower", "seize_power", "seize-power")
+
+# The lord a seizure replaces loses the title and is sent home
+DEPOSED_LORD_UPDATE = {"$set": {"lordOf": None, "currentLocation": "H"}}
+
+
+def purchase_filter(items):
+    """update_user() query admitting the purchase of [(itemName, itemCost)] only if it is affordable."""
+    return {"coins": {"$gte": sum(cost for _, cost in items)}}
+
+
+def purchase_update(items):
+    """Update document that pays for and records [(itemName, itemCost)]."""
+    purchase_date = datetime.datetime.utcnow()
+    bought = {}
+    for name, _ in items:
+        bought[name] = bought.get(name, 0) + 1
+    return with_summary({
+        "$inc": {"coins": -sum(cost for _, cost in items)},
+        "$push": {"purchasedItems": {"$each": [
+            {"itemName": name, "cost": cost, "purchaseDate": purchase_date} for name, cost in items
+        ]}}
+    }, summary_inc(items=bought))
+
+
+def purchase_projection(projection, count=1):
+    """`projection` widened to return the new balance and the `count` items just pushed."""
+    if isinstance(projection.get("purchasedItems"), dict):
+        projection = {**projection, "purchasedItems": {"$slice": -count}}
+    return {**projection, "coins": 1}
+
+
+def purchase_refusal(user, cost_field, cost):
+    """(body, status) for a purchase whose conditional write matched nothing."""
+    if not user:
+        return {"error": "User not found"}, 404
+    return {"error": "Not enough coins", "currentCoins": user.get("coins", 0), cost_field: cost}, 400
+
+
+def travel_destination(data):
+    """(destination nodeId, error message) for a use_travel_item body."""
+    item_name = data.get("itemName")
+    if not item_name:
+        return None, "itemName is required"
+    # destinationNodeId overrides the mapping if provided
+    destination = data.get("destinationNodeId") or TRAVEL_DESTINATIONS.get(item_name)
+    if not destination:
+        return None, f"Unknown travel item or destination missing: {item_name}"
+    return destination, None
+
+
+def without_one_item(purchased_items, item_name):
+    """purchasedItems minus its first `item_name` entry, or None if there is none."""
+    for index, entry in enumerate(purchased_items):
+        if purchased_item_name(entry) == item_name:
+            return purchased_items[:index] + purchased_items[index + 1:]
+    return None
+
+
+def travel_update(destination, purchased_items, item_name):
+    return with_summary(
+        {"$set": {"currentLocation": destination, "purchasedItems": purchased_items}},
+        summary_inc(items={item_name: -1})
+    )
+
+
+def has_seize_power(purchased_items):
+    return any(
+        (item.get("itemName") or "").lower() in SEIZE_POWER_NAMES
+        for item in purchased_items or []
+        if isinstance(item, dict)
+    )
+
+
+def seize_power_update(location):
+    return {
+        # The $pull may remove several differently named items, so recount later
+        "$set": {"lordOf": location, **STALE_SUMMARY},
+        "$pull": {"purchasedItems": {"itemName": {"$regex": "^seize", "$options": "i"}}}
+    }
+
+
 @app.route("/api/v1/purchase_item", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def purchase_item():
     """
     ESP32 shop endpoint - handles item purchases
@@ -1467,52 +4310,27 @@ def purchase_item():
     try:
         data = request.get_json()
         
+        # Validate input
+        error = validate_purchase(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
+        
         rfid_uid = data.get('rfidUID')
         item_name = data.get('itemName')
         item_cost = data.get('itemCost')
+        items = [(item_name, item_cost)]
         
-        # Validate input
-        if not rfid_uid:
-            return make_response(jsonify({"error": "rfidUID required"}), 400)
-        if not item_name:
-            return make_response(jsonify({"error": "itemName required"}), 400)
-        if not item_cost or item_cost <= 0:
-            return make_response(jsonify({"error": "itemCost must be > 0"}), 400)
-        
-        # Find user
-        user = mongo.db.Users.find_one({"rfidUID": rfid_uid})
-        if not user:
-            return make_response(jsonify({"error": "User not found"}), 404)
-        
-        # Check if user has enough coins
-        current_coins = user.get('coins', 0)
-        if current_coins < item_cost:
-            return make_response(jsonify({
-                "error": "Not enough coins",
-                "currentCoins": current_coins,
-                "itemCost": item_cost
-            }), 400)
-        
-        # Calculate new balance
-        new_balance = current_coins - item_cost
+        # Deduct coins and add the item in one write that only matches if the user can afford it
+        projection, _ = post_image_projection(["coins", "purchasedItems"], pushed=["purchasedItems"])
+        updated_user = update_user(rfid_uid, purchase_update(items), purchase_projection(projection), purchase_filter(items))
         
-        # Update user - deduct coins and add item to purchasedItems array
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfid_uid},
-            {
-                "$set": {"coins": new_balance},
-                "$push": {
-                    "purchasedItems": {
-                        "itemName": item_name,
-                        "cost": item_cost,
-                        "purchaseDate": datetime.datetime.utcnow()
-                    }
-                }
-            }
-        )
+        if not updated_user:
+            body, status = purchase_refusal(mongo.db.Users.find_one({"rfidUID": rfid_uid}, {"coins": 1}), "itemCost", item_cost)
+            return make_response(jsonify(body), status)
         
-        if result.modified_count == 0:
-            return make_response(jsonify({"error": "Failed to update user"}), 500)
+        new_balance = updated_user.get("coins", 0)
+        if "coins" not in projection:
+            updated_user.pop("coins")
         
         app.logger.info(f"User {rfid_uid} purchased {item_name} for {item_cost} coins. New balance: {new_balance}")
         
@@ -1521,7 +4339,8 @@ def purchase_item():
             "message": f"Successfully purchased {item_name}",
             "itemPurchased": item_name,
             "itemCost": item_cost,
-            "newCoinBalance": new_balance
+            "newCoinBalance": new_balance,
+            "user": user_slice(updated_user)
         }), 200
         
     except Exception as e:
@@ -1529,8 +4348,57 @@ def purchase_item():
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
 
+@app.route("/api/v1/purchase_cart", methods=["POST"])
+@require_api_key_strict
+@validate_write_fields
+def purchase_cart():
+    """
+    ESP32 shop endpoint - buys several items at once, all or nothing
+    Expects: { "rfidUID": "...", "items": [{ "itemName": "...", "itemCost": ... }, ...] }
+    Returns: { "success": true, "newCoinBalance": ..., "itemsPurchased": [...], "totalCost": ... }
+    """
+    try:
+        data = request.get_json()
+        
+        error = validate_cart(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
+        
+        rfid_uid = data.get('rfidUID')
+        items = [(item["itemName"], item["itemCost"]) for item in data["items"]]
+        total_cost = sum(cost for _, cost in items)
+        log_fields(rfid=rfid_uid, items=len(items), totalCost=total_cost)
+        
+        projection, _ = post_image_projection(["coins", "purchasedItems"], pushed=["purchasedItems"])
+        updated_user = update_user(
+            rfid_uid, purchase_update(items), purchase_projection(projection, len(items)), purchase_filter(items)
+        )
+        
+        if not updated_user:
+            body, status = purchase_refusal(mongo.db.Users.find_one({"rfidUID": rfid_uid}, {"coins": 1}), "totalCost", total_cost)
+            return make_response(jsonify(body), status)
+        
+        new_balance = updated_user.get("coins", 0)
+        if "coins" not in projection:
+            updated_user.pop("coins")
+        
+        return jsonify({
+            "success": True,
+            "message": f"Successfully purchased {len(items)} items",
+            "itemsPurchased": [name for name, _ in items],
+            "totalCost": total_cost,
+            "newCoinBalance": new_balance,
+            "user": user_slice(updated_user)
+        }), 200
+        
+    except Exception as e:
+        app.logger.error(f"Error in purchase_cart: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
 @app.route("/api/v1/users/<rfidUID>/use_travel_item", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def use_travel_item(rfidUID):
     """Consume a travel item and move the user.
 
@@ -1545,59 +4413,37 @@ def use_travel_item(rfidUID):
     try:
         data = request.get_json(silent=True) or {}
 
+        destination, error = travel_destination(data)
+        if error:
+            return make_response(jsonify({"error": error}), 400)
         item_name = data.get("itemName")
-        if not item_name:
-            return make_response(jsonify({"error": "itemName is required"}), 400)
-
-        destination_node_id = data.get("destinationNodeId")
-
-        # Map travel items to their destinations (node IDs).
-        # Includes a couple legacy aliases (boatTick*) to match older mock data.
-        ITEM_TO_DESTINATION = {
-            "boatTicketForest": "HF",  # Greenwood Harbour
-            "boatTicketLava": "HL",    # Lavastone Harbour
-            "boatTicketWater": "HW",   # Water Harbour
-            "boatTickForest": "HF",
-            "boatTickLava": "HL",
-            "boatTickWater": "HW",
-            "wagonRide": "FT",         # Town of Greenwood
-            "machete": "WT",           # Town of Bluehaven
-            "lavaBoots": "LT",         # Castle Emberfall
-            "donkeyRide": "MP",        # Mountain Pass
-            "forestMap": "CF",         # Forest Gate
-            "gasMask": "CL",           # Ashwood Pass
-        }
-
-        destination = destination_node_id or ITEM_TO_DESTINATION.get(item_name)
-        if not destination:
-            return make_response(jsonify({"error": f"Unknown travel item or destination missing: {item_name}"}), 400)
-
-        user = mongo.db.Users.find_one({"rfidUID": rfidUID})
-        if not user:
-            return make_response(jsonify({"error": "User not found"}), 404)
-
-        purchased_items = user.get("purchasedItems", []) or []
-        if not isinstance(purchased_items, list):
-            return make_response(jsonify({"error": "User purchasedItems is not a list"}), 500)
-
-        # Remove exactly one matching purchased item.
-        new_purchased_items = []
-        removed = False
-        for entry in purchased_items:
-            entry_item_name = entry.get("itemName") if isinstance(entry, dict) else entry
-            if not removed and entry_item_name == item_name:
-                removed = True
-                continue
-            new_purchased_items.append(entry)
-
-        if not removed:
-            return make_response(jsonify({"error": f"User does not have {item_name}"}), 400)
 
-        updated_user = mongo.db.Users.find_one_and_update(
-            {"rfidUID": rfidUID},
-            {"$set": {"currentLocation": destination, "purchasedItems": new_purchased_items}},
-            return_document=ReturnDocument.AFTER,
-        )
+        projection, _ = post_image_projection(["currentLocation", "purchasedItems"])
+        for _ in range(3):
+            user = mongo.db.Users.find_one({"rfidUID": rfidUID}, {"purchasedItems": 1})
+            if not user:
+                return make_response(jsonify({"error": "User not found"}), 404)
+
+            purchased_items = user.get("purchasedItems", []) or []
+            if not isinstance(purchased_items, list):
+                return make_response(jsonify({"error": "User purchasedItems is not a list"}), 500)
+
+            # Remove exactly one matching purchased item.
+            new_purchased_items = without_one_item(purchased_items, item_name)
+            if new_purchased_items is None:
+                return make_response(jsonify({"error": f"User does not have {item_name}"}), 400)
+
+            # Conditional on purchasedItems being unchanged, so a concurrent purchase is never overwritten
+            updated_user = update_user(
+                rfidUID,
+                travel_update(destination, new_purchased_items, item_name),
+                projection,
+                {"purchasedItems": user.get("purchasedItems")}
+            )
+            if updated_user:
+                break
+        else:
+            return make_response(jsonify({"error": "purchasedItems changed during the update, try again"}), 409)
 
         app.logger.info(f"✅ User {rfidUID} used {item_name} to travel to {destination}")
 
@@ -1609,6 +4455,7 @@ def use_travel_item(rfidUID):
                     "message": f"Traveled to {destination}",
                     "currentLocation": destination,
                     "itemUsed": item_name,
+                    "user": user_slice(updated_user),
                 }
             ),
             200,
@@ -1621,6 +4468,7 @@ def use_travel_item(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/set_location", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def set_location(rfidUID):
     """Directly set a user's currentLocation (admin/teacher use)."""
     try:
@@ -1630,19 +4478,18 @@ def set_location(rfidUID):
         if not location:
             return make_response(jsonify({"error": "location is required"}), 400)
 
-        result = mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {"$set": {"currentLocation": location}}
-        )
+        projection, _ = post_image_projection(["currentLocation"])
+        updated_user = update_user(rfidUID, {"$set": {"currentLocation": location}}, projection)
 
-        if result.matched_count == 0:
+        if not updated_user:
             return make_response(jsonify({"error": "User not found"}), 404)
 
         app.logger.info(f"✅ Set location for {rfidUID} to {location}")
 
         return make_response(jsonify({
             "message": f"Location set to {location}",
-            "currentLocation": location
+            "currentLocation": location,
+            "user": user_slice(updated_user)
         }), 200)
 
     except Exception as e:
@@ -1652,6 +4499,7 @@ def set_location(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/use_seize_power", methods=["POST"])
 @require_api_key_strict
+@validate_write_fields
 def use_seize_power(rfidUID):
     """Use SeizePower to take over Lordship of the current location."""
     try:
@@ -1663,14 +4511,7 @@ def use_seize_power(rfidUID):
         if not current_location:
             return make_response(jsonify({"error": "Activator has no currentLocation"}), 400)
 
-        purchased_items = activator.get("purchasedItems", [])
-        has_seize = any(
-            (item.get("itemName") or "").lower() in ("seizepower", "seize_power", "seize-power")
-            for item in purchased_items
-            if isinstance(item, dict)
-        )
-
-        if not has_seize:
+        if not has_seize_power(activator.get("purchasedItems", [])):
             return make_response(jsonify({"error": "User does not have SeizePower"}), 400)
 
         current_lord = mongo.db.Users.find_one({"lordOf": current_location})
@@ -1678,18 +4519,10 @@ def use_seize_power(rfidUID):
         previous_lord_id = None
         if current_lord and current_lord.get("rfidUID") != rfidUID:
             previous_lord_id = current_lord.get("rfidUID")
-            mongo.db.Users.update_one(
-                {"rfidUID": current_lord.get("rfidUID")},
-                {"$set": {"lordOf": None, "currentLocation": "H"}}
-            )
+            update_user(previous_lord_id, DEPOSED_LORD_UPDATE, {"_id": 1})
 
-        mongo.db.Users.update_one(
-            {"rfidUID": rfidUID},
-            {
-                "$set": {"lordOf": current_location},
-                "$pull": {"purchasedItems": {"itemName": {"$regex": "^seize", "$options": "i"}}}
-            }
-        )
+        projection, _ = post_image_projection(["currentLocation", "lordOf", "purchasedItems"])
+        updated_user = update_user(rfidUID, seize_power_update(current_location), projection)
 
         app.logger.info(f"✅ User {rfidUID} seized power at {current_location} (prev: {previous_lord_id})")
 
@@ -1697,7 +4530,8 @@ def use_seize_power(rfidUID):
             "message": "SeizePower used",
             "location": current_location,
             "previousLord": previous_lord_id,
-            "newLord": rfidUID
+            "newLord": rfidUID,
+            "user": user_slice(updated_user)
         }), 200)
 
     except Exception as e:
@@ -1707,6 +4541,7 @@ def use_seize_power(rfidUID):
 
 @app.route("/api/v1/users/<rfidUID>/set_class", methods=["POST"])
 @require_api_key_optional
+@validate_write_fields
 def set_class(rfidUID):
     """Update a user's playerClass."""
     try:
@@ -1716,21 +4551,354 @@ def set_class(rfidUID):
         if not player_class:
             return make_response(jsonify({"error": "playerClass is required"}), 400)
 
-        result = mongo.db.Users.update_one(
+        # The pre-image gives the class being left; the post-image only differs in playerClass
+        projection, _ = post_image_projection(["playerClass"])
+        previous_user = mongo.db.Users.find_one_and_update(
             {"rfidUID": rfidUID},
-            {"$set": {"playerClass": player_class}}
+            {
+                "$set": {"playerClass": player_class, "school": class_school(player_class)},
+                "$inc": {LEADERBOARD_VERSION_FIELD: 1, USER_VERSION_FIELD: 1}
+            },
+            projection={**projection, "playerClass": 1, "name": 1, "coins": 1, LEADERBOARD_VERSION_FIELD: 1},
+            return_document=ReturnDocument.BEFORE,
         )
 
-        if result.matched_count == 0:
+        if not previous_user:
             return make_response(jsonify({"error": "User not found"}), 404)
 
-        return jsonify({"rfidUID": rfidUID, "playerClass": player_class}), 200
+        # Registry first: a class-list read between the two would cache the old list under the new tag
+        if previous_user.get("playerClass") != player_class:
+            register_class_members(previous_user.get("playerClass"), -1)
+            register_class_members(player_class, 1)
+        bump_versions(previous_user.get("playerClass"), player_class, class_list=True)
+        updated_user = {
+            **previous_user, "playerClass": player_class,
+            LEADERBOARD_VERSION_FIELD: previous_user.get(LEADERBOARD_VERSION_FIELD, 0) + 1
+        }
+        update_leaderboard({**updated_user, "rfidUID": rfidUID})
+        for field in ("playerClass", "name", "coins", LEADERBOARD_VERSION_FIELD):
+            if field not in projection:
+                updated_user.pop(field, None)
+
+        return jsonify({"rfidUID": rfidUID, "playerClass": player_class, "user": user_slice(updated_user)}), 200
 
     except Exception as e:
         app.logger.error(f"Error setting class: {str(e)}")
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
 
+# ==========================================
+# CLASS REFRESH EVENTS
+# ==========================================
+# Big screens hold one server-sent events stream per class instead of
+# polling ClassRefresh. Each worker fans events out to its own subscribers
+# through an EventHub, fed by a change stream on ClassRefresh so a refresh
+# posted to any worker reaches every screen; without change streams one
+# query per worker every REFRESH_POLL_SECONDS stands in for it. An event's
+# id is its refreshedAt in milliseconds, so a reconnecting EventSource's
+# Last-Event-ID tells whether it missed the latest refresh.
+
+SSE_MIMETYPE = "text/event-stream"
+SSE_RETRY_MS = 3000
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class EventHub:
+    """In-process pub/sub: one bounded queue per subscriber, events keyed by channel.
+
+    Events published with an id no newer than the channel's last one are
+    dropped, so the same event arriving from several sources is delivered once.
+    """
+
+    def __init__(self, queue_size=16):
+        self._queue_size = queue_size
+        self._subscribers = {}
+        self._last_ids = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscriber = queue.Queue(self._queue_size)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+
+    def has_subscribers(self, channel):
+        with self._lock:
+            return bool(self._subscribers.get(channel))
+
+    def publish(self, channel, name, data, event_id=None):
+        with self._lock:
+            if event_id is not None:
+                if event_id <= self._last_ids.get(channel, -1):
+                    return
+                self._last_ids[channel] = event_id
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_id, name, data))
+            except queue.Full:
+                # A stalled client loses events; its heartbeat write will fail soon
+                pass
+
+
+refresh_hub = EventHub()
+_refresh_bridge_lock = threading.Lock()
+_refresh_bridge_started = False
+
+
+def refresh_event_id(refreshed_at):
+    """Milliseconds since the epoch; Mongo stores datetimes at that precision."""
+    return (refreshed_at - _EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def publish_refresh(record):
+    """Hand a ClassRefresh document to this worker's subscribers."""
+    refreshed_at = record.get("refreshedAt")
+    if record.get("classId") and isinstance(refreshed_at, datetime.datetime):
+        # Same text whether it came from this worker or back from Mongo
+        refreshed_at = refreshed_at.replace(microsecond=refreshed_at.microsecond // 1000 * 1000)
+        refresh_hub.publish(record["classId"], "refresh", {
+            "classId": record["classId"],
+            "refreshedAt": refreshed_at.isoformat() + "Z"
+        }, refresh_event_id(refreshed_at))
+
+
+def _poll_class_refresh():
+    since = datetime.datetime.utcnow()
+    while True:
+        time.sleep(app.config["REFRESH_POLL_SECONDS"])
+        try:
+            for record in mongo.db.ClassRefresh.find({"refreshedAt": {"$gt": since}}).sort("refreshedAt", 1):
+                since = max(since, record["refreshedAt"])
+                publish_refresh(record)
+        except Exception as e:
+            app.logger.warning(f"ClassRefresh poll failed: {e}")
+
+
+def class_refresh_bridge():
+    """Publish ClassRefresh changes from any worker to this worker's hub.
+
+    Falls back to polling when the server does not support change streams.
+    """
+    while True:
+        try:
+            with mongo.db.ClassRefresh.watch(
+                    [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}],
+                    full_document="updateLookup") as stream:
+                app.logger.info("Class refresh events following ClassRefresh change stream")
+                for change in stream:
+                    publish_refresh(change.get("fullDocument") or {})
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                app.logger.info(f"Change streams unavailable, polling ClassRefresh every {app.config['REFRESH_POLL_SECONDS']}s")
+                return _poll_class_refresh()
+            app.logger.warning(f"ClassRefresh change stream failed: {e}")
+        except Exception as e:
+            app.logger.warning(f"ClassRefresh change stream failed: {e}")
+        time.sleep(app.config["REFRESH_POLL_SECONDS"])
+
+
+def ensure_refresh_bridge():
+    """Start the bridge on the first subscription, so idle workers never open the stream."""
+    global _refresh_bridge_started
+    if _refresh_bridge_started:
+        return
+    with _refresh_bridge_lock:
+        if not _refresh_bridge_started:
+            _refresh_bridge_started = True
+            threading.Thread(target=class_refresh_bridge, name="class-refresh-bridge", daemon=True).start()
+
+
+def sse_message(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    if data is not None:
+        lines.append(f"data: {app.json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def last_event_id():
+    """Last-Event-ID from a reconnecting EventSource (or ?lastEventId=), or None."""
+    value = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def sse_response(hub, channel, initial, on_close=None):
+    """Stream `hub` events on `channel` after the messages `initial()` returns.
+
+    `initial` runs after subscribing, so nothing published while it reads is lost.
+    Comment heartbeats keep proxies from timing the connection out and find
+    dead clients; after SSE_MAX_SECONDS the stream ends and the EventSource
+    reconnects with its Last-Event-ID, so no sync worker is held indefinitely.
+    """
+    subscriber = hub.subscribe(channel)
+    heartbeat = app.config["SSE_HEARTBEAT_SECONDS"]
+    deadline = time.monotonic() + app.config["SSE_MAX_SECONDS"]
+    try:
+        messages = initial()
+    except Exception:
+        hub.unsubscribe(channel, subscriber)
+        if on_close:
+            on_close()
+        raise
+
+    def events():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            yield from messages
+            while time.monotonic() < deadline:
+                try:
+                    event_id, name, data = subscriber.get(timeout=min(heartbeat, max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield sse_message(data, name, event_id)
+        finally:
+            hub.unsubscribe(channel, subscriber)
+            if on_close:
+                on_close()
+
+    response = Response(events(), mimetype=SSE_MIMETYPE)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx/Heroku router: do not buffer
+    return response
+
+
+# ==========================================
+# LIVE CLASS ROSTERS
+# ==========================================
+# A big screen opens one event stream per class and gets a snapshot of the
+# roster followed by deltas: coins, new creature stacks, location, new lord,
+# and students joining or leaving the class. Each worker keeps the last
+# state it sent for the classes someone is watching and diffs Users
+# change-stream documents against it; while change streams are unavailable
+# the watched classes are re-read every ROSTER_POLL_SECONDS and diffed whole.
+
+roster_hub = EventHub()
+_live_rosters = {}  # playerClass -> {rfidUID: live state}
+_live_roster_lock = threading.Lock()
+_live_poller_started = False
+
+
+def live_state(user):
+    """The parts of a user a big screen animates."""
+    creatures = {}
+    for entry in user.get("creatures") or []:
+        if isinstance(entry, dict) and entry.get("name"):
+            creatures[entry["name"]] = creatures.get(entry["name"], 0) + stack_total([entry])
+    return {
+        "rfidUID": user.get("rfidUID"),
+        "name": user.get("name"),
+        "coins": user.get("coins", 0),
+        "currentLocation": user.get("currentLocation"),
+        "lordOf": user.get("lordOf"),
+        "creatures": creatures,
+    }
+
+
+def live_deltas(before, after):
+    """(event, data) pairs turning one student's `before` state into `after`."""
+    who = {"rfidUID": after["rfidUID"], "name": after["name"]}
+    if before is None:
+        return [("joined", after)]
+    deltas = []
+    if after["coins"] != before["coins"]:
+        deltas.append(("coins", {**who, "coins": after["coins"], "delta": after["coins"] - before["coins"]}))
+    for creature in after["creatures"]:
+        if creature not in before["creatures"]:
+            deltas.append(("creature", {**who, "creature": creature, "count": after["creatures"][creature]}))
+    if after["currentLocation"] != before["currentLocation"]:
+        deltas.append(("location", {**who, "currentLocation": after["currentLocation"]}))
+    if after["lordOf"] and after["lordOf"] != before["lordOf"]:
+        deltas.append(("lord", {**who, "lordOf": after["lordOf"]}))
+    return deltas
+
+
+def _apply_live_user(player_class, roster, state):
+    """Update a watched roster with one student's state and publish what changed. Hold _live_roster_lock."""
+    for event, data in live_deltas(roster.get(state["rfidUID"]), state):
+        roster_hub.publish(player_class, event, data)
+    roster[state["rfidUID"]] = state
+
+
+def publish_roster_change(change):
+    """Diff a Users change-stream document against the watched rosters it can affect."""
+    user = change.get("fullDocument")
+    if not user or not user.get("rfidUID") or not _live_rosters:
+        return
+    state = live_state(inventory_to_arrays(dict(user)))
+    with _live_roster_lock:
+        for player_class, roster in _live_rosters.items():
+            if player_class == user.get("playerClass"):
+                _apply_live_user(player_class, roster, state)
+            elif roster.pop(state["rfidUID"], None) is not None:
+                roster_hub.publish(player_class, "left", {"rfidUID": state["rfidUID"], "name": state["name"]})
+
+
+def _load_live_roster(player_class):
+    return {user.get("rfidUID"): live_state(user) for user in class_roster(player_class) if user.get("rfidUID")}
+
+
+def refresh_live_roster(player_class):
+    """Re-read a watched class and publish the differences. Used while change streams are down."""
+    roster = _load_live_roster(player_class)
+    with _live_roster_lock:
+        current = _live_rosters.get(player_class)
+        if current is None:
+            return
+        for rfid_uid in [rfid_uid for rfid_uid in current if rfid_uid not in roster]:
+            left = current.pop(rfid_uid)
+            roster_hub.publish(player_class, "left", {"rfidUID": rfid_uid, "name": left["name"]})
+        for state in roster.values():
+            _apply_live_user(player_class, current, state)
+
+
+def live_roster_poller():
+    while True:
+        time.sleep(app.config["ROSTER_POLL_SECONDS"])
+        if _roster_stream_live.is_set():
+            continue
+        for player_class in list(_live_rosters):
+            try:
+                refresh_live_roster(player_class)
+            except Exception as e:
+                app.logger.warning(f"Live roster poll failed for {player_class}: {e}")
+
+
+def watch_live_roster(player_class):
+    """Start tracking a class for a new subscriber and return its snapshot."""
+    global _live_poller_started
+    ensure_roster_watcher()
+    with _live_roster_lock:
+        if not _live_poller_started:
+            _live_poller_started = True
+            threading.Thread(target=live_roster_poller, name="live-roster-poller", daemon=True).start()
+        roster = _live_rosters.get(player_class)
+        if roster is None:
+            # Read under the lock so no change is diffed against a half-built roster
+            roster = _live_rosters[player_class] = _load_live_roster(player_class)
+        return sorted(roster.values(), key=lambda state: -state["coins"])
+
+
+def unwatch_live_roster(player_class):
+    with _live_roster_lock:
+        if not roster_hub.has_subscribers(player_class):
+            _live_rosters.pop(player_class, None)
+
+
 @app.route("/api/v1/users/<rfidUID>/refresh_now", methods=["POST"])
 @require_api_key_strict
 def refresh_now(rfidUID):
@@ -1751,6 +4919,8 @@ def refresh_now(rfidUID):
             {"$set": {"classId": player_class, "refreshedAt": now}},
             upsert=True,
         )
+        # Immediate for this worker's screens; the bridge's copy is dropped as a repeat
+        publish_refresh({"classId": player_class, "refreshedAt": now})
 
         return jsonify({
             "classId": player_class,
@@ -1783,6 +4953,52 @@ def get_refresh_now(class_id):
         app.logger.error(f"Error in get_refresh_now: {str(e)}")
         return make_response(jsonify({"error": "Internal Server Error"}), 500)
 
+@app.route("/api/v1/classes/<path:class_id>/refresh_events", methods=["GET"])
+@require_api_key_optional
+def stream_refresh_events(class_id):
+    """Server-sent `refresh` events for a class as refresh_now fires."""
+    try:
+        ensure_refresh_bridge()
+        seen = last_event_id()
+
+        def initial():
+            record = mongo.db.ClassRefresh.find_one({"classId": class_id}, {"_id": 0, "classId": 1, "refreshedAt": 1})
+            if not record or not isinstance(record.get("refreshedAt"), datetime.datetime):
+                return []
+            event_id = refresh_event_id(record["refreshedAt"])
+            if seen is None:
+                # Only sets the client's Last-Event-ID; a fresh screen has nothing to catch up on
+                return [sse_message(None, event_id=event_id)]
+            if event_id > seen:
+                # Missed while reconnecting
+                return [sse_message({
+                    "classId": class_id,
+                    "refreshedAt": record["refreshedAt"].isoformat() + "Z"
+                }, "refresh", event_id)]
+            return []
+
+        return sse_response(refresh_hub, class_id, initial)
+
+    except Exception as e:
+        app.logger.error(f"Error in stream_refresh_events: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
+@app.route("/api/v1/classes/<path:class_id>/live", methods=["GET"])
+@require_api_key_optional
+def stream_live_roster(class_id):
+    """Server-sent roster snapshot for a class, then one event per change."""
+    try:
+        def initial():
+            return [sse_message({"classId": class_id, "students": watch_live_roster(class_id)}, "snapshot")]
+
+        return sse_response(roster_hub, class_id, initial, on_close=lambda: unwatch_live_roster(class_id))
+
+    except Exception as e:
+        app.logger.error(f"Error in stream_live_roster: {str(e)}")
+        return make_response(jsonify({"error": "Internal Server Error"}), 500)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host="0.0.0.0", port=port)
@@ -0,0 +1,558 @@
+"""ASGI entry point: async device routes in front of the Flask app.
+
+The write endpoints ESP32 devices hit most - add_5_coin, the *_stacked
+uploads, purchase_item, purchase_cart, use_travel_item and use_seize_power -
+are served here by coroutines on one event loop using Motor, so a worker
+waiting on Mongo holds no thread. Every other path, and these ones when a
+feature the async twins do not implement is in play, goes to the unchanged
+Flask app mounted underneath. The twins share validation, update documents,
+projections, rate-limit buckets and encodings with app.py, so a device
+cannot tell which side answered.
+
+Requests handed to Flask:
+  - anything with an Origin header (Flask owns CORS)
+  - strict routes called with an Idempotency-Key
+  - stacked routes with KEYED_INVENTORY=1, and the complete_* uploads with
+    ASYNC_INGEST=1 (keyed writes and the write-behind journal stay in Flask)
+
+This service is opt-in: the Procfile still runs the WSGI app:app. To
+deploy it, change the Procfile's web line to the same gunicorn settings
+with the uvicorn worker:
+
+    web: gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+"""
+import contextlib
+import logging
+import math
+import time
+
+from a2wsgi import WSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app as gameapi
+from app import (
+    BINARY_FORMATS, COMPRESSIBLE_MIMETYPES, DEPOSED_LORD_UPDATE, api_key_error, brotli, build_challenge_entry,
+    caller_identities, has_seize_power, leaderboard_write, merge_stacks, post_image_projection, purchase_filter,
+    purchase_projection, purchase_refusal, purchase_update, queue_version_bumps, rate_limit_buckets,
+    requested_fields, seize_power_update, stack_names, stack_total, stacked_upload_pipeline, summary_inc,
+    take_tokens, touches_coins, travel_destination, travel_update, unknown_fields_error, user_slice,
+    validate_cart, validate_purchase, validate_rfid_body, validate_stack_item, validate_stacked_upload,
+    with_leaderboard_version, with_summary, with_user_version, without_one_item, write_tracked_fields,
+)
+
+flask_app = gameapi.app
+logger = flask_app.logger
+flask_asgi = WSGIMiddleware(flask_app)
+
+# Set per worker by the lifespan
+db = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    global db
+    client = AsyncIOMotorClient(flask_app.config["MONGO_URI"], **gameapi.mongo_client_options())
+    db = client.get_default_database()
+    gameapi.start_background_tasks()
+    try:
+        yield
+    finally:
+        client.close()
+
+
+# ==========================================
+# REQUESTS AND RESPONSES
+# ==========================================
+
+async def json_body(request, silent=False):
+    """The decoded JSON, msgpack or CBOR body, as Flask's request.get_json() would give it."""
+    if not hasattr(request.state, "json_body"):
+        mimetype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        try:
+            raw = await request.body()
+            if mimetype in BINARY_FORMATS:
+                request.state.json_body = BINARY_FORMATS[mimetype][1](raw)
+            elif mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json")):
+                request.state.json_body = flask_app.json.loads(raw)
+            else:
+                raise ValueError(f"Unsupported Content-Type: {mimetype or 'none'}")
+        except Exception as e:
+            request.state.json_body = e
+    body = request.state.json_body
+    if isinstance(body, Exception):
+        if silent:
+            return None
+        raise body
+    return body
+
+
+def respond(request, body, status=200):
+    """Encode `body` as jsonify() and compress_response() would."""
+    accept = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+    mimetype = "application/json"
+    if BINARY_FORMATS:
+        mimetype = accept.best_match(["application/json", *BINARY_FORMATS], "application/json")
+    if mimetype in BINARY_FORMATS:
+        content = BINARY_FORMATS[mimetype][0](body)
+    else:
+        content = (flask_app.json.dumps(body) + "\n").encode()
+
+    headers = {"Vary": "Accept, Accept-Encoding" if BINARY_FORMATS else "Accept-Encoding"}
+    encodings = parse_accept_header(request.headers.get("accept-encoding"))
+    encoding = encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+    if (encoding and mimetype in COMPRESSIBLE_MIMETYPES
+            and len(content) >= flask_app.config["COMPRESS_MIN_SIZE"]):
+        level = flask_app.config["COMPRESS_GZIP_LEVEL"] if encoding == "gzip" else flask_app.config["COMPRESS_BROTLI_QUALITY"]
+        compress, _, finish = gameapi._compressor(encoding, level)
+        content = compress(content) + finish()
+        headers["Content-Encoding"] = encoding
+    return Response(content, status, headers=headers, media_type=mimetype)
+
+
+def error(request, message, status, **extra):
+    return respond(request, {"error": message, **extra}, status)
+
+
+async def throttled(request, endpoint):
+    """A 429 response if the caller is out of tokens for `endpoint`, else None."""
+    if not flask_app.config["RATE_LIMIT"]:
+        return None
+    rfid_uid = request.path_params.get("rfidUID") or request.query_params.get("rfidUID")
+    if not rfid_uid:
+        body = await json_body(request, silent=True)
+        if isinstance(body, dict) and isinstance(body.get("rfidUID"), str):
+            rfid_uid = body["rfidUID"]
+    identities = caller_identities(
+        request.client.host if request.client else None,
+        request.headers.get("X-API-Key"), request.headers.get("X-Device-Id"), rfid_uid
+    )
+    try:
+        wait = await run_in_threadpool(take_tokens, rate_limit_buckets(endpoint, identities))
+    except Exception as e:
+        logger.warning("Rate limiter unavailable, admitting request: %s", e)
+        return None
+    if not wait:
+        return None
+    retry_after = max(1, math.ceil(wait))
+    response = error(request, "Too many requests", 429, retryAfter=retry_after)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def unauthorized(request, strict):
+    """The 401 require_api_key_strict / require_api_key_optional would give, else None."""
+    message = api_key_error(request.headers.get("X-API-Key"), strict)
+    return error(request, message, 401) if message else None
+
+
+def unknown_fields(request):
+    """The 400 validate_write_fields would give for ?fields=, else None."""
+    requested = request.query_params.get("fields")
+    message = unknown_fields_error(requested_fields(requested)) if requested is not None else None
+    return error(request, message, 400) if message else None
+
+
+def served_by_flask(request, strict):
+    return "origin" in request.headers or (strict and "idempotency-key" in request.headers)
+
+
+def stacked_on_flask(request):
+    return flask_app.config["KEYED_INVENTORY"]
+
+
+def ingest_on_flask(request):
+    return flask_app.config["KEYED_INVENTORY"] or flask_app.config["ASYNC_INGEST"]
+
+
+ROUTES = []
+
+
+def device_route(path, endpoint, strict=True, on_flask=None):
+    """Register an async twin of the Flask view `endpoint` at the same path.
+
+    The handler gets (request, log) and returns a Response; `log` is the
+    dict behind this request's summary line. `on_flask(request)` returning
+    true hands the request to Flask untouched.
+    """
+    def decorator(handler):
+        async def view(request):
+            if served_by_flask(request, strict) or (on_flask and on_flask(request)):
+                # Flask admits, logs and answers it; the body has not been read
+                return flask_asgi
+            started = time.perf_counter()
+            log = {}
+            response = unauthorized(request, strict)
+            if response is None:
+                response = await throttled(request, endpoint)
+                if response is not None:
+                    log["throttled"] = 1
+            if response is None:
+                response = unknown_fields(request)
+            if response is None:
+                try:
+                    response = await handler(request, log)
+                except Exception as e:
+                    logger.error("Error in async %s: %s", endpoint, e)
+                    response = error(request, "Internal Server Error", 500)
+            if logger.isEnabledFor(logging.INFO):
+                fields = {
+                    "method": request.method,
+                    "path": request.url.path,
+                    "status": response.status_code,
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                    "async": 1,
+                    **log
+                }
+                logger.info("request", extra={"fields": fields, "endpoint": endpoint})
+            return response
+
+        ROUTES.append(Route(path, view, methods=["POST"], name=endpoint))
+        return handler
+    return decorator
+
+
+# ==========================================
+# WRITES
+# ==========================================
+# Async counterparts of update_user() and apply_stacked_upload() for the
+# array inventory layout.
+
+async def update_user(rfid_uid, update, projection, query=None):
+    update = with_user_version(update)
+    if touches_coins(update):
+        update = with_leaderboard_version(update)
+    internal = write_tracked_fields(update, projection)
+    updated_user = await db.Users.find_one_and_update(
+        {"rfidUID": rfid_uid, **(query or {})},
+        update,
+        projection={**projection, **dict.fromkeys(internal, 1)},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated_user:
+        user = {**updated_user, "rfidUID": rfid_uid}
+        for field in internal:
+            updated_user.pop(field, None)
+        # Queued for app.py's version flusher; the user's own counter rode on the write
+        queue_version_bumps(user.get("playerClass"))
+        if touches_coins(update):
+            await update_leaderboard(user)
+    return updated_user
+
+
+async def update_leaderboard(user):
+    try:
+        await db.Leaderboard.update_one(*leaderboard_write(user), upsert=True)
+    except DuplicateKeyError:
+        # A write with a newer version got there first
+        pass
+    except Exception as e:
+        # The coin write itself succeeded; the next one or a rebuild repairs the entry
+        logger.error(f"Failed to update leaderboard for {user.get('rfidUID')}: {str(e)}")
+
+
+async def apply_stacked_upload(rfid_uid, add_coins=0, creatures=None, loot=None, challenge_entries=(),
+                               projection=None):
+    """Returns (updated_user, creatures_processed, loot_processed) like app.apply_stacked_upload()."""
+    creature_stacks, creatures_processed = merge_stacks(creatures, "creatures")
+    loot_stacks, loot_processed = merge_stacks(loot, "loot")
+    counters = summary_inc(
+        creatures=stack_total(creature_stacks), loot=stack_total(loot_stacks), challenge_codes=len(challenge_entries)
+    )
+    update = stacked_upload_pipeline(creature_stacks, loot_stacks, add_coins, challenge_entries)
+    if update:
+        updated_user = await update_user(rfid_uid, with_summary(update, counters), projection)
+    else:
+        updated_user = await db.Users.find_one({"rfidUID": rfid_uid}, projection)
+    return updated_user, creatures_processed, loot_processed
+
+
+# ==========================================
+# DEVICE ROUTES
+# ==========================================
+
+@device_route("/api/v1/add_5_coin", "add_5_coin")
+async def add_5_coin(request, log):
+    data = await json_body(request)
+    message = validate_rfid_body(data)
+    if message:
+        return error(request, message, 400)
+
+    projection, _ = post_image_projection(["coins"], requested=request.query_params.get("fields"))
+    updated_user = await update_user(data.get("rfidUID"), {"$inc": {"coins": 5}}, projection)
+    if not updated_user:
+        return error(request, "No user found for given rfidUID", 404)
+
+    return respond(request, {"message": "5 coins added successfully", "user": user_slice(updated_user)})
+
+
+@device_route("/api/v1/users/{rfidUID}/add_creature_stacked", "add_creature_stacked", on_flask=stacked_on_flask)
+async def add_creature_stacked(request, log):
+    data = await json_body(request)
+    message = validate_stack_item(data, "creatureName")
+    if message:
+        return error(request, message, 400)
+
+    creature_name = data.get("creatureName")
+    count_to_add = data.get("count", 1)
+    projection, changed = post_image_projection(
+        ["coins", "mainCreature", "creatures"], creatures=[creature_name], requested=request.query_params.get("fields")
+    )
+    updated_user, _, _ = await apply_stacked_upload(
+        request.path_params["rfidUID"],
+        creatures=[{"name": creature_name, "value": data.get("creatureValue", 1), "count": count_to_add}],
+        projection=projection
+    )
+    if not updated_user:
+        return error(request, "No user found for given rfidUID", 404)
+
+    return respond(request, {
+        "message": f"Added {count_to_add} {creature_name}(s) successfully",
+        "user": user_slice(updated_user, changed)
+    })
+
+
+async def add_loot(request, log):
+    data = await json_body(request)
+    message = validate_stack_item(data, "lootName")
+    if message:
+        return error(request, message, 400)
+
+    loot_name = data.get("lootName")
+    count_to_add = data.get("count", 1)
+    projection, changed = post_image_projection(
+        ["coins", "loot"], loot=[loot_name], requested=request.query_params.get("fields")
+    )
+    updated_user, _, _ = await apply_stacked_upload(
+        request.path_params["rfidUID"], loot=[{"name": loot_name, "count": count_to_add}], projection=projection
+    )
+    if not updated_user:
+        return error(request, "No user found for given rfidUID", 404)
+
+    return respond(request, {
+        "message": f"Added {count_to_add} {loot_name}(s) successfully",
+        "user": user_slice(updated_user, changed)
+    })
+
+
+device_route("/api/v1/users/{rfidUID}/add_loot_stacked", "add_loot_stacked", on_flask=stacked_on_flask)(add_loot)
+device_route("/api/v1/users/{rfidUID}/add_loot_stacked_v2", "add_loot_stacked_v2", on_flask=stacked_on_flask)(add_loot)
+
+
+async def complete_loot_upload(request, log, with_challenge):
+    data = await json_body(request)
+    message = validate_stacked_upload(data)
+    if message:
+        return error(request, message, 400)
+
+    rfid_uid = data.get('rfidUID')
+    add_coins = data.get('addCoins', 0)
+    creatures = data.get('creatures', [])
+    loot = data.get('loot', [])
+    challenge_code = data.get('challengeCode', '') if with_challenge else ''
+    log.update(rfid=rfid_uid, coins=add_coins, creatures=len(creatures), loot=len(loot))
+    if with_challenge:
+        log["challenge"] = challenge_code or None
+
+    challenge_entries = [build_challenge_entry(challenge_code)] if challenge_code else []
+    fields = ["name", "coins", "creatures", "loot"] + (["challengeCodes"] if with_challenge else [])
+    projection, changed = post_image_projection(
+        fields, creatures=stack_names(creatures), loot=stack_names(loot),
+        pushed=["challengeCodes"] if with_challenge else (), requested=request.query_params.get("fields")
+    )
+    updated_user, creatures_processed, loot_processed = await apply_stacked_upload(
+        rfid_uid, add_coins, creatures, loot, challenge_entries, projection=projection
+    )
+    if not updated_user:
+        logger.warning("[async complete_loot_upload] User not found for RFID: %s", rfid_uid)
+        return error(request, "User not found", 404)
+
+    log.update(user=updated_user.get("name"), totalCoins=updated_user.get("coins", 0))
+    body = {
+        "message": "Stacked upload successful",
+        "coinsAdded": add_coins,
+        "creaturesProcessed": creatures_processed,
+        "lootProcessed": loot_processed,
+    }
+    if with_challenge:
+        body["challengeCodeAdded"] = challenge_code if challenge_code else None
+    body["totalCoins"] = updated_user.get("coins", 0)
+    body["user"] = user_slice(updated_user, changed)
+    return respond(request, body)
+
+
+@device_route("/api/v1/complete_loot_upload_stacked", "complete_loot_upload_stacked", on_flask=ingest_on_flask)
+async def complete_loot_upload_stacked(request, log):
+    return await complete_loot_upload(request, log, with_challenge=False)
+
+
+@device_route("/api/v1/complete_loot_upload_stacked_v2", "complete_loot_upload_stacked_v2", on_flask=ingest_on_flask)
+async def complete_loot_upload_stacked_v2(request, log):
+    return await complete_loot_upload(request, log, with_challenge=True)
+
+
+async def purchase(request, rfid_uid, items, cost_field):
+    """Buy [(itemName, itemCost)] in one conditional write, as the Flask shop views do.
+
+    Returns (post-image, new balance, None), or (None, None, error response)
+    when the user is missing or cannot afford it.
+    """
+    projection, _ = post_image_projection(
+        ["coins", "purchasedItems"], pushed=["purchasedItems"], requested=request.query_params.get("fields")
+    )
+    updated_user = await update_user(
+        rfid_uid, purchase_update(items), purchase_projection(projection, len(items)), purchase_filter(items)
+    )
+    if not updated_user:
+        user = await db.Users.find_one({"rfidUID": rfid_uid}, {"coins": 1})
+        body, status = purchase_refusal(user, cost_field, sum(cost for _, cost in items))
+        return None, None, respond(request, body, status)
+    new_balance = updated_user.get("coins", 0)
+    if "coins" not in projection:
+        updated_user.pop("coins")
+    return updated_user, new_balance, None
+
+
+@device_route("/api/v1/purchase_item", "purchase_item")
+async def purchase_item(request, log):
+    data = await json_body(request)
+    message = validate_purchase(data)
+    if message:
+        return error(request, message, 400)
+
+    rfid_uid = data.get('rfidUID')
+    item_name = data.get('itemName')
+    item_cost = data.get('itemCost')
+
+    updated_user, new_balance, refused = await purchase(request, rfid_uid, [(item_name, item_cost)], "itemCost")
+    if refused:
+        return refused
+
+    logger.info(f"User {rfid_uid} purchased {item_name} for {item_cost} coins. New balance: {new_balance}")
+    return respond(request, {
+        "success": True,
+        "message": f"Successfully purchased {item_name}",
+        "itemPurchased": item_name,
+        "itemCost": item_cost,
+        "newCoinBalance": new_balance,
+        "user": user_slice(updated_user)
+    })
+
+
+@device_route("/api/v1/purchase_cart", "purchase_cart")
+async def purchase_cart(request, log):
+    data = await json_body(request)
+    message = validate_cart(data)
+    if message:
+        return error(request, message, 400)
+
+    rfid_uid = data.get('rfidUID')
+    items = [(item["itemName"], item["itemCost"]) for item in data["items"]]
+    total_cost = sum(cost for _, cost in items)
+    log.update(rfid=rfid_uid, items=len(items), totalCost=total_cost)
+
+    updated_user, new_balance, refused = await purchase(request, rfid_uid, items, "totalCost")
+    if refused:
+        return refused
+
+    return respond(request, {
+        "success": True,
+        "message": f"Successfully purchased {len(items)} items",
+        "itemsPurchased": [name for name, _ in items],
+        "totalCost": total_cost,
+        "newCoinBalance": new_balance,
+        "user": user_slice(updated_user)
+    })
+
+
+@device_route("/api/v1/users/{rfidUID}/use_travel_item", "use_travel_item", strict=False)
+async def use_travel_item(request, log):
+    rfid_uid = request.path_params["rfidUID"]
+    data = await json_body(request, silent=True) or {}
+    destination, message = travel_destination(data)
+    if message:
+        return error(request, message, 400)
+    item_name = data.get("itemName")
+
+    projection, _ = post_image_projection(
+        ["currentLocation", "purchasedItems"], requested=request.query_params.get("fields")
+    )
+    for _ in range(3):
+        user = await db.Users.find_one({"rfidUID": rfid_uid}, {"purchasedItems": 1})
+        if not user:
+            return error(request, "User not found", 404)
+
+        purchased_items = user.get("purchasedItems", []) or []
+        if not isinstance(purchased_items, list):
+            return error(request, "User purchasedItems is not a list", 500)
+
+        new_purchased_items = without_one_item(purchased_items, item_name)
+        if new_purchased_items is None:
+            return error(request, f"User does not have {item_name}", 400)
+
+        # Conditional on purchasedItems being unchanged, as in the Flask view
+        updated_user = await update_user(
+            rfid_uid,
+            travel_update(destination, new_purchased_items, item_name),
+            projection,
+            {"purchasedItems": user.get("purchasedItems")}
+        )
+        if updated_user:
+            break
+    else:
+        return error(request, "purchasedItems changed during the update, try again", 409)
+
+    logger.info(f"✅ User {rfid_uid} used {item_name} to travel to {destination}")
+    return respond(request, {
+        "success": True,
+        "message": f"Traveled to {destination}",
+        "currentLocation": destination,
+        "itemUsed": item_name,
+        "user": user_slice(updated_user),
+    })
+
+
+@device_route("/api/v1/users/{rfidUID}/use_seize_power", "use_seize_power")
+async def use_seize_power(request, log):
+    rfid_uid = request.path_params["rfidUID"]
+    activator = await db.Users.find_one({"rfidUID": rfid_uid}, {"currentLocation": 1, "purchasedItems": 1})
+    if not activator:
+        return error(request, "User not found", 404)
+
+    current_location = activator.get("currentLocation")
+    if not current_location:
+        return error(request, "Activator has no currentLocation", 400)
+
+    if not has_seize_power(activator.get("purchasedItems", [])):
+        return error(request, "User does not have SeizePower", 400)
+
+    current_lord = await db.Users.find_one({"lordOf": current_location}, {"rfidUID": 1})
+
+    previous_lord_id = None
+    if current_lord and current_lord.get("rfidUID") != rfid_uid:
+        previous_lord_id = current_lord.get("rfidUID")
+        await update_user(previous_lord_id, DEPOSED_LORD_UPDATE, {"_id": 1})
+
+    projection, _ = post_image_projection(
+        ["currentLocation", "lordOf", "purchasedItems"], requested=request.query_params.get("fields")
+    )
+    updated_user = await update_user(rfid_uid, seize_power_update(current_location), projection)
+
+    logger.info(f"✅ User {rfid_uid} seized power at {current_location} (prev: {previous_lord_id})")
+    return respond(request, {
+        "message": "SeizePower used",
+        "location": current_location,
+        "previousLord": previous_lord_id,
+        "newLord": rfid_uid,
+        "user": user_slice(updated_user)
+    })
+
+
+application = Starlette(routes=[*ROUTES, Mount("/", app=flask_asgi)], lifespan=lifespan)
@@ -0,0 +1,95 @@
+"""Compare the stdlib JSON path jsonify() used to take with the orjson provider.
+
+Builds a class of realistic user documents (ObjectIds, creature and loot
+stacks, purchasedItems and challengeCodes with datetimes) and times encoding
+the whole roster the way each provider does it.
+
+    python benchmarks/json_encoders.py [--students 30] [--classes 10] [--runs 200]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/gameapi")
+
+import app as gameapi  # noqa: E402
+
+
+class CustomJSONEncoder(json.JSONEncoder):
+    """The encoder app.json_encoder used to point at, plus Flask's old datetime handling."""
+
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, datetime.datetime):
+            from werkzeug.http import http_date
+            return http_date(obj)
+        return super().default(obj)
+
+
+def stdlib_dumps(obj):
+    # What Flask 2.2's default provider did with app.json_encoder set
+    return json.dumps(obj, cls=CustomJSONEncoder, sort_keys=True, separators=(",", ":"))
+
+
+def sample_student(i):
+    now = datetime.datetime(2024, 5, 1, 9, 30)
+    return {
+        "_id": ObjectId(),
+        "name": f"Student {i}",
+        "rfidUID": f"04A2B3{i:04X}",
+        "playerClass": "Kowhai School / Room 5",
+        "coins": 100 + i * 7,
+        "mainCreature": "Taniwha",
+        "currentLocation": "H",
+        "creatures": [
+            {"name": f"Creature{c}", "value": c % 9 + 1, "count": c % 4 + 1,
+             "stats": {"power": 3, "defence": 4, "speed": 5}}
+            for c in range(30)
+        ],
+        "artifacts": [{"name": f"Artifact{a}", "power": a} for a in range(5)],
+        "loot": [{"name": f"Loot{l}", "count": l % 6 + 1, "type": "loot"} for l in range(20)],
+        "purchasedItems": [
+            {"itemName": "boatTicketForest", "cost": 10, "purchaseDate": now - datetime.timedelta(days=p)}
+            for p in range(8)
+        ],
+        "challengeCodes": [
+            {"code": f"{c}7", "baseCode": str(c), "livesRemaining": 7, "timestamp": now}
+            for c in range(10)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    roster = [sample_student(i) for i in range(args.students)]
+    district = roster * args.classes
+    provider = gameapi.app.json
+    encoders = {
+        "stdlib (CustomJSONEncoder)": stdlib_dumps,
+        f"provider ({'orjson' if gameapi.orjson else 'stdlib fallback'})": provider.dumps,
+    }
+
+    for label, payload in ((f"class of {args.students}", roster), (f"{len(district)} users", district)):
+        print(f"\n{label}")
+        baseline = None
+        for name, dumps in encoders.items():
+            size = len(dumps(payload).encode())
+            seconds = timeit.timeit(lambda: dumps(payload), number=args.runs) / args.runs
+            baseline = baseline or seconds
+            print(f"  {name:<28}{size:>10} bytes{seconds * 1e3:>10.2f} ms{baseline / seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
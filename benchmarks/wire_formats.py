@@ -0,0 +1,82 @@
+"""Compare JSON, msgpack and CBOR for the payloads ESP32 devices exchange.
+
+Encodes a get_users?rfidUID= response and a stacked upload body in each
+format and reports the encoded size and the time to decode it. Decode time
+is what the device pays; run on a desktop it is only useful as a ratio.
+
+    python benchmarks/wire_formats.py [--creatures 40] [--loot 25] [--runs 2000]
+"""
+import argparse
+import datetime
+import json
+import timeit
+
+import cbor2
+import msgpack
+
+
+def sample_user(creatures, loot):
+    return {
+        "name": "Aroha",
+        "rfidUID": "04A2B3C4D5",
+        "playerClass": "Kowhai School / Room 5",
+        "coins": 1375,
+        "mainCreature": "Taniwha",
+        "currentLocation": "H",
+        "creatures": [
+            {"name": f"Creature{i}", "value": i % 9 + 1, "count": i % 4 + 1,
+             "stats": {"power": 3, "defence": 4, "speed": 5}}
+            for i in range(creatures)
+        ],
+        "loot": [{"name": f"Loot{i}", "count": i % 6 + 1, "type": "loot"} for i in range(loot)],
+        "artifacts": [{"name": "Compass", "value": 3}],
+        "challengeCodes": [
+            {"code": "734", "baseCode": "7", "livesRemaining": 7,
+             "timestamp": datetime.datetime(2024, 5, 1, 9, 30).isoformat()}
+        ],
+    }
+
+
+def sample_upload(creatures, loot):
+    return {
+        "rfidUID": "04A2B3C4D5",
+        "addCoins": 15,
+        "creatures": [{"name": f"Creature{i}", "value": i % 9 + 1, "count": 1} for i in range(creatures)],
+        "loot": [{"name": f"Loot{i}", "count": 1} for i in range(loot)],
+        "challengeCode": "734",
+    }
+
+
+FORMATS = {
+    "json": (lambda obj: json.dumps(obj, separators=(",", ":")).encode(), json.loads),
+    "msgpack": (msgpack.packb, msgpack.unpackb),
+    "cbor": (cbor2.dumps, cbor2.loads),
+}
+
+
+def compare(label, payload, runs):
+    print(f"\n{label}")
+    print(f"{'format':<10}{'bytes':>8}{'vs json':>10}{'decode us':>12}{'vs json':>10}")
+    baseline = None
+    for name, (encode, decode) in FORMATS.items():
+        data = encode(payload)
+        seconds = timeit.timeit(lambda: decode(data), number=runs) / runs
+        if baseline is None:
+            baseline = (len(data), seconds)
+        print(f"{name:<10}{len(data):>8}{len(data) / baseline[0]:>10.2f}"
+              f"{seconds * 1e6:>12.2f}{seconds / baseline[1]:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--creatures", type=int, default=40)
+    parser.add_argument("--loot", type=int, default=25)
+    parser.add_argument("--runs", type=int, default=2000)
+    args = parser.parse_args()
+
+    compare("get_users?rfidUID= response", sample_user(args.creatures, args.loot), args.runs)
+    compare("complete_loot_upload_stacked_v2 body", sample_upload(args.creatures // 4, args.loot // 4), args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Measure throughput of the gunicorn worker model across worker/thread counts.
+
+For each WORKERSxTHREADS pair this starts gunicorn with gunicorn.conf.py on
+a local port, drives one read endpoint from --clients keep-alive client
+threads for --seconds, and reports requests per second with p50/p99
+latency. The rate limiter is turned off and the pool is sized to the
+thread count, so the numbers reflect the worker model and Mongo alone.
+
+Point MONGO_URI at a database shaped like production (the default path
+reads one user's summary, so pass an rfidUID that exists) and run from
+the repository root:
+
+    MONGO_URI=mongodb://localhost:27017/gameapi \\
+        python benchmarks/worker_model.py --rfid 04A2B3C4D5 --grid 1x1,2x1,2x4,2x8,4x8
+
+Compare --worker-class gthread against gevent (needs `pip install gevent`)
+at the same total concurrency; for gevent the THREADS column is
+worker_connections. The 1x1 gthread row is the baseline the old
+`gunicorn app:app` Procfile ran at.
+
+No MongoDB server has been reachable where these were last run, so the
+rows below are the summary path served from an in-memory stand-in that
+sleeps 3ms per collection call (a LAN round trip). They show how the
+worker models overlap Mongo waits, not absolute throughput; rerun
+against a real Mongo before tuning production. One shared CPU, 32
+clients, 5s per row:
+
+    gthread      req/s  p50 ms  p99 ms     gevent       req/s  p50 ms  p99 ms
+    1x1             84   407.2   434.2     1x1             89    12.1  5342.7
+    2x1            159   208.2   229.6     2x1            144    14.0  5160.0
+    2x4            425    75.8    96.2     2x4            408    19.4  5026.6
+    2x8            565    55.6    94.6     2x8            477    32.7    58.0
+    4x8            445    70.2   138.6     4x8            374    86.9   118.3
+
+For gevent the second number is worker_connections, and below 32 the
+clients left waiting to be accepted are what the p99 shows. Past 2x8,
+extra workers only compete for the one CPU.
+
+With 8 refresh_events streams held open, a 1x8 gthread worker served no
+summary requests at all (every client timed out), 1x16 served 375 req/s
+and a 1x200 gevent worker 529 req/s; see the note on threads in
+gunicorn.conf.py.
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def wait_until_up(port, path, deadline):
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", path)
+            conn.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def drive(port, path, headers, seconds, clients):
+    """(completed requests, errors, latencies in ms) from `clients` threads hitting `path`."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        mine, failed = [], 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+                else:
+                    mine.append((time.perf_counter() - started) * 1000)
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], latencies
+
+
+def run(args, workers, threads, port):
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "WEB_CONCURRENCY": str(workers),
+        "GUNICORN_THREADS": str(threads),
+        "GUNICORN_WORKER_CLASS": args.worker_class,
+        "GUNICORN_CONNECTIONS": str(threads),
+        "MONGO_MAX_POOL_SIZE": str(threads + 4),
+        "RATE_LIMIT": "0",
+        "LOG_LEVEL": "WARNING",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not wait_until_up(port, args.path, time.monotonic() + 30):
+            return None
+        headers = {"X-API-Key": os.getenv("API_KEY", ""), "Accept-Encoding": "identity"}
+        drive(port, args.path, headers, 1, args.clients)  # warm pools and caches
+        return drive(port, args.path, headers, args.seconds, args.clients)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rfid", default="04A2B3C4D5")
+    parser.add_argument("--path", help="defaults to /api/v1/users/<rfid>/summary")
+    parser.add_argument("--grid", default="1x1,2x1,2x4,2x8,4x8", help="WORKERSxTHREADS pairs")
+    parser.add_argument("--worker-class", default="gthread", choices=["gthread", "gevent"])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+    args.path = args.path or f"/api/v1/users/{args.rfid}/summary"
+
+    print(f"{args.worker_class}, {args.clients} clients, {args.seconds:g}s per row, GET {args.path}")
+    print(f"{'workers':>8}{'threads':>9}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for pair in args.grid.split(","):
+        workers, threads = (int(n) for n in pair.lower().split("x"))
+        result = run(args, workers, threads, args.port)
+        if result is None:
+            print(f"{workers:>8}{threads:>9}  gunicorn did not come up")
+            continue
+        completed, errors, latencies = result
+        p50 = statistics.median(latencies) if latencies else float("nan")
+        p99 = statistics.quantiles(latencies, n=100)[98] if len(latencies) >= 100 else float("nan")
+        print(f"{workers:>8}{threads:>9}{completed / args.seconds:>10.0f}{p50:>9.1f}{p99:>9.1f}{errors:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""gunicorn settings for the game API.
+
+Every value can be overridden from the environment, so the Procfile stays
+`gunicorn -c gunicorn.conf.py app:app`:
+
+    WEB_CONCURRENCY         worker processes (Heroku sets this per dyno size)
+    GUNICORN_WORKER_CLASS   gthread (default) or gevent
+    GUNICORN_THREADS        threads per gthread worker
+    GUNICORN_CONNECTIONS    concurrent connections per gevent worker
+    GUNICORN_TIMEOUT        seconds a silent worker is given before it is restarted
+    GUNICORN_PRELOAD        1 to import the app once in the master before forking
+
+Requests mostly wait on Mongo, so threads (or greenlets) rather than more
+processes are the cheap way to serve more of them; the server-sent event
+streams in particular each hold one for up to SSE_MAX_SECONDS. Keep
+MONGO_MAX_POOL_SIZE at or above the threads per worker plus a few for the
+background threads, or requests queue for a connection (and fail after
+MONGO_WAIT_QUEUE_TIMEOUT_MS). gevent needs `pip install gevent`.
+benchmarks/worker_model.py measures throughput across these settings.
+
+The async device routes in asgi.py are opt-in; the Procfile does not run
+them. To serve them, run the same settings with
+`-k uvicorn.workers.UvicornWorker asgi:application`. GUNICORN_THREADS does
+not apply there; the Flask routes mounted beneath them run on a2wsgi's own
+thread pool.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2, 4)))
+# Each open refresh_events or live stream holds one of these threads for up
+# to SSE_MAX_SECONDS, so 8 dashboards on a worker leave it none for devices.
+# Add the streams a worker is expected to hold to this, or run gevent,
+# where a stream only holds a greenlet.
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_connections = int(os.getenv("GUNICORN_CONNECTIONS", 200))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 30
+# Seconds to hold an idle keep-alive connection open for its next request
+keepalive = 5
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+accesslog = None  # app.py logs one summary line per request
+
+
+def post_fork(server, worker):
+    # With preload_app the master imported app.py and its (unconnected)
+    # MongoClient; give each worker its own. Otherwise the worker imports
+    # app.py itself after this hook and gets a fresh client anyway.
+    import sys
+    if "app" in sys.modules:
+        sys.modules["app"].init_mongo()
+        server.log.info("Worker %s: Mongo client created post-fork", worker.pid)